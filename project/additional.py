@@ -1,19 +1,163 @@
+import atexit
 import csv
 import datetime
+import decimal
+import glob
+import gzip
+import io
+import json
 import os
+import queue
 import shutil
-import tempfile
+import sys
+import threading
 import zipfile
-from typing import Union
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator, Optional, Union
+from urllib.parse import quote
 
 import pkg_resources
 
 from fastapi import Request
+from starlette.responses import StreamingResponse
+
+from .data.database import Base
+
+
+class _LogWriter:
+    """
+    Writes log entries queued by ApiLogger from a single background thread, in batches,
+    to log files kept open between batches. Callers never wait for disk: when the bounded queue
+    is full new entries are dropped, and the number of dropped entries is logged with the next batch.
+    With max_bytes set, a file reaching that size is renamed to <name>.<timestamp><ext>, gzipped by another
+    background thread and only the newest backup_count compressed segments of it are kept
+    """
+
+    def __init__(self, max_queue_size: int, batch_size: int = 500, max_open_files: int = 32,
+                 max_bytes: int = 0, backup_count: int = 0):
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.batch_size = batch_size
+        self.max_open_files = max_open_files
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+        self._files = OrderedDict()
+        self._compressor: Optional[ThreadPoolExecutor] = None
+        self._thread = threading.Thread(target=self._run, name="api-logger", daemon=True)
+        self._thread.start()
+
+    def put(self, path: str, text: str) -> None:
+        try:
+            self.queue.put_nowait((path, text))
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+    def flush(self) -> None:
+        """Wait until all queued entries are written"""
+        self.queue.join()
+
+    def close(self, timeout: float = 5) -> None:
+        """Write queued entries, close files and stop the writer thread, finishing compression of rotated files"""
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+        if self._compressor is not None:
+            self._compressor.shutdown(wait=True)
+
+    def _run(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            entries = [entry for entry in batch if entry is not None]
+            try:
+                self._write(entries)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+            if len(entries) < len(batch):
+                for file in self._files.values():
+                    file.close()
+                self._files.clear()
+                return
+
+    def _write(self, entries: list) -> None:
+        texts = defaultdict(list)
+        for path, text in entries:
+            texts[path].append(text)
+        with self._dropped_lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped and texts:
+            texts[next(iter(texts))].append(f"\n[{datetime.datetime.now().isoformat(sep='#', timespec='seconds')}]"
+                                            f" logger: {dropped} log entries dropped, queue was full\n")
+        for path, path_texts in texts.items():
+            try:
+                file = self._file(path)
+                file.write("".join(path_texts))
+                file.flush()
+                if self.max_bytes and os.fstat(file.fileno()).st_size >= self.max_bytes:
+                    self._rotate(path)
+            except Exception as e:
+                print(f"Couldn't write {len(path_texts)} log entries to {path}: {e}", file=sys.stderr)
+
+    def _rotate(self, path: str) -> None:
+        self._files.pop(path).close()
+        base, ext = os.path.splitext(path)
+        rotated = f"{base}.{datetime.datetime.now().strftime('%Y%m%dT%H%M%S%f')}{ext}"
+        os.replace(path, rotated)
+        if self._compressor is None:
+            self._compressor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="api-logger-gzip")
+        # only timestamped segments of this log, not of logs named with it as a dotted prefix
+        self._compressor.submit(self._compress, rotated, f"{glob.escape(base)}.[0-9]*T[0-9]*{ext}.gz")
+
+    def _compress(self, rotated: str, segments_pattern: str) -> None:
+        try:
+            with open(rotated, "rb") as source, gzip.open(rotated + ".gz", "wb") as target:
+                shutil.copyfileobj(source, target)
+            os.remove(rotated)
+            if self.backup_count:
+                for old in sorted(glob.glob(segments_pattern))[:-self.backup_count]:
+                    os.remove(old)
+        except Exception as e:
+            print(f"Couldn't compress rotated log {rotated}: {e}", file=sys.stderr)
+
+    def _file(self, path: str):
+        file = self._files.get(path)
+        if file is not None:
+            self._files.move_to_end(path)
+            return file
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        file = self._files[path] = open(path, mode="a", encoding="utf-8")
+        while len(self._files) > self.max_open_files:
+            self._files.popitem(last=False)[1].close()
+        return file
+
+
+# headers never written to logs, as they carry credentials
+REDACTED_HEADERS = frozenset(("authorization", "proxy-authorization", "cookie", "set-cookie"))
+
+
+def redacted_headers(headers) -> dict:
+    return {name: "<redacted>" if name.lower() in REDACTED_HEADERS else value
+            for name, value in headers.items()}
 
 
 class ApiLogger:
 
     logs_path = pkg_resources.resource_filename("project", "") + f"/{os.environ.get('LOGS_DIR_NAME')}"
+    # 'text' - free-form entries in per-day directories, 'json' - one JSON object per line in files
+    # rotated by size, with request events logged by middleware.RequestLogMiddleware
+    log_format = os.environ.get("LOG_FORMAT", "text")
+    _writer: Optional[_LogWriter] = None
+    _writer_lock = threading.Lock()
 
     @classmethod
     def create_main_logs_dir(cls):
@@ -21,59 +165,228 @@ class ApiLogger:
             print("Creating logs directory")
             os.mkdir(cls.logs_path)
 
+    @classmethod
+    def writer(cls) -> _LogWriter:
+        """Get background writer of log entries, started on first use"""
+        if cls._writer is None:
+            with cls._writer_lock:
+                if cls._writer is None:
+                    cls._writer = _LogWriter(max_queue_size=int(os.environ.get("LOG_QUEUE_SIZE", 10000)),
+                                             max_bytes=int(os.environ.get("LOG_MAX_BYTES", 50 * 1024 * 1024)),
+                                             backup_count=int(os.environ.get("LOG_BACKUP_COUNT", 20)))
+                    atexit.register(cls._writer.close)
+        return cls._writer
+
+    @classmethod
+    def flush(cls):
+        """Wait until all created logs are written to files"""
+        if cls._writer is not None:
+            cls._writer.flush()
+
+    @classmethod
+    def json_mode(cls) -> bool:
+        return cls.log_format == "json"
+
+    @classmethod
+    def log_event(cls, name: str, event: dict):
+        """
+        Queue structured log event to be written as JSON line into logs/<name>.jsonl
+
+        :param name: name of the log file, without extension
+        :param event: JSON serializable event data, values which aren't are written as strings
+        :return: None
+        """
+        line = json.dumps({"ts": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='milliseconds'),
+                           **event}, ensure_ascii=False, default=str)
+        cls.writer().put(f"{cls.logs_path}/{name}.jsonl", line + "\n")
+
     @classmethod
     def create_module_log(cls, module: Union[Request, str], msg: str,
-                          log_type: str = 'work'):
-        cls.create_main_logs_dir()
+                          log_type: str = 'work', **fields):
+        """
+        Queue log entry to be written by background writer into logs/<date>/<module>.<log_type>.log,
+        or as JSON line into logs/<module>.<log_type>.jsonl in json log format,
+        where module is the first segment of request path if request is given
+
+        :param module: request the entry is about or name of the module logging it
+        :param msg: logged message
+        :param log_type: type of the log, ex: 'work' or 'exc'
+        :param fields: additional data of the entry, ex: status
+        :return: None
+        """
         if not 3 <= len(log_type) <= 20:
             raise ValueError("Module name must be between 3 to 20 characters in length")
         if not isinstance(module, (str, Request)):
             raise TypeError("Argument 'module' has to be str or Request")
         if not isinstance(msg, str):
             raise TypeError("Argument 'msg' has to be of type str")
+        module_name = module.url.path.split('/')[1] if isinstance(module, Request) else module
+
+        if cls.json_mode():
+            event = {"event": log_type, "module": module_name, "msg": msg, **fields}
+            if isinstance(module, Request):
+                event.update(request_log_fields(module.scope), query=dict(module.query_params),
+                             path_params=module.path_params, headers=redacted_headers(module.headers))
+            cls.log_event(f"{module_name}.{log_type}", event)
+            return
+
         log_dir_path = cls.logs_path + f"/{datetime.date.today().isoformat()}"
-        if not os.path.exists(log_dir_path):
-            os.mkdir(log_dir_path)
-
-        if type(module) == Request:
-            with open(file=f"{log_dir_path}/{module.url.path.split('/')[1]}.{log_type}.log", mode="a+", encoding="utf-8") as logfile:
-                msg = f"\n[{datetime.datetime.now().isoformat(sep='#', timespec='seconds')}]" \
-                      f" {module.url.path}: {msg} \n" \
-                      f"Request url: {module.url}\n" \
-                      f"Request path params: {module.path_params}\n" \
-                      f"Request query params: {module.query_params}\n" \
-                      f"Request headers: {module.headers}\n"
-                logfile.write(msg)
-
-        elif type(module) == str:
-            with open(file=f"{log_dir_path}/{module}.{log_type}.log", mode="a+", encoding="utf-8") as logfile:
-                msg = f"\n[{datetime.datetime.now().isoformat(sep='#', timespec='seconds')}]" \
-                      f" {module}: {msg} \n"
-                logfile.write(msg)
-
-
-def create_temp_csv(data: list, filename: str, column_names: list[str]) -> None:
-    if not isinstance(data, list):
-        raise TypeError(f"Input must be dict, got {type(data)}")
-    if not isinstance(column_names, list):
-        raise TypeError(f"Column names have to be list of str, got {type(column_names)}")
-    current_path = os.path.dirname(os.path.realpath(__file__))
-    tmp_dir = tempfile.mkdtemp(dir=current_path)
-    compressed_file = f"{filename}.zip"
-    os.chdir(tmp_dir)
-    zip_file = zipfile.ZipFile(compressed_file, 'w')
-    csv_filename = f"{filename}.csv"
-
-    with open(f"{tmp_dir}/{csv_filename}", 'w', encoding='utf-8') as csv_file:
-        writer = csv.DictWriter(csv_file, fieldnames=column_names)
-        writer.writeheader()
-        for row in data:
-            writer.writerow(row)
-    zip_file.write(f'{tmp_dir}/{csv_filename}', compress_type=zipfile.ZIP_DEFLATED,
-                   arcname=os.path.basename(f"{tmp_dir}/{csv_filename}.csv"))
-    zip_file.close()
-    return compressed_file, tmp_dir
-
-
-def delete_temp_files(temp_files_dir: str):
-    shutil.rmtree(temp_files_dir)
+        path = f"{log_dir_path}/{module_name}.{log_type}.log"
+        extra = "".join(f"{name}: {value}\n" for name, value in fields.items())
+        if isinstance(module, Request):
+            msg = f"\n[{datetime.datetime.now().isoformat(sep='#', timespec='seconds')}]" \
+                  f" {module.url.path}: {msg} \n" \
+                  f"Request url: {module.url}\n" \
+                  f"Request path params: {module.path_params}\n" \
+                  f"Request query params: {module.query_params}\n" \
+                  f"Request headers: {redacted_headers(module.headers)}\n" + extra
+        else:
+            msg = f"\n[{datetime.datetime.now().isoformat(sep='#', timespec='seconds')}]" \
+                  f" {module}: {msg} \n" + extra
+        cls.writer().put(path, msg)
+
+
+def request_log_fields(scope: dict) -> dict:
+    """
+    Get fields identifying request in structured logs: method, path, route template
+    (set once the request is routed) and id of authenticated user (set by auth dependencies)
+    """
+    return {"method": scope.get("method"),
+            "path": scope.get("path"),
+            "route": getattr(scope.get("route"), "path", None),
+            "user_id": scope.get("state", {}).get("user_id")}
+
+
+class _ZipStream(io.RawIOBase):
+    """
+    Write-only, unseekable stream collecting bytes written by ZipFile until they are taken out.
+    ZipFile falls back to data descriptors for unseekable streams, so nothing has to be rewritten
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self.size = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        self.size += len(b)
+        return len(b)
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        self.size = 0
+        return data
+
+
+def stream_csv_zip(rows: Iterable[dict], filename: str, column_names: Iterable[str],
+                   chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+    """
+    Write rows as csv file compressed into a zip archive, yielding the archive in chunks as it's built.
+    Nothing is written to disk and only one chunk is kept in memory at a time
+
+    :param rows: dicts with csv row values, can be a lazy iterator over database results
+    :param filename: name of the csv file inside the archive, without extension
+    :param column_names: names of csv columns, keys of rows
+    :param chunk_size: approximate size of yielded chunks in bytes
+    :return: iterator over bytes of the zip archive
+    """
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+        with zip_file.open(f"{filename}.csv", 'w', force_zip64=True) as binary_file:
+            csv_file = io.TextIOWrapper(binary_file, encoding='utf-8', newline='')
+            writer = csv.DictWriter(csv_file, fieldnames=list(column_names))
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(row)
+                if stream.size >= chunk_size:
+                    yield stream.take()
+            csv_file.flush()
+            csv_file.detach()
+    yield stream.take()
+
+
+def csv_zip_response(rows: Iterable[dict], filename: str, column_names: Iterable[str],
+                     headers: Optional[dict] = None) -> StreamingResponse:
+    """
+    Create response streaming rows as zipped csv file, see stream_csv_zip
+
+    :param rows: dicts with csv row values
+    :param filename: name of the archive and the csv file inside it, without extension
+    :param column_names: names of csv columns, keys of rows
+    :param headers: additional response headers
+    :return: streaming response with zip archive attachment
+    """
+    quoted_filename = quote(f"{filename}.zip")
+    if quoted_filename == f"{filename}.zip":
+        content_disposition = f'attachment; filename="{filename}.zip"'
+    else:
+        content_disposition = f"attachment; filename*=utf-8''{quoted_filename}"
+    return StreamingResponse(stream_csv_zip(rows, filename, column_names), media_type='application/zip',
+                             headers={'Content-Disposition': content_disposition, **(headers or {})})
+
+
+def model_rows(objects: Iterable[Base]) -> Iterator[dict]:
+    """Convert model objects to dicts of their column values, lazily"""
+    for obj in objects:
+        yield dict((col, getattr(obj, col)) for col in obj.__table__.columns.keys())
+
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def wants_ndjson(request: Request, data_format: Optional[str] = None) -> bool:
+    """Check if list should be streamed as NDJSON, requested with data_format=ndjson or Accept header"""
+    return data_format == 'ndjson' or NDJSON_MEDIA_TYPE in request.headers.get('accept', '')
+
+
+def _ndjson_default(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def ndjson_lines(rows: Iterable[dict]) -> str:
+    """Serialize rows as NDJSON, decimals as numbers and dates in ISO format like JSON responses"""
+    return "".join(json.dumps(row, default=_ndjson_default, separators=(',', ':')) + "\n" for row in rows)
+
+
+def stream_ndjson(objects: Iterable[Base], batch_size: int = 500) -> Iterator[str]:
+    """
+    Serialize model objects to NDJSON lines of their column values as they are read,
+    yielding batch_size lines at once
+
+    :param objects: model objects, for example from query_stream
+    :param batch_size: number of lines in one yielded chunk
+    :return: iterator over chunks of NDJSON
+    """
+    rows = model_rows(objects)
+    while True:
+        chunk = ndjson_lines(row for _, row in zip(range(batch_size), rows))
+        if not chunk:
+            return
+        yield chunk
+
+
+async def astream_ndjson(batches: AsyncIterable[Iterable[Base]]) -> AsyncIterator[str]:
+    """Async version of stream_ndjson, for batches of objects read from AsyncSession.stream"""
+    async for batch in batches:
+        yield ndjson_lines(model_rows(batch))
+
+
+def ndjson_response(content: Union[Iterator[str], AsyncIterator[str]],
+                    headers: Optional[dict] = None) -> StreamingResponse:
+    """
+    Create response streaming NDJSON chunks, see stream_ndjson
+
+    :param content: chunks of NDJSON
+    :param headers: additional response headers
+    :return: streaming response
+    """
+    return StreamingResponse(content, media_type=NDJSON_MEDIA_TYPE, headers=headers)
@@ -1,16 +1,23 @@
+import asyncio
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Any, Optional
+from typing import Any, NamedTuple, Optional, Tuple
 
 from dotenv import load_dotenv
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from sqlalchemy.orm import Session
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, object_session
 
+from .cache import TTLCache
 from .data.models import User
-from .dependencies import get_db
+from .dependencies import get_db, get_async_db
 
 load_dotenv()
 SECRET_KEY = os.environ.get("API_SEC_SECRET")
@@ -19,6 +26,23 @@ ACCESS_TOKEN_EXPIRE_DAYS = int(os.environ.get("API_TOKEN_EXPIRE_DAYS"))
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 bcrypt_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# bcrypt is slow by design, so hashing in async endpoints runs on its own bounded pool, off the event loop
+# and without taking threads of the pool running sync endpoints
+password_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("PASSWORD_HASHING_WORKERS",
+                                                                      min(4, os.cpu_count() or 1))),
+                                       thread_name_prefix="password-hashing")
+
+
+class UserIdentity(NamedTuple):
+    """Authenticated user, enough for routes that only need to know who is calling"""
+    id: int
+    username: str
+    auth_level: int
+
+
+# verified token -> identity of its active user, entries are dropped when the user is changed or deleted
+user_cache = TTLCache(max_entries=int(os.environ.get("USER_CACHE_MAX_ENTRIES", 10000)))
+USER_CACHE_TTL_SECONDS = float(os.environ.get("USER_CACHE_TTL_SECONDS", 60))
 
 
 def get_password_hash(password: str) -> str:
@@ -29,8 +53,32 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     return bcrypt_context.verify(plain_password, hashed_password)
 
 
+async def get_password_hash_async(password: str) -> str:
+    return await asyncio.get_running_loop().run_in_executor(password_executor, get_password_hash, password)
+
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await asyncio.get_running_loop().run_in_executor(password_executor, verify_password,
+                                                            plain_password, hashed_password)
+
+
+def user_get_by_username(db: Session, username: str) -> Optional[User]:
+    return db.query(User).filter(User.username == username).first()
+
+
+def user_get_by_username_released(db: Session, username: str) -> Optional[User]:
+    """
+    Look up user and close the session in the same call, so its connection is released by the thread
+    that used it when called through run_in_threadpool. Returned user is detached with its columns loaded
+    """
+    try:
+        return user_get_by_username(db, username)
+    finally:
+        db.close()
+
+
 def authenticate_user(username: str, password: str, db: Session) -> Any:
-    user = db.query(User).filter(User.username == username).first()
+    user = user_get_by_username(db, username)
     if not user:
         return False
     if not verify_password(password, user.hashed_password):
@@ -38,6 +86,15 @@ def authenticate_user(username: str, password: str, db: Session) -> Any:
     return user
 
 
+async def authenticate_user_async(username: str, password: str, db: Session) -> Any:
+    user = await run_in_threadpool(user_get_by_username_released, db, username)
+    if not user:
+        return False
+    if not await verify_password_async(password, user.hashed_password):
+        return False
+    return user
+
+
 def create_access_token(username: str, user_id: int,
                         expires_delta: Optional[timedelta] = None):
     encode_data = {"sub": username, "id": user_id}
@@ -49,24 +106,103 @@ def create_access_token(username: str, user_id: int,
     return jwt.encode(encode_data, SECRET_KEY, algorithm=ALGORITHM)
 
 
-async def get_current_active_user(db: Session = Depends(get_db),
-                                  token: str = Depends(oauth2_scheme)):
+def get_current_active_user(request: Request,
+                            db: Session = Depends(get_db),
+                            token: str = Depends(oauth2_scheme)):
+    """Get the full user model of the token's active user, for routes which need more than its identity"""
+    username, _ = _decode_token(token)
+    user = db.query(User)\
+        .filter(User.username == username)\
+        .filter(User.is_active == True)\
+        .first()
+    if user is not None:
+        request.state.user_id = user.id
+    return user
+
+
+def _decode_token(token: str) -> Tuple[str, Optional[float]]:
     try:
         payload = jwt.decode(token, SECRET_KEY, ALGORITHM)
-        username: str = payload.get("sub")
-        user_id: int = payload.get("id")
-        if username is None or user_id is None:
-            raise get_user_exception()
-        else:
-            return db.query(User)\
-                .filter(User.username == username)\
-                .filter(User.is_active == True)\
-                .first()
     except JWTError:
         raise get_user_exception()
+    if payload.get("sub") is None or payload.get("id") is None:
+        raise get_user_exception()
+    return payload["sub"], payload.get("exp")
 
 
-def check_if_user_admin(current_active_user: User = Depends(get_current_active_user)):
+def _cache_identity(token: str, user: Optional[User], expires: Optional[float]) -> UserIdentity:
+    if user is None:
+        raise get_user_exception()
+    identity = UserIdentity(id=user.id, username=user.username, auth_level=user.auth_level)
+    ttl = USER_CACHE_TTL_SECONDS if expires is None else min(USER_CACHE_TTL_SECONDS, expires - time.time())
+    if ttl > 0:
+        user_cache.set(token, identity, time.monotonic() + ttl)
+    return identity
+
+
+def get_current_user_identity(request: Request,
+                              db: Session = Depends(get_db),
+                              token: str = Depends(oauth2_scheme)) -> UserIdentity:
+    """
+    Get identity of the active user the token belongs to, without querying the database
+    if the same token was verified recently. User id is kept in request state for request logs
+
+    :param request: authenticated request
+    :param db: database session, used only when token isn't cached
+    :param token: bearer token
+    :return: identity of authenticated user
+    """
+    identity = user_cache.get(token)
+    if identity is None:
+        username, expires = _decode_token(token)
+        user = db.query(User)\
+            .filter(User.username == username)\
+            .filter(User.is_active == True)\
+            .first()
+        identity = _cache_identity(token, user, expires)
+    request.state.user_id = identity.id
+    return identity
+
+
+async def get_current_user_identity_async(request: Request,
+                                          db: AsyncSession = Depends(get_async_db),
+                                          token: str = Depends(oauth2_scheme)) -> UserIdentity:
+    """Same as get_current_user_identity, querying through async session"""
+    identity = user_cache.get(token)
+    if identity is None:
+        username, expires = _decode_token(token)
+        result = await db.execute(select(User)
+                                  .filter(User.username == username)
+                                  .filter(User.is_active == True))
+        identity = _cache_identity(token, result.scalars().first(), expires)
+    request.state.user_id = identity.id
+    return identity
+
+
+def _forget_user(user_id: int) -> None:
+    user_cache.discard_where(lambda identity: identity.id == user_id)
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _forget_changed_user(mapper, connection, user: User) -> None:
+    _forget_user(user.id)
+    # forgotten again after commit, as requests running before it can cache the old state again
+    object_session(user).info.setdefault('changed_users', set()).add(user.id)
+
+
+@event.listens_for(Session, "after_commit")
+def _forget_committed_users(session: Session) -> None:
+    for user_id in session.info.pop('changed_users', ()):
+        _forget_user(user_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_changed_users(session: Session) -> None:
+    session.info.pop('changed_users', None)
+
+
+def check_if_user_admin(current_active_user: UserIdentity = Depends(get_current_user_identity)):
     if not current_active_user.auth_level > 1:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail="Only admin users can access this endpoint")
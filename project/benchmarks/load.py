@@ -0,0 +1,286 @@
+"""
+Load generator replaying a weighted mix of client calls against a running server, by many users at once.
+Users are the ones generated by populate_db in bulk mode (populator_<seed>_<n>), each using its latest season:
+
+    python -m project.populate_db --bulk --seed 1 --users 20 --employees 50
+    python -m project.benchmarks.load --seed 1 --users 20 --concurrency 32 --duration 60 --launch --workers 4
+
+Reports throughput, error rate and latency percentiles, overall and per call, as JSON
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+from urllib.parse import urlsplit
+
+import requests
+
+from .stats import summarize
+
+# relative frequency of calls, like the web and mobile clients send them in season
+DEFAULT_MIX = {
+    "dashboard": 40,          # season summary polled with If-None-Match
+    "seasons_summary": 10,    # all seasons summary polled with If-None-Match
+    "harvests_list": 10,
+    "employee_summary": 10,
+    "workday_entry": 15,
+    "harvest_entry": 5,
+    "export_csv": 5,
+    "workdays_page": 5,
+}
+# fruits not used by populate_db, so new harvests don't collide with generated ones on unique date and fruit
+ENTRY_FRUITS = ("apple", "blackcurrant", "redcurrant")
+
+
+class VirtualUser:
+    """Logged in user with ids of its latest season data, shared by workers sending its calls"""
+
+    def __init__(self, username: str, token: str, season: dict, harvests: List[dict], employee_ids: List[int]):
+        self.username = username
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.year = season["year"]
+        self.harvest_ids = [harvest["id"] for harvest in harvests]
+        self.employee_ids = employee_ids
+        self.etags: Dict[str, str] = {}
+        self.next_workdays_page = "/workdays/?limit=50"
+        used = {(harvest["date"], harvest["fruit"]) for harvest in harvests}
+        start = datetime.date.fromisoformat(season["start_date"])
+        end = datetime.date.fromisoformat(season["end_date"] or season["start_date"])
+        self.free_slots = [(day.isoformat(), fruit)
+                           for day in (start + datetime.timedelta(days=d) for d in range((end - start).days + 1))
+                           for fruit in ENTRY_FRUITS if (day.isoformat(), fruit) not in used]
+        self.lock = threading.Lock()
+
+
+class LoadTest:
+
+    def __init__(self, base_url: str, mix: Dict[str, int], rng: random.Random,
+                 session_factory: Callable[[], requests.Session] = requests.Session):
+        unknown = set(mix) - set(DEFAULT_MIX)
+        if unknown:
+            raise ValueError(f"Unknown calls in mix: {', '.join(sorted(unknown))}")
+        self.base_url = base_url.rstrip("/")
+        self.calls = [name for name, weight in mix.items() if weight > 0]
+        self.weights = [mix[name] for name in self.calls]
+        self.rng = rng
+        self.session_factory = session_factory
+        self.results: Dict[str, dict] = defaultdict(lambda: {"durations": [], "queries": [], "statuses": []})
+        self.errors = Counter()
+        self._results_lock = threading.Lock()
+        self._local = threading.local()
+
+    def session(self) -> requests.Session:
+        if not hasattr(self._local, "session"):
+            self._local.session = self.session_factory()
+        return self._local.session
+
+    def request(self, call: str, method: str, path: str, **kwargs) -> Optional[requests.Response]:
+        start = time.perf_counter()
+        try:
+            response = self.session().request(method, self.base_url + path, timeout=60, **kwargs)
+        except requests.RequestException as e:
+            response = None
+            error = type(e).__name__
+        else:
+            error = str(response.status_code) if response.status_code >= 400 else None
+        duration = time.perf_counter() - start
+        with self._results_lock:
+            result = self.results[call]
+            result["durations"].append(duration)
+            result["statuses"].append(response.status_code if response is not None else 0)
+            if response is not None and "X-DB-Queries" in response.headers:
+                result["queries"].append(int(response.headers["X-DB-Queries"]))
+            if error:
+                self.errors[(call, error)] += 1
+        return response
+
+    def login(self, username: str, password: str) -> Optional[VirtualUser]:
+        response = self.request("login", "POST", "/token", data={"username": username, "password": password})
+        if response is None or response.status_code != 200:
+            return None
+        token = response.json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        seasons = self.request("setup", "GET", "/seasons/?order_by=year&order=desc&limit=1", headers=headers)
+        if seasons is None or seasons.status_code != 200:
+            return None
+        season = seasons.json()[0]
+        harvests = self.request("setup", "GET", f"/seasons/{season['year']}/harvests?limit=100000",
+                                headers=headers)
+        employees = self.request("setup", "GET", f"/seasons/{season['year']}/employees?limit=100000",
+                                 headers=headers)
+        return VirtualUser(username, token, season,
+                           harvests.json() if harvests is not None and harvests.status_code == 200 else [],
+                           [e["id"] for e in employees.json()]
+                           if employees is not None and employees.status_code == 200 else [])
+
+    def run_call(self, user: VirtualUser, call: str) -> None:
+        year, headers = user.year, user.headers
+        if call in ("dashboard", "seasons_summary"):
+            path = f"/seasons/{year}/summary" if call == "dashboard" else "/seasons/summary"
+            etag = user.etags.get(path)
+            if etag:
+                headers = {**headers, "If-None-Match": etag}
+            response = self.request(call, "GET", path, headers=headers)
+            if response is not None and "ETag" in response.headers:
+                user.etags[path] = response.headers["ETag"]
+        elif call == "harvests_list":
+            self.request(call, "GET", f"/seasons/{year}/harvests?limit=20&order_by=date", headers=headers)
+        elif call == "employee_summary" and user.employee_ids:
+            self.request(call, "GET", f"/emlpoyees/{self.rng.choice(user.employee_ids)}/summary", headers=headers)
+        elif call == "workday_entry" and user.harvest_ids and user.employee_ids:
+            body = {"employee_id": self.rng.choice(user.employee_ids),
+                    "harvested": self.rng.randint(3, 200), "pay_per_kg": self.rng.randint(2, 10)}
+            self.request(call, "POST", f"/harvests/{self.rng.choice(user.harvest_ids)}/workdays",
+                         json=body, headers=headers)
+        elif call == "harvest_entry":
+            with user.lock:
+                slot = user.free_slots.pop(self.rng.randrange(len(user.free_slots))) if user.free_slots else None
+            if slot is None:
+                return
+            body = {"date": slot[0], "fruit": slot[1], "price": self.rng.randint(5, 25),
+                    "harvested": self.rng.randint(100, 3000)}
+            response = self.request(call, "POST", f"/seasons/{year}/harvests", json=body, headers=headers)
+            if response is not None and response.status_code == 201:
+                with user.lock:
+                    user.harvest_ids.append(response.json()["id"])
+        elif call == "export_csv":
+            self.request(call, "GET", f"/seasons/{year}/harvests?data_format=csv&limit=100000", headers=headers)
+        elif call == "workdays_page":
+            response = self.request(call, "GET", user.next_workdays_page, headers=headers)
+            next_page = response.links.get("next", {}).get("url") if response is not None else None
+            if next_page:
+                url = urlsplit(next_page)
+                user.next_workdays_page = f"{url.path}?{url.query}"
+            else:
+                user.next_workdays_page = "/workdays/?limit=50"
+
+    def worker(self, users: List[VirtualUser], deadline: float, think_time: float) -> None:
+        while time.perf_counter() < deadline:
+            self.run_call(self.rng.choice(users), self.rng.choices(self.calls, self.weights)[0])
+            if think_time:
+                time.sleep(think_time)
+
+    def report(self, duration: float) -> dict:
+        calls = {}
+        total = {"durations": [], "queries": [], "statuses": []}
+        for call, result in sorted(self.results.items()):
+            errors = sum(count for (error_call, _), count in self.errors.items() if error_call == call)
+            calls[call] = {**summarize(**result), "errors": errors,
+                           "error_rate": round(errors / len(result["durations"]), 4) if result["durations"] else 0}
+            if call not in ("login", "setup"):
+                for key in total:
+                    total[key] += result[key]
+        errors = sum(count for (call, _), count in self.errors.items() if call not in ("login", "setup"))
+        return {
+            "duration_s": round(duration, 3),
+            "requests": len(total["durations"]),
+            "throughput_rps": round(len(total["durations"]) / duration, 2) if duration else None,
+            "errors": errors,
+            "error_rate": round(errors / len(total["durations"]), 4) if total["durations"] else 0,
+            "latency": summarize(**total),
+            "errors_by_status": {f"{call} {error}": count for (call, error), count in sorted(self.errors.items())},
+            "calls": calls,
+        }
+
+
+def run_load(base_url: str, usernames: List[str], password: str, concurrency: int = 16, duration: float = 30,
+             mix: Optional[Dict[str, int]] = None, think_time: float = 0, seed: int = 0,
+             session_factory: Callable[[], requests.Session] = requests.Session) -> dict:
+    """
+    Log users in and send the mix of calls from concurrent workers for given time
+
+    :param base_url: url of tested server
+    :param usernames: users logged in, calls are spread over them randomly
+    :param password: password of the users
+    :param concurrency: number of workers sending calls, each waits for its response before sending the next
+    :param duration: seconds of sending calls, after logins
+    :param mix: relative weights of calls, DEFAULT_MIX if not given
+    :param think_time: seconds each worker waits between calls
+    :param seed: seed of randomly chosen calls and their data
+    :param session_factory: creates http session of every worker
+    :return: report with throughput, error rate and latency percentiles, overall and per call
+    """
+    load_test = LoadTest(base_url, mix or DEFAULT_MIX, random.Random(seed), session_factory)
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="load") as executor:
+        users = [user for user in executor.map(lambda username: load_test.login(username, password), usernames)
+                 if user is not None]
+        if not users:
+            raise RuntimeError(f"None of the users could log in: {dict(load_test.errors)}")
+        start = time.perf_counter()
+        deadline = start + duration
+        futures = [executor.submit(load_test.worker, users, deadline, think_time) for _ in range(concurrency)]
+        for future in futures:
+            future.result()
+    report = load_test.report(time.perf_counter() - start)
+    report.update(users=len(users), concurrency=concurrency, mix=mix or DEFAULT_MIX)
+    return report
+
+
+def launch_server(host: str, port: int, workers: int) -> subprocess.Popen:
+    """Start uvicorn serving the app in a subprocess and wait until it responds"""
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "project.main:app", "--host", host,
+                               "--port", str(port), "--workers", str(workers), "--no-access-log"],
+                              env=dict(os.environ))
+    for _ in range(300):
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with code {server.returncode}")
+        try:
+            requests.get(f"http://{host}:{port}/", timeout=1)
+            return server
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError("Server didn't start in 30 seconds")
+
+
+def parse_mix(values: List[str]) -> Dict[str, int]:
+    mix = dict(DEFAULT_MIX)
+    for value in values:
+        name, _, weight = value.partition("=")
+        mix[name] = int(weight)
+    return mix
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay weighted mix of client calls against running server")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--seed", type=int, default=0, help="seed of populate_db users and of sent calls")
+    parser.add_argument("--users", type=int, default=10, help="number of populate_db users to log in")
+    parser.add_argument("--password", default="populator")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--think-time", type=float, default=0, help="seconds between calls of each worker")
+    parser.add_argument("--mix", action="append", default=[], metavar="CALL=WEIGHT",
+                        help=f"weight of a call, can be repeated, calls: {', '.join(DEFAULT_MIX)}")
+    parser.add_argument("--launch", action="store_true", help="start uvicorn for the test on base url host and port")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers of launched server")
+    parser.add_argument("--output", help="file for JSON report, printed if not given")
+    args = parser.parse_args()
+
+    server = None
+    if args.launch:
+        url = urlsplit(args.base_url)
+        server = launch_server(url.hostname, url.port or 80, args.workers)
+    try:
+        results = run_load(args.base_url, [f"populator_{args.seed}_{i}" for i in range(1, args.users + 1)],
+                           args.password, concurrency=args.concurrency, duration=args.duration,
+                           mix=parse_mix(args.mix), think_time=args.think_time, seed=args.seed)
+        results["workers"] = args.workers if args.launch else None
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
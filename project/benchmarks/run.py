@@ -0,0 +1,202 @@
+"""
+End-to-end benchmarks of key routes, run against the real app through in-process test client
+on a generated dataset (see populate_db.generate_bulk) in on-disk sqlite or local postgres database.
+Results are written as JSON with latency percentiles and database statements per route:
+
+    python -m project.benchmarks.run --database-url sqlite:///./benchmark.db --employees 100 --output results.json
+"""
+import argparse
+import datetime
+import json
+import platform
+import sys
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional
+
+import requests
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+from project import cache
+from project.auth import user_cache
+from project.data import models as m
+from project.data.database import Base, async_database_url
+from project.dependencies import get_db, get_async_db
+from project.main import app
+from project.populate_db import generate_bulk
+from .stats import summarize
+
+
+@contextmanager
+def app_database(database_url: str) -> Iterator[sessionmaker]:
+    """
+    Route sessions of the app to benchmarked database, restoring previous dependency overrides afterwards.
+    In-process caches are cleared on both ends, as ids of users and seasons repeat across databases
+    """
+    connect_args = {"check_same_thread": False} if make_url(database_url).get_backend_name() == "sqlite" else {}
+    engine = create_engine(database_url, connect_args=connect_args)
+    Base.metadata.create_all(bind=engine)
+    session_local = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    async_session_local = sessionmaker(create_async_engine(async_database_url(database_url)), class_=AsyncSession,
+                                       autoflush=False, expire_on_commit=False)
+
+    def override_get_db():
+        db = session_local()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    async def override_get_async_db():
+        async with async_session_local() as db:
+            yield db
+
+    previous = dict(app.dependency_overrides)
+    app.dependency_overrides.update({get_db: override_get_db, get_async_db: override_get_async_db})
+    cache.summary_cache.clear()
+    user_cache.clear()
+    try:
+        yield session_local
+    finally:
+        app.dependency_overrides.clear()
+        app.dependency_overrides.update(previous)
+        cache.summary_cache.clear()
+        user_cache.clear()
+        engine.dispose()
+
+
+def load_dataset(db: Session, seed: int, password: str, **scale) -> Dict[str, int]:
+    """Generate dataset unless one generated with the same seed is already in the database"""
+    user = db.query(m.User).filter(m.User.username == f"populator_{seed}_1").first()
+    if user is not None and db.query(m.Season).filter(m.Season.owner_id == user.id).count():
+        return {"reused": 1, "seasons": db.query(m.Season).count(), "workdays": db.query(m.Workday).count()}
+    return generate_bulk(db, seed=seed, password=password, **scale)
+
+
+def run_case(request: Callable[[int], requests.Response], repeat: int, warmup: int, cold: bool) -> dict:
+    durations, queries, statuses = [], [], []
+    for i in range(warmup + repeat):
+        if cold:
+            cache.summary_cache.clear()
+        start = time.perf_counter()
+        response = request(i)
+        if i < warmup:
+            continue
+        durations.append(time.perf_counter() - start)
+        statuses.append(response.status_code)
+        if "X-DB-Queries" in response.headers:
+            queries.append(int(response.headers["X-DB-Queries"]))
+    return summarize(durations, queries, statuses)
+
+
+def run_benchmarks(database_url: str, seed: int = 0, users: int = 1, seasons: int = 1, employees: int = 50,
+                   harvests: int = 60, expenses: int = 30, repeat: int = 20, warmup: int = 2,
+                   login_repeat: int = 5, cold: bool = False, only: Optional[List[str]] = None) -> dict:
+    """
+    Load dataset and time key routes, as the first generated user
+
+    :param database_url: url of benchmarked database, sqlite file or postgres
+    :param seed: seed of generated dataset
+    :param users: number of users in generated dataset
+    :param seasons: seasons per user
+    :param employees: employees per season
+    :param harvests: harvests per season
+    :param expenses: expenses per season
+    :param repeat: timed requests per route
+    :param warmup: untimed requests per route sent first
+    :param login_repeat: timed logins, bcrypt makes them much slower than other routes
+    :param cold: clear summary cache before every request
+    :param only: names of benchmarked routes, all if not given
+    :return: benchmark results, JSON serializable
+    """
+    password = "benchmark"
+    with app_database(database_url) as session_local:
+        db = session_local()
+        started = time.perf_counter()
+        dataset = load_dataset(db, seed, password, users=users, seasons=seasons, employees=employees,
+                               harvests=harvests, expenses=expenses)
+        load_seconds = time.perf_counter() - started
+        username = f"populator_{seed}_1"
+        user = db.query(m.User).filter(m.User.username == username).one()
+        season = db.query(m.Season).filter(m.Season.owner_id == user.id).order_by(m.Season.year).first()
+        employee = db.query(m.Employee).filter(m.Employee.season_id == season.id).order_by(m.Employee.id).first()
+        db.close()
+
+        client = TestClient(app)
+        login = {"username": username, "password": password}
+        token = client.post("/token", data=login).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        year = season.year
+        next_workdays_page = ["/workdays/?limit=100"]
+
+        def workdays_page(_: int) -> requests.Response:
+            response = client.get(next_workdays_page[0], headers=headers)
+            next_workdays_page[0] = response.links.get("next", {}).get("url", "/workdays/?limit=100")
+            return response
+
+        cases = {
+            "login": (lambda _: client.post("/token", data=login), login_repeat),
+            "season_summary": (lambda _: client.get(f"/seasons/{year}/summary", headers=headers), repeat),
+            "harvests_extended": (lambda _: client.get(f"/seasons/{year}/harvests?extended=true&limit=100",
+                                                       headers=headers), repeat),
+            "employee_summary": (lambda _: client.get(f"/emlpoyees/{employee.id}/summary", headers=headers),
+                                 repeat),
+            "harvests_csv": (lambda _: client.get(f"/seasons/{year}/harvests?data_format=csv&limit=100000",
+                                                  headers=headers), repeat),
+            "expenses_csv": (lambda _: client.get(f"/seasons/{year}/expenses?data_format=csv&limit=100000",
+                                                  headers=headers), repeat),
+            "workdays_page": (workdays_page, repeat),
+        }
+        results = {name: run_case(request, case_repeat, warmup, cold)
+                   for name, (request, case_repeat) in cases.items() if only is None or name in only}
+
+    return {
+        "meta": {
+            "timestamp": datetime.datetime.utcnow().isoformat(timespec="seconds") + "Z",
+            "database": make_url(database_url).get_backend_name(),
+            "python": platform.python_version(),
+            "seed": seed,
+            "scale": {"users": users, "seasons": seasons, "employees": employees,
+                      "harvests": harvests, "expenses": expenses},
+            "dataset": dataset,
+            "load_seconds": round(load_seconds, 3),
+            "repeat": repeat,
+            "warmup": warmup,
+            "cold_cache": cold,
+        },
+        "routes": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark key routes on generated dataset")
+    parser.add_argument("--database-url", default="sqlite:///./benchmark.db",
+                        help="sqlite file or postgres database, dataset is generated on first run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--users", type=int, default=1)
+    parser.add_argument("--seasons", type=int, default=1, help="seasons per user")
+    parser.add_argument("--employees", type=int, default=50, help="employees per season")
+    parser.add_argument("--harvests", type=int, default=60, help="harvests per season")
+    parser.add_argument("--expenses", type=int, default=30, help="expenses per season")
+    parser.add_argument("--repeat", type=int, default=20, help="timed requests per route")
+    parser.add_argument("--warmup", type=int, default=2, help="untimed requests per route sent first")
+    parser.add_argument("--login-repeat", type=int, default=5)
+    parser.add_argument("--cold", action="store_true", help="clear summary cache before every request")
+    parser.add_argument("--only", action="append", help="benchmarked route, can be repeated")
+    parser.add_argument("--output", help="file for JSON results, printed if not given")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.database_url, seed=args.seed, users=args.users, seasons=args.seasons,
+                             employees=args.employees, harvests=args.harvests, expenses=args.expenses,
+                             repeat=args.repeat, warmup=args.warmup, login_repeat=args.login_repeat,
+                             cold=args.cold, only=args.only)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
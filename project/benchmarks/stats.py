@@ -0,0 +1,34 @@
+import math
+import statistics
+from typing import List
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Nearest-rank percentile of values"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def summarize(durations: List[float], queries: List[int], statuses: List[int]) -> dict:
+    """
+    Summarize timed requests
+
+    :param durations: durations of requests in seconds
+    :param queries: database statements of requests, from X-DB-Queries header
+    :param statuses: response statuses
+    :return: number of requests, latency percentiles, mean, min and max in milliseconds,
+        median and max database statements and distinct statuses
+    """
+    result = {"n": len(durations)}
+    if not durations:
+        return result
+    result.update({f"p{p}_ms": round(percentile(durations, p) * 1000, 3) for p in PERCENTILES})
+    result.update(mean_ms=round(statistics.mean(durations) * 1000, 3),
+                  min_ms=round(min(durations) * 1000, 3),
+                  max_ms=round(max(durations) * 1000, 3),
+                  db_queries_median=statistics.median(queries) if queries else None,
+                  db_queries_max=max(queries) if queries else None,
+                  statuses=sorted(set(statuses)))
+    return result
@@ -0,0 +1,201 @@
+import hashlib
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from itertools import chain
+from typing import Any, Callable, Hashable, Iterable, Optional, Tuple
+
+from fastapi import Request, Response
+from sqlalchemy import event, func, inspect
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.util import identity_key
+
+from .data import models as m
+from .data.database import upsert_increment
+
+ALL_SEASONS = 0
+
+
+class SummaryCache:
+    """
+    LRU cache of summary payloads bounded by approximate memory used by cached payloads.
+    Can be replaced with any object providing get() and set() to keep payloads in another local store
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        size = len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.used_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.used_bytes += size
+            while self.used_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.used_bytes -= evicted_size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.used_bytes = 0
+
+
+class TTLCache:
+    """LRU cache of at most max_entries values, each valid until its own expiry time (time.monotonic based)"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key: Hashable, value: Any, expires_at: float) -> None:
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard_where(self, predicate: Callable[[Any], bool]) -> None:
+        """Remove entries whose values match predicate"""
+        with self._lock:
+            for key in [key for key, (value, _) in self._entries.items() if predicate(value)]:
+                del self._entries[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+summary_cache = SummaryCache(max_bytes=int(os.environ.get("SUMMARY_CACHE_MAX_BYTES", 32 * 1024 * 1024)))
+
+
+class NotModified(Exception):
+    """Raised when the representation identified by request's If-None-Match header is still current"""
+
+    def __init__(self, etag: str, vary: Optional[str] = None):
+        self.etag = etag
+        self.vary = vary
+
+
+def check_etag(request: Request, response: Response, *key: Hashable, representation: Hashable = None,
+               vary: Optional[str] = None) -> str:
+    """
+    Compute strong ETag of a response from request's path and query and given key, set it on the response
+    and raise NotModified when the client already has it, before the response is computed.
+    Key has to contain the owner and version of data the response is built from, and representation
+    has to tell apart different responses to the same url, for example chosen by Accept header
+
+    :param request: current request
+    :param response: response the ETag header is set on
+    :param key: values identifying the data of the response
+    :param representation: values identifying the format of the response, if url alone doesn't
+    :param vary: request headers the representation depends on, set as Vary header
+    :return: the ETag, to be set on responses returned directly by the route
+    """
+    identity = repr((request.url.path, sorted(request.query_params.multi_items()), key, representation))
+    etag = f'"{hashlib.sha1(identity.encode()).hexdigest()}"'
+    response.headers['ETag'] = etag
+    if vary:
+        response.headers['Vary'] = vary
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match:
+        client_etags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+        if '*' in client_etags or etag in client_etags:
+            raise NotModified(etag, vary)
+    return etag
+
+
+def _harvest_season_id(session: Session, harvest_id: int) -> Optional[int]:
+    harvest = session.identity_map.get(identity_key(m.Harvest, harvest_id))
+    if harvest is not None:
+        return harvest.season_id
+    return session.query(m.Harvest.season_id).autoflush(False).filter(m.Harvest.id == harvest_id).scalar()
+
+
+def _touched_seasons(session: Session, obj) -> list:
+    if isinstance(obj, m.Season):
+        return [(obj.owner_id, obj.id)]
+    if isinstance(obj, (m.Harvest, m.Expense)):
+        return [(obj.owner_id, obj.season_id)]
+    if isinstance(obj, m.Employee):
+        return [(obj.employer_id, obj.season_id)]
+    if isinstance(obj, m.Workday):
+        history = inspect(obj).attrs.harvest_id.history
+        return [(obj.employer_id, _harvest_season_id(session, h_id)) for h_id in chain(*history) if h_id is not None]
+    return []
+
+
+def data_version(db: Session, owner_id: int, season_id: int = ALL_SEASONS) -> int:
+    """
+    Get current version of data of a season or of all seasons of given owner.
+    Version of all seasons is the sum of versions of the owner's seasons, so it grows with every write
+    without all writes of the owner updating one shared row
+
+    :param db: database session
+    :param owner_id: id of the seasons' owner
+    :param season_id: id of the season, versions of all owner's seasons if not given
+    :return: version number, 0 if data was never written
+    """
+    if season_id == ALL_SEASONS:
+        version = db.query(func.sum(m.DataVersion.version)).filter(m.DataVersion.owner_id == owner_id).scalar()
+    else:
+        version = db.query(m.DataVersion.version)\
+            .filter(m.DataVersion.owner_id == owner_id, m.DataVersion.season_id == season_id).scalar()
+    return int(version or 0)
+
+
+def bump_data_versions(db: Session, touched: Iterable[Tuple[int, int]]) -> None:
+    """
+    Raise versions of given (owner_id, season_id) pairs in the current transaction, with upserts.
+    Called automatically on flush, has to be called explicitly after bulk writes that bypass the ORM
+
+    :param db: database session of the write
+    :param touched: pairs of owner id and season id changed by the write
+    :return: None
+    """
+    keys = {(owner_id, season_id) for owner_id, season_id in touched
+            if owner_id is not None and season_id is not None}
+    for owner_id, season_id in sorted(keys):
+        upsert_increment(db, m.DataVersion.__table__, {'owner_id': owner_id, 'season_id': season_id}, {'version': 1})
+
+
+def bump_all_data_versions(db: Session) -> None:
+    """Raise every stored version, used after bulk writes affecting many owners. Doesn't commit"""
+    table = m.DataVersion.__table__
+    db.execute(table.update().values(version=table.c.version + 1))
+
+
+@event.listens_for(Session, "after_flush")
+def _bump_touched_seasons(session: Session, flush_context) -> None:
+    touched = set()
+    for obj in chain(session.new, session.dirty, session.deleted):
+        touched.update(_touched_seasons(session, obj))
+    bump_data_versions(session, touched)
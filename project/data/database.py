@@ -1,14 +1,139 @@
 import os
+import time
+from collections import Counter
+from contextvars import ContextVar
+from typing import Optional, Tuple
 
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
+from sqlalchemy import Table, create_engine, event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
 
 load_dotenv()
 # MAIN DB
 SQLALCHEMY_DATABASE_URL = os.environ.get("SQLALCHEMY_DATABASE_URL")
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+# sync routes, their session dependency and streamed exports reading an open cursor
+# may run in different threadpool threads
+engine = create_engine(SQLALCHEMY_DATABASE_URL,
+                       connect_args={"check_same_thread": False}
+                       if make_url(SQLALCHEMY_DATABASE_URL).get_backend_name() == "sqlite" else {})
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
+
+UPSERT_INSERTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+
+def upsert_increment(db: Session, table: Table, key: dict, increments: dict) -> None:
+    """
+    Insert a row with given key and values, or add the values to columns of the existing row with that key,
+    in a single INSERT ... ON CONFLICT DO UPDATE statement, so concurrent first writes don't fail on the key
+
+    :param db: database session
+    :param table: table with primary key made of key columns
+    :param key: values of primary key columns
+    :param increments: values of inserted row, added to columns of existing row
+    :return: None
+    """
+    dialect = db.get_bind().dialect.name
+    if dialect not in UPSERT_INSERTS:
+        raise ValueError(f"Upserts are supported only in {', '.join(UPSERT_INSERTS)} databases, not {dialect}")
+    statement = UPSERT_INSERTS[dialect](table).values(**key, **increments)
+    db.execute(statement.on_conflict_do_update(
+        index_elements=list(key),
+        set_={col: table.c[col] + statement.excluded[col] for col in increments}))
+
+
+# ASYNC DB, same database through asyncio drivers
+ASYNC_DRIVERS = {'sqlite': 'sqlite+aiosqlite', 'postgresql': 'postgresql+asyncpg'}
+
+
+def async_database_url(url: str) -> str:
+    """
+    Get url of the same database using its asyncio driver (aiosqlite or asyncpg)
+
+    :param url: database url using sync driver
+    :return: database url using asyncio driver
+    """
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No asyncio driver configured for {backend} databases")
+    return str(url.set(drivername=ASYNC_DRIVERS[backend]))
+
+
+_async_sessionmaker = None
+
+
+def get_async_sessionmaker() -> sessionmaker:
+    """
+    Get factory of async sessions, creating the async engine on first use so that
+    asyncio drivers are needed only when async routes are used
+    """
+    global _async_sessionmaker
+    if _async_sessionmaker is None:
+        url = os.environ.get("SQLALCHEMY_ASYNC_DATABASE_URL") or async_database_url(SQLALCHEMY_DATABASE_URL)
+        _async_sessionmaker = sessionmaker(create_async_engine(url), class_=AsyncSession,
+                                           autoflush=False, expire_on_commit=False)
+    return _async_sessionmaker
+
+
+# QUERY STATS, statements executed while handling a request
+# max number of statements per request, 0 means no limit; exceeding it is logged, or raises in strict mode
+QUERY_BUDGET = int(os.environ.get("DB_QUERY_BUDGET", 0))
+QUERY_BUDGET_STRICT = os.environ.get("DB_QUERY_BUDGET_STRICT", "").lower() in ("1", "true", "yes")
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryStats:
+    """Number, total time and repetitions of statements executed while handling a single request"""
+
+    def __init__(self, budget: int = 0, strict: bool = False):
+        self.budget = budget
+        self.strict = strict
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = Counter()
+
+    @property
+    def over_budget(self) -> bool:
+        return bool(self.budget) and self.count > self.budget
+
+    def most_repeated(self) -> Optional[Tuple[str, int]]:
+        """Get the statement executed most times, usually a lazy load run for every row (N+1 queries)"""
+        repeated = self.statements.most_common(1)
+        return repeated[0] if repeated else None
+
+
+# stats of the handled request, set by middleware.QueryStatsMiddleware; sync routes and dependencies
+# run in threadpool with a copy of the request's context, so they update the same stats
+query_stats: ContextVar[Optional[QueryStats]] = ContextVar("query_stats", default=None)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    stats = query_stats.get()
+    if stats is None:
+        return
+    stats.count += 1
+    stats.statements[statement] += 1
+    if stats.strict and stats.over_budget:
+        repeated, times = stats.most_repeated()
+        raise QueryBudgetExceeded(f"Request executed more than {stats.budget} statements, "
+                                  f"most repeated ({times} times): {repeated}")
+    if context is not None:
+        context._query_start = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _time_query(conn, cursor, statement, parameters, context, executemany):
+    stats = query_stats.get()
+    start = getattr(context, "_query_start", None)
+    if stats is not None and start is not None:
+        stats.seconds += time.perf_counter() - start
@@ -0,0 +1,57 @@
+import argparse
+from typing import List
+
+from sqlalchemy import inspect
+from sqlalchemy.engine import Engine
+
+from .database import Base
+from . import models  # noqa: F401 - registers tables in Base.metadata
+
+
+def missing_indexes(engine: Engine) -> list:
+    """
+    Find indexes declared on models which don't exist in the database yet.
+    Tables which don't exist are skipped, create_all creates them together with their indexes
+
+    :param engine: engine of checked database
+    :return: list of missing Index objects
+    """
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        missing.extend(index for index in sorted(table.indexes, key=lambda i: i.name)
+                       if index.name not in existing)
+    return missing
+
+
+def ensure_indexes(engine: Engine) -> List[str]:
+    """
+    Create indexes declared on models that are missing in an existing database,
+    as create_all doesn't add indexes to tables which already exist
+
+    :param engine: engine of upgraded database
+    :return: names of created indexes
+    """
+    created = []
+    for index in missing_indexes(engine):
+        index.create(bind=engine, checkfirst=True)
+        created.append(index.name)
+    return created
+
+
+if __name__ == "__main__":
+    from .database import engine
+
+    parser = argparse.ArgumentParser(description="Create indexes missing in an existing database")
+    parser.add_argument("--dry-run", action="store_true", help="only list missing indexes")
+    args = parser.parse_args()
+    if args.dry_run:
+        names = [index.name for index in missing_indexes(engine)]
+        print("\n".join(names) if names else "No missing indexes")
+    else:
+        names = ensure_indexes(engine)
+        print(f"Created {len(names)} indexes" + (": " + ", ".join(names) if names else ""))
@@ -1,7 +1,7 @@
 from enum import Enum
 
 from sqlalchemy import Column, Integer, ForeignKey, String,\
-    Boolean, DATE, DECIMAL, Table, UniqueConstraint
+    Boolean, DATE, DECIMAL, Table, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 
 from .database import Base
@@ -13,7 +13,8 @@ harvests_employees_asoc_tab = Table('association', Base.metadata,
                                            primary_key=True),
                                     Column('employee_id',
                                            ForeignKey('employees.id'),
-                                           primary_key=True))
+                                           primary_key=True),
+                                    Index('ix_association_employee_id', 'employee_id'))
 
 
 class Fruit(str, Enum):
@@ -40,6 +41,9 @@ class User(Base):
 
 class Season(Base):
     __tablename__ = "seasons"
+    __table_args__ = (
+        Index('ix_seasons_owner_id_year', 'owner_id', 'year'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     year = Column(Integer, nullable=False)
@@ -54,6 +58,7 @@ class Season(Base):
     harvests = relationship("Harvest", back_populates="season", cascade="all, delete")
     employees = relationship("Employee", back_populates="season", cascade="all, delete")
     expenses = relationship("Expense", back_populates="season", cascade="all, delete")
+    rollups = relationship("SeasonRollup", back_populates="season", cascade="all, delete")
 
     @property
     def fruits(self):
@@ -106,6 +111,10 @@ class Season(Base):
 
 class Harvest(Base):
     __tablename__ = "harvests"
+    __table_args__ = (
+        Index('ix_harvests_owner_id_season_id_date', 'owner_id', 'season_id', 'date'),
+        Index('ix_harvests_season_id_fruit', 'season_id', 'fruit'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     fruit = Column(String, nullable=False)
@@ -172,6 +181,9 @@ class Harvest(Base):
 
 class Expense(Base):
     __tablename__ = "expenses"
+    __table_args__ = (
+        Index('ix_expenses_owner_id_season_id_date', 'owner_id', 'season_id', 'date'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     type = Column(String, nullable=False)
@@ -185,6 +197,10 @@ class Expense(Base):
 
 class Employee(Base):
     __tablename__ = "employees"
+    __table_args__ = (
+        Index('ix_employees_employer_id_season_id', 'employer_id', 'season_id'),
+        Index('ix_employees_season_id', 'season_id'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     employer_id = Column(Integer, ForeignKey("users.id"))
@@ -244,6 +260,11 @@ class Employee(Base):
 
 class Workday(Base):
     __tablename__ = "workdays"
+    __table_args__ = (
+        Index('ix_workdays_employee_id', 'employee_id'),
+        Index('ix_workdays_harvest_id', 'harvest_id'),
+        Index('ix_workdays_employer_id_fruit', 'employer_id', 'fruit'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     employee_id = Column(Integer, ForeignKey("employees.id"))
@@ -255,3 +276,34 @@ class Workday(Base):
 
     employee = relationship("Employee", back_populates="workdays")
     harvest = relationship("Harvest", back_populates="workdays")
+
+
+class SeasonRollup(Base):
+    """
+    Running totals for a season and fruit, kept up to date by crud writes.
+    Expenses aren't related to fruits, so they are stored in a row with an empty fruit
+    """
+    __tablename__ = "season_rollups"
+
+    season_id = Column(Integer, ForeignKey("seasons.id"), primary_key=True)
+    fruit = Column(String(30), primary_key=True)
+    harvests_n = Column(Integer, nullable=False, default=0)
+    harvested = Column(DECIMAL(12, 1), nullable=False, default=0)
+    harvested_value = Column(DECIMAL(14, 2), nullable=False, default=0)
+    employee_payout = Column(DECIMAL(14, 2), nullable=False, default=0)
+    workdays_n = Column(Integer, nullable=False, default=0)
+    expenses = Column(DECIMAL(14, 1), nullable=False, default=0)
+
+    season = relationship("Season", back_populates="rollups")
+
+
+class DataVersion(Base):
+    """
+    Version of data of a season, raised in the transaction of every write touching it.
+    Version of all seasons of an owner is the sum of versions of their seasons
+    """
+    __tablename__ = "data_versions"
+
+    owner_id = Column(Integer, primary_key=True)
+    season_id = Column(Integer, primary_key=True, default=0)
+    version = Column(Integer, nullable=False, default=0)
@@ -242,6 +242,19 @@ class WorkdayUpdate(WorkdayCreate):
         }
 
 
+class WorkdayBulkItem(WorkdayCreate):
+    employee_id: int
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "employee_id": 1,
+                "harvested": decimal.Decimal(55.5),
+                "pay_per_kg": decimal.Decimal(5.5)
+            }
+        }
+
+
 class WorkdayResponse(WorkdayCreate):
     id: int
     employer_id: int
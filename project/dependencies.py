@@ -3,7 +3,7 @@ from typing import Optional
 
 from fastapi import Query
 
-from .data.database import SessionLocal
+from .data.database import SessionLocal, get_async_sessionmaker
 
 
 def get_db():
@@ -14,8 +14,14 @@ def get_db():
         db.close()
 
 
-async def limit_offset(offset: int = 0, limit: int = 10):
-    return {"offset": offset, "limit": limit}
+async def get_async_db():
+    async with get_async_sessionmaker()() as db:
+        yield db
+
+
+async def limit_offset(offset: int = 0, limit: int = 10,
+                       cursor: Optional[str] = Query(None, max_length=500)):
+    return {"offset": offset, "limit": limit, "cursor": cursor}
 
 
 async def after_before(
@@ -1,23 +1,32 @@
+import hashlib
+import json
 import os
 import secrets
 from datetime import timedelta
+from functools import lru_cache
+from typing import Tuple
 
-from fastapi import Depends, FastAPI, HTTPException, status, Request
+from fastapi import Depends, FastAPI, HTTPException, status, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.openapi.docs import get_swagger_ui_html
-from fastapi.openapi.utils import get_openapi
 from fastapi.security import HTTPBasic, HTTPBasicCredentials, OAuth2PasswordRequestForm
 from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.exception_handlers import http_exception_handler
+from fastapi.responses import HTMLResponse, PlainTextResponse
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from sqlalchemy.orm import Session
 
 from .dependencies import get_db
 from .data import schemas as sc
 from .data.models import Base, User
-from .auth import authenticate_user, token_exception, create_access_token, get_password_hash
+from .auth import authenticate_user_async, token_exception, create_access_token, get_password_hash_async,\
+    user_get_by_username_released, check_if_user_admin, UserIdentity
 from .data.database import engine
 from .routers import seasons, harvests, employees, expenses, workdays, admin
 from .additional import ApiLogger
+from .middleware import MetricsMiddleware, ProfilerMiddleware, QueryStatsMiddleware, RequestLogMiddleware
+from .metrics import http_metrics
+from .cache import NotModified, check_etag
 
 # TODO add docstrings to dependencies and additional functions
 # TODO finish readme
@@ -33,6 +42,10 @@ app.include_router(workdays.router)
 app.include_router(admin.router)
 
 app.add_middleware(GZipMiddleware, minimum_size=500)
+app.add_middleware(ProfilerMiddleware)
+app.add_middleware(QueryStatsMiddleware)
+app.add_middleware(RequestLogMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 
 security = HTTPBasic()
@@ -52,33 +65,70 @@ def get_current_active_username(credentials: HTTPBasicCredentials = Depends(secu
 
 @app.exception_handler(StarletteHTTPException)
 async def custom_http_exception_handler(request: Request, exc: StarletteHTTPException):
-    ApiLogger.create_module_log(module=request, msg=exc.detail, log_type='exc')
+    ApiLogger.create_module_log(module=request, msg=exc.detail, log_type='exc', status=exc.status_code)
     return await http_exception_handler(request, exc)
 
 
+@app.exception_handler(NotModified)
+async def not_modified_handler(request: Request, exc: NotModified):
+    headers = {"ETag": exc.etag}
+    if exc.vary:
+        headers["Vary"] = exc.vary
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+
+@lru_cache(maxsize=None)
+def documentation_html() -> bytes:
+    return get_swagger_ui_html(openapi_url="/openapi.json", title="Swagger").body
+
+
+@lru_cache(maxsize=None)
+def openapi_json() -> Tuple[bytes, str]:
+    """Generate OpenAPI schema on first call and keep it serialized, together with its digest used as ETag"""
+    body = json.dumps(app.openapi(), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return body, hashlib.sha1(body).hexdigest()
+
+
 @app.get("/docs", include_in_schema=False)
 async def get_documentation(username: str = Depends(get_current_active_username)):
-    return get_swagger_ui_html(openapi_url="/openapi.json", title="Swagger")
+    return HTMLResponse(documentation_html())
 
 
 @app.get("/openapi.json", include_in_schema=False)
-async def openapi(username: str = Depends(get_current_active_username)):
-    return get_openapi(title=app.title, version=app.version, routes=app.routes)
+async def openapi(request: Request, response: Response,
+                  username: str = Depends(get_current_active_username)):
+    body, digest = await run_in_threadpool(openapi_json)
+    etag = check_etag(request, response, digest)
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics(user: UserIdentity = Depends(check_if_user_admin)):
+    # async, so metrics are read on the event loop thread which updates them
+    return PlainTextResponse(http_metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+def save_new_user(db: Session, user_m: User) -> None:
+    # session is closed in the same threadpool call, see auth.user_get_by_username_released
+    try:
+        db.add(user_m)
+        db.commit()
+        db.refresh(user_m)
+    finally:
+        db.close()
 
 
 @app.post("/user", status_code=status.HTTP_201_CREATED)
 async def create_new_user(user: sc.UserCreate, db: Session = Depends(get_db),
                           username: str = Depends(get_current_active_username)):
-    user_m = db.query(User).filter(User.username == user.username).first()
+    user_m = await run_in_threadpool(user_get_by_username_released, db, user.username)
     if user_m:
         raise HTTPException(status_code=400, detail="User already exists")
     else:
-        hashed_password = get_password_hash(user.password)
+        hashed_password = await get_password_hash_async(user.password)
         user_m = User(username=user.username,
                       hashed_password=hashed_password)
-        db.add(user_m)
-        db.commit()
-        db.refresh(user_m)
+        await run_in_threadpool(save_new_user, db, user_m)
     return user_m
 
 
@@ -86,7 +136,7 @@ async def create_new_user(user: sc.UserCreate, db: Session = Depends(get_db),
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(),
                                  db: Session = Depends(get_db)):
 
-    user = authenticate_user(form_data.username, form_data.password, db)
+    user = await authenticate_user_async(form_data.username, form_data.password, db)
     if not user:
         raise token_exception()
     token_expires = timedelta()
@@ -0,0 +1,119 @@
+from bisect import bisect_left
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from .data.database import QueryStats
+
+# upper bounds of latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# upper bounds of response size histogram buckets, in bytes
+SIZE_BUCKETS = (100, 1000, 10_000, 100_000, 1_000_000, 10_000_000)
+# upper bounds of histogram buckets of database statements executed per request
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+UNMATCHED_ROUTE = "<unmatched>"
+
+
+class Histogram:
+    """Counts of observed values in buckets, kept non-cumulative and summed up when rendered"""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            result.append((_format_value(bound), total))
+        result.append(("+Inf", total + self.counts[-1]))
+        return result
+
+
+class HTTPMetrics:
+    """
+    Request counts, histograms of latency, response size, database statements and database time per route,
+    and the number of requests in progress.
+    Updated only by MetricsMiddleware and read only by the async /metrics endpoint, both running
+    on the event loop thread, so plain counters are used without locks.
+    Routes are labeled by their path template, not by the requested path, to keep the number of series bounded
+    """
+
+    def __init__(self):
+        self.requests: Dict[Tuple[str, str, int], int] = {}
+        self.latency: Dict[Tuple[str, str], Histogram] = {}
+        self.response_size: Dict[Tuple[str, str], Histogram] = {}
+        self.db_queries: Dict[Tuple[str, str], Histogram] = {}
+        self.db_time: Dict[Tuple[str, str], Histogram] = {}
+        self.in_progress = 0
+
+    def observe(self, method: str, route: str, status: int, seconds: float, size: int,
+                query_stats: Optional[QueryStats] = None) -> None:
+        key = (method, route, status)
+        self.requests[key] = self.requests.get(key, 0) + 1
+        route_key = (method, route)
+        latency = self.latency.get(route_key)
+        if latency is None:
+            latency = self.latency[route_key] = Histogram(LATENCY_BUCKETS)
+            self.response_size[route_key] = Histogram(SIZE_BUCKETS)
+            self.db_queries[route_key] = Histogram(QUERY_COUNT_BUCKETS)
+            self.db_time[route_key] = Histogram(LATENCY_BUCKETS)
+        latency.observe(seconds)
+        self.response_size[route_key].observe(size)
+        if query_stats is not None:
+            self.db_queries[route_key].observe(query_stats.count)
+            self.db_time[route_key].observe(query_stats.seconds)
+
+    def render(self) -> str:
+        """
+        Render metrics in Prometheus text exposition format
+
+        :return: text of all metrics
+        """
+        lines = ["# HELP http_requests_total Number of finished HTTP requests",
+                 "# TYPE http_requests_total counter"]
+        for (method, route, status), count in sorted(self.requests.items()):
+            lines.append(f'http_requests_total{{{_labels(method, route)},status="{status}"}} {count}')
+        lines += ["# HELP http_requests_in_progress Number of HTTP requests being handled",
+                  "# TYPE http_requests_in_progress gauge",
+                  f"http_requests_in_progress {self.in_progress}"]
+        lines += _render_histograms("http_request_duration_seconds", "Latency of HTTP requests",
+                                    self.latency)
+        lines += _render_histograms("http_response_size_bytes", "Size of HTTP response bodies",
+                                    self.response_size)
+        lines += _render_histograms("http_request_db_queries", "Database statements executed per HTTP request",
+                                    self.db_queries)
+        lines += _render_histograms("http_request_db_seconds", "Database time of HTTP requests",
+                                    self.db_time)
+        return "\n".join(lines) + "\n"
+
+
+def _render_histograms(name: str, description: str, histograms: Dict[Tuple[str, str], Histogram]) -> List[str]:
+    lines = [f"# HELP {name} {description}", f"# TYPE {name} histogram"]
+    for (method, route), histogram in sorted(histograms.items()):
+        labels = _labels(method, route)
+        for bound, count in histogram.cumulative():
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+        lines.append(f"{name}_sum{{{labels}}} {_format_value(histogram.sum)}")
+        lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+    return lines
+
+
+def _labels(method: str, route: str) -> str:
+    route = route.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'method="{method}",route="{route}"'
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value))
+
+
+http_metrics = HTTPMetrics()
@@ -0,0 +1,192 @@
+import time
+
+from fastapi import HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.security.utils import get_authorization_scheme_param
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from . import profiler
+from .additional import ApiLogger, request_log_fields
+from .auth import check_if_user_admin, get_current_user_identity
+from .data import database
+from .data.database import QueryStats, query_stats
+from .dependencies import get_db
+from .metrics import UNMATCHED_ROUTE, http_metrics
+
+
+class RequestLogMiddleware:
+    """
+    Logs every http request as structured event into logs/access.jsonl, with its route, status,
+    latency and user id, when ApiLogger uses json log format.
+    Plain ASGI middleware, so responses pass through it without being wrapped or buffered
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not ApiLogger.json_mode():
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            event = {"event": "request", **request_log_fields(scope), "status": status_code,
+                     "latency_ms": round((time.perf_counter() - start) * 1000, 3)}
+            stats = scope.get("state", {}).get("query_stats")
+            if stats is not None:
+                event.update(db_queries=stats.count, db_time_ms=round(stats.seconds * 1000, 3))
+            ApiLogger.log_event("access", event)
+
+
+class MetricsMiddleware:
+    """Records count, latency and response size of http requests per route in metrics.http_metrics"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status_code = 500
+        size = 0
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code, size
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        http_metrics.in_progress += 1
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_metrics.in_progress -= 1
+            http_metrics.observe(scope["method"], getattr(scope.get("route"), "path", UNMATCHED_ROUTE),
+                                 status_code, time.perf_counter() - start, size,
+                                 scope.get("state", {}).get("query_stats"))
+
+
+class QueryStatsMiddleware:
+    """
+    Counts statements executed while handling http requests and their total time (see database.QueryStats),
+    adding them to responses as X-DB-Queries and X-DB-Time (milliseconds) headers.
+    Requests executing more statements than database.QUERY_BUDGET are logged with the most repeated statement,
+    in strict mode (database.QUERY_BUDGET_STRICT) the statement over budget raises QueryBudgetExceeded.
+    Statements executed after response headers are sent, ex. by streaming responses,
+    are counted only in logs and metrics
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = QueryStats(budget=database.QUERY_BUDGET, strict=database.QUERY_BUDGET_STRICT)
+        scope.setdefault("state", {})["query_stats"] = stats
+
+        async def send_wrapper(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []),
+                                      (b"x-db-queries", str(stats.count).encode()),
+                                      (b"x-db-time", f"{stats.seconds * 1000:.3f}".encode())]
+            await send(message)
+
+        token = query_stats.set(stats)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            query_stats.reset(token)
+            if stats.over_budget and not stats.strict:
+                repeated, times = stats.most_repeated()
+                route = getattr(scope.get("route"), "path", scope["path"])
+                ApiLogger.create_module_log("db", f"{scope['method']} {route} executed {stats.count} statements, "
+                                                  f"over budget of {stats.budget}; most repeated "
+                                                  f"({times} times): {repeated}",
+                                            log_type="budget", route=route, db_queries=stats.count)
+
+
+class ProfilerMiddleware:
+    """
+    Profiles requests of admin users sent with ?profile=1 query parameter or X-Profile: 1 header,
+    using profiler.SamplingProfiler. Collapsed stacks and executed statements are saved as profile
+    with id returned in X-Profile-Id header, available from /admin/profiles/ endpoints.
+    Requests of other users, and requests sent while another one is profiled, are handled normally
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request = Request(scope)
+        if "1" not in (request.query_params.get("profile"), request.headers.get("x-profile")) \
+                or not await self._is_admin(request) or not profiler.profile_lock.acquire(blocking=False):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = profiler.new_profile_id(scope["method"], scope["path"])
+        status_code = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message["headers"] = [*message.get("headers", []), (b"x-profile-id", profile_id.encode())]
+            await send(message)
+
+        sampler = profiler.SamplingProfiler()
+        start = time.perf_counter()
+        sampler.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            sampler.stop()
+            info = {"method": scope["method"], "path": scope["path"], "query": scope["query_string"].decode(),
+                    "route": getattr(scope.get("route"), "path", None), "status": status_code,
+                    "duration_ms": round((time.perf_counter() - start) * 1000, 3)}
+            try:
+                await run_in_threadpool(profiler.save_profile, profile_id, sampler, info,
+                                        scope.get("state", {}).get("query_stats"))
+            finally:
+                profiler.profile_lock.release()
+
+    @staticmethod
+    async def _is_admin(request: Request) -> bool:
+        scheme, token = get_authorization_scheme_param(request.headers.get("authorization"))
+        if scheme.lower() != "bearer" or not token:
+            return False
+        # same database session as routes get, including overrides
+        session_dependency = request.app.dependency_overrides.get(get_db, get_db)
+
+        def check() -> bool:
+            sessions = session_dependency()
+            try:
+                check_if_user_admin(get_current_user_identity(request, next(sessions), token))
+                return True
+            except HTTPException:
+                return False
+            finally:
+                sessions.close()
+
+        return await run_in_threadpool(check)
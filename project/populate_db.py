@@ -1,25 +1,38 @@
+import argparse
 import datetime
 import random
+import time
 import traceback
+from decimal import Decimal
+from typing import Dict, List, Optional
 
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 
-from project.data.database import SessionLocal
+from project import cache
+from project.auth import get_password_hash
+from project.data.database import Base, SessionLocal, engine
 from project.data import models as m
 from project.additional import ApiLogger
+from project.routers.rollups import rollups_rebuild
 
+NAMES = ["Nayeli Le", "Johan Oliver", "Jeffery Fisher", "Theresa Taylor",
+         "Atticus Gay", "Cara Baldwin", "Caden Madden", "Liberty Bowen",
+         "Elijah Dennis", "Valentin Montoya", "Estrella Wyatt", "Audrey Mckay",
+         "Clara Robinson", "Charlize Hanson", "Izayah Bridges", "Liberty Bowen"]
+FRUITS = ['strawberry', 'cherry', 'raspberry', 'apricot']
+EXPENSE_TYPES = ["general", "pesticides", "herbicides", "fungicides", "fuel", "maintenance"]
 
-def generate_constrained_sum(n, total):
-    dividers = sorted(random.sample(range(1, total), n-1))
+
+def generate_constrained_sum(n, total, rng=random):
+    dividers = sorted(rng.sample(range(1, total), n-1))
     return [a - b for a, b in zip(dividers + [total], [0] + dividers)]
 
 
-def generate_workdays(harvests: list[m.Harvest], user_id):
+def generate_workdays(harvests: list[m.Harvest], user_id, db: Session):
     workdays_to_generate = sum([len(h.employees) for h in harvests])
     i = 1
     print(f"Generating Workdays ============================================================")
-    dates = [h.date for h in harvests]
     for harvest in harvests:
         try:
             if len(harvest.employees) == 0:
@@ -27,7 +40,6 @@ def generate_workdays(harvests: list[m.Harvest], user_id):
                 print(msg)
                 ApiLogger.create_module_log("populator", msg, 'work')
                 continue
-            print(dates)
             harvested_per_employee = generate_constrained_sum(len(harvest.employees),
                                                               int(harvest.harvested))
 
@@ -35,7 +47,6 @@ def generate_workdays(harvests: list[m.Harvest], user_id):
                 msg = f"Generating Workday for harvest {harvest.date} - {i} out of {workdays_to_generate}"
                 print(msg)
                 ApiLogger.create_module_log("populator", msg, 'work')
-                print(employee.id, harvested)
                 workday = m.Workday()
                 workday.harvest_id = harvest.id
                 workday.employer_id = user_id
@@ -56,7 +67,6 @@ def generate_workdays(harvests: list[m.Harvest], user_id):
 def generate_harvests(start_date: datetime.date, end_date: datetime.date,
                       n: int, season_id: int, user_id: int, db: Session):
     """EXECUTE AFTER generate_employees"""
-    fruits = ['strawberry', 'cherry', 'raspberry', 'apricot']
     days_between = (end_date - start_date).days
     harvests = []
     i = 1
@@ -68,7 +78,7 @@ def generate_harvests(start_date: datetime.date, end_date: datetime.date,
             ApiLogger.create_module_log("populator", msg, 'work')
             i += 1
             harvest = m.Harvest()
-            harvest.fruit = fruits[random.randrange(0, len(fruits))]
+            harvest.fruit = FRUITS[random.randrange(0, len(FRUITS))]
             harvest.date = start_date + datetime.timedelta(days=random.randint(0, days_between))
             harvest.harvested = random.randint(500, 5000)
             harvest.price = random.randint(5, 25)
@@ -98,10 +108,6 @@ def generate_employees(start_date: datetime.date,
                        season_id: int,
                        user_id: int,
                        db: Session):
-    names = ["Nayeli Le", "Johan Oliver", "Jeffery Fisher", "Theresa Taylor",
-             "Atticus Gay", "Cara Baldwin", "Caden Madden", "Liberty Bowen",
-             "Elijah Dennis", "Valentin Montoya", "Estrella Wyatt", "Audrey Mckay"
-             "Clara Robinson", "Charlize Hanson", "Izayah Bridges", "Liberty Bowen"]
     i = 1
     print(f"Generating Employees ============================================================")
     for _ in range(n):
@@ -114,7 +120,7 @@ def generate_employees(start_date: datetime.date,
             random_days = random.randint(0, 15)
             employee.start_date = start_date + datetime.timedelta(days=random_days)
             employee.end_date = end_date - datetime.timedelta(days=random_days)
-            employee.name = names[random.randrange(0, len(names))]
+            employee.name = NAMES[random.randrange(0, len(NAMES))]
             employee.season_id = season_id
             employee.employer_id = user_id
             db.add(employee)
@@ -130,7 +136,6 @@ def generate_employees(start_date: datetime.date,
 def generate_expenses(n: int, season_id: int, user_id: int,
                       start_date: datetime.date, end_date: datetime.date,
                       db: Session):
-    types = ["general", "pesticides", "herbicides", "fungicides", "fuel", "maintenance"]
     days_between = (end_date - start_date).days
     i = 1
     msg = f"Generating Expenses ============================================================"
@@ -145,7 +150,7 @@ def generate_expenses(n: int, season_id: int, user_id: int,
             expense = m.Expense()
             expense.season_id = season_id
             expense.owner_id = user_id
-            expense.type = types[random.randrange(0, len(types))]
+            expense.type = EXPENSE_TYPES[random.randrange(0, len(EXPENSE_TYPES))]
             expense.date = start_date + datetime.timedelta(days=random.randint(0, days_between))
             expense.amount = random.randint(150, 10000)
             db.add(expense)
@@ -189,7 +194,9 @@ def generate_seasons(start_year: int, end_year: int, user_id: int, db: Session):
                                n=random.randint(4, 16))
             harvests = generate_harvests(db=db, season_id=season.id, start_date=season.start_date,
                                          end_date=season.end_date, user_id=user_id, n=random.randint(12, 48))
-            generate_workdays(harvests=harvests, user_id=user_id)
+            generate_workdays(harvests=harvests, user_id=user_id, db=db)
+            rollups_rebuild(db, [season.id])
+            db.commit()
     except Exception as e:
         print(e)
         print(traceback.format_exc())
@@ -200,6 +207,162 @@ def generate_seasons(start_year: int, end_year: int, user_id: int, db: Session):
         db.commit()
 
 
+# BULK GENERATION ======================================================================================
+def generate_season_bulk(db: Session, rng: random.Random, user_id: int, year: int,
+                         employees_n: int, harvests_n: int, expenses_n: int,
+                         chunk_size: int = 10000) -> Dict[str, int]:
+    """
+    Generate season with its expenses, employees, harvests and workdays, built in memory and inserted
+    in bulk: seasons, employees and harvests through one flush each, as their ids are needed,
+    expenses, harvest employees and workdays with executemany in chunks.
+    Rollups and data versions of the season are updated too. Doesn't commit
+
+    :param db: database session
+    :param rng: random generator, seeded for reproducible data
+    :param user_id: owner of generated season
+    :param year: year of generated season
+    :param employees_n: number of employees
+    :param harvests_n: number of harvests, limited by number of days and fruits in the season
+    :param expenses_n: number of expenses
+    :param chunk_size: number of rows inserted by a single executemany
+    :return: numbers of generated rows per table
+    """
+    season = m.Season(owner_id=user_id, year=year,
+                      start_date=datetime.date(year, rng.randint(5, 6), rng.randint(2, 30)),
+                      end_date=datetime.date(year, rng.randint(8, 10), rng.randint(2, 30)))
+    db.add(season)
+    db.flush()
+    days_between = (season.end_date - season.start_date).days
+
+    _insert_chunks(db, m.Expense, [
+        {"season_id": season.id, "owner_id": user_id, "type": rng.choice(EXPENSE_TYPES),
+         "date": season.start_date + datetime.timedelta(days=rng.randint(0, days_between)),
+         "amount": rng.randint(150, 10000)} for _ in range(expenses_n)], chunk_size)
+
+    employees = []
+    for _ in range(employees_n):
+        random_days = rng.randint(0, 15)
+        employees.append(m.Employee(employer_id=user_id, season_id=season.id, name=rng.choice(NAMES),
+                                    start_date=season.start_date + datetime.timedelta(days=random_days),
+                                    end_date=season.end_date - datetime.timedelta(days=random_days)))
+    # dates and fruits of harvests are unique (u_df), so there are at most 4 harvests per day
+    days_fruits = [(day, fruit) for day in range(days_between + 1) for fruit in FRUITS]
+    harvests, harvest_workers = [], []
+    for day, fruit in sorted(rng.sample(days_fruits, min(harvests_n, len(days_fruits)))):
+        date = season.start_date + datetime.timedelta(days=day)
+        workers = [e for e in employees if e.start_date <= date <= e.end_date]
+        # harvests are validated to at most 5000 kg, so amounts per employee are kept small enough for their sum
+        most = max(1, min(500, 5000 // max(1, len(workers))))
+        amounts = [rng.randint(min(20, most), most) for _ in workers]
+        harvests.append(m.Harvest(fruit=fruit, date=date, price=rng.randint(5, 25),
+                                  harvested=sum(amounts) or rng.randint(500, 5000),
+                                  season_id=season.id, owner_id=user_id))
+        harvest_workers.append(list(zip(workers, amounts)))
+    db.add_all(employees + harvests)
+    db.flush()
+
+    associations, workdays = [], []
+    for harvest, workers in zip(harvests, harvest_workers):
+        pay_per_kg = (Decimal(harvest.price) / 3).quantize(Decimal("0.1"))
+        for employee, harvested in workers:
+            associations.append({"harvest_id": harvest.id, "employee_id": employee.id})
+            workdays.append({"harvest_id": harvest.id, "employee_id": employee.id, "employer_id": user_id,
+                             "fruit": harvest.fruit, "harvested": harvested, "pay_per_kg": pay_per_kg})
+    _insert_chunks(db, m.harvests_employees_asoc_tab, associations, chunk_size)
+    _insert_chunks(db, m.Workday, workdays, chunk_size)
+
+    rollups_rebuild(db, [season.id])
+    cache.bump_data_versions(db, [(user_id, season.id)])
+    return {"seasons": 1, "expenses": expenses_n, "employees": employees_n,
+            "harvests": len(harvests), "workdays": len(workdays)}
+
+
+def _insert_chunks(db: Session, target, rows: List[dict], chunk_size: int) -> None:
+    for start in range(0, len(rows), chunk_size):
+        if isinstance(target, type):
+            db.bulk_insert_mappings(target, rows[start:start + chunk_size])
+        else:
+            db.execute(target.insert(), rows[start:start + chunk_size])
+
+
+def generate_bulk(db: Session, seed: int = 0, users: int = 1, seasons: int = 3, employees: int = 10,
+                  harvests: int = 30, expenses: int = 12, start_year: int = 2121,
+                  password: str = "populator", user_ids: Optional[List[int]] = None) -> Dict[str, int]:
+    """
+    Generate reproducible dataset of given scale, committing once per season.
+    Each season gets its own generator seeded from seed, user and year,
+    so the same parameters always produce the same data.
+    Users populator_<seed>_<n> are created if user ids aren't given, or reused if they exist.
+    Harvest dates and fruits are unique across all users, so every user gets seasons in different years
+
+    :param db: database session
+    :param seed: seed of generated data
+    :param users: number of users owning generated seasons, ignored if user_ids are given
+    :param seasons: number of seasons per user, in consecutive years from start_year
+                    for the first user, following years for the next ones
+    :param employees: number of employees per season
+    :param harvests: number of harvests per season
+    :param expenses: number of expenses per season
+    :param start_year: year of first generated season
+    :param password: password of created users
+    :param user_ids: ids of existing users to generate seasons for
+    :return: numbers of generated rows per table
+    """
+    if user_ids is None:
+        user_ids = _populator_users(db, seed, users, password)
+    totals = dict.fromkeys(("seasons", "expenses", "employees", "harvests", "workdays"), 0)
+    for user_n, user_id in enumerate(user_ids):
+        for year in range(start_year + user_n * seasons, start_year + (user_n + 1) * seasons):
+            started = time.perf_counter()
+            rng = random.Random(f"{seed}-{user_id}-{year}")
+            try:
+                counts = generate_season_bulk(db, rng, user_id, year, employees, harvests, expenses)
+                db.commit()
+            except Exception:
+                db.rollback()
+                ApiLogger.create_module_log("populator", traceback.format_exc(), log_type='exc')
+                raise
+            for table, count in counts.items():
+                totals[table] += count
+            print(f"User {user_id}, season {year}: {counts['workdays']} workdays "
+                  f"in {time.perf_counter() - started:.2f}s, {totals['workdays']} in total")
+    return totals
+
+
+def _populator_users(db: Session, seed: int, n: int, password: str) -> List[int]:
+    usernames = [f"populator_{seed}_{i}" for i in range(1, n + 1)]
+    existing = dict(db.query(m.User.username, m.User.id).filter(m.User.username.in_(usernames)))
+    hashed_password = get_password_hash(password)
+    new_users = [m.User(username=username, hashed_password=hashed_password)
+                 for username in usernames if username not in existing]
+    db.add_all(new_users)
+    db.commit()
+    existing.update((user.username, user.id) for user in new_users)
+    return [existing[username] for username in usernames]
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Populate database with generated data")
+    parser.add_argument("--bulk", action="store_true",
+                        help="generate whole seasons in memory and insert them in bulk, one transaction per season")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--users", type=int, default=1)
+    parser.add_argument("--seasons", type=int, default=3, help="seasons per user")
+    parser.add_argument("--employees", type=int, default=10, help="employees per season")
+    parser.add_argument("--harvests", type=int, default=30, help="harvests per season")
+    parser.add_argument("--expenses", type=int, default=12, help="expenses per season")
+    parser.add_argument("--start-year", type=int, default=2121)
+    parser.add_argument("--user-id", type=int, action="append",
+                        help="existing user to generate seasons for, can be repeated; "
+                             "populator users are created if not given")
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
     db: Session = SessionLocal()
-    generate_seasons(2121, 2123, 1, db)
+    if args.bulk:
+        totals = generate_bulk(db, seed=args.seed, users=args.users, seasons=args.seasons,
+                               employees=args.employees, harvests=args.harvests, expenses=args.expenses,
+                               start_year=args.start_year, user_ids=args.user_id)
+        print("Generated " + ", ".join(f"{count} {table}" for table, count in totals.items()))
+    else:
+        generate_seasons(2121, 2123, 1, db)
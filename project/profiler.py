@@ -0,0 +1,118 @@
+import datetime
+import json
+import os
+import re
+import sys
+import threading
+from collections import Counter
+from typing import List, Optional
+
+from .additional import ApiLogger
+from .data.database import QueryStats
+
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", 0.005))
+PROFILE_RETENTION_FILES = int(os.environ.get("PROFILE_RETENTION_FILES", 50))
+# leaf frames of threads waiting for work, left out of samples
+_IDLE_FRAMES = {("threading.py", "wait"), ("selectors.py", "select")}
+_PROFILE_ID = re.compile(r"^[0-9TZ]+-[a-z0-9_-]+$")
+# only one request is profiled at a time, as the profiler samples all threads
+profile_lock = threading.Lock()
+
+
+def profiles_path() -> str:
+    return ApiLogger.logs_path + "/profiles"
+
+
+class SamplingProfiler:
+    """
+    Samples stacks of all running threads from a background thread, counting them in collapsed stack
+    format (frames joined with ';', root first), ready for flamegraph tools.
+    Samples every thread, as sync routes run in threadpool, so requests handled at the same time
+    show up in the profile too - profile on an instance without other traffic for clean results
+    """
+
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in _IDLE_FRAMES:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                frames.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(frames))] += 1
+            self.samples += 1
+
+
+def new_profile_id(method: str, path: str) -> str:
+    slug = re.sub(r"[^a-z0-9]+", "_", f"{method} {path}".lower()).strip("_")[:60]
+    return f"{datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%fZ')}-{slug}"
+
+
+def save_profile(profile_id: str, profiler: SamplingProfiler, info: dict, stats: Optional[QueryStats]) -> None:
+    """
+    Save collapsed stacks into logs/profiles/<profile_id>.collapsed and request info with executed
+    statements into logs/profiles/<profile_id>.json, removing the oldest profiles over retention limit
+
+    :param profile_id: id from new_profile_id
+    :param profiler: stopped profiler of the request
+    :param info: request data, ex. method, path, status and duration
+    :param stats: statements executed by the request
+    :return: None
+    """
+    os.makedirs(profiles_path(), exist_ok=True)
+    with open(f"{profiles_path()}/{profile_id}.collapsed", "w", encoding="utf-8") as file:
+        file.write(profiler.collapsed())
+    if stats is not None:
+        info.update(db_queries=stats.count, db_time_ms=round(stats.seconds * 1000, 3),
+                    statements=[{"sql": sql, "count": count} for sql, count in stats.statements.most_common()])
+    info.update(samples=profiler.samples, sample_interval=profiler.interval)
+    with open(f"{profiles_path()}/{profile_id}.json", "w", encoding="utf-8") as file:
+        json.dump(info, file, ensure_ascii=False, indent=2)
+    if not PROFILE_RETENTION_FILES:
+        return
+    for old_id in profile_ids()[:-PROFILE_RETENTION_FILES]:
+        for extension in (".collapsed", ".json"):
+            try:
+                os.remove(f"{profiles_path()}/{old_id}{extension}")
+            except FileNotFoundError:
+                pass
+
+
+def profile_ids() -> List[str]:
+    """Get ids of saved profiles, oldest first"""
+    if not os.path.isdir(profiles_path()):
+        return []
+    return sorted(name[:-len(".json")] for name in os.listdir(profiles_path()) if name.endswith(".json"))
+
+
+def profile_file(profile_id: str, extension: str) -> Optional[str]:
+    """Get path of saved profile file, None if there is no such profile or its id is malformed"""
+    if not _PROFILE_ID.match(profile_id):
+        return None
+    path = f"{profiles_path()}/{profile_id}{extension}"
+    return path if os.path.isfile(path) else None
@@ -1,9 +1,15 @@
-from fastapi import APIRouter, Depends, status
-from sqlalchemy.orm import Session, joinedload
+from typing import List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi.responses import FileResponse
+from sqlalchemy.orm import Session
 
 import project.data.models as m
+from project import cache, profiler
 from project.dependencies import get_db
-from project.auth import check_if_user_admin
+from project.auth import check_if_user_admin, UserIdentity
+from .crud import SEASON_LOAD_PROFILES
+from .rollups import rollups_rebuild
 
 router = APIRouter(
     prefix="/admin",
@@ -13,22 +19,59 @@ router = APIRouter(
 
 @router.delete("/seasons/", status_code=status.HTTP_200_OK)
 def delete_all_seasons_admin(db: Session = Depends(get_db),
-                             user: m.User = Depends(check_if_user_admin)):
+                             user: UserIdentity = Depends(check_if_user_admin)):
+    # bulk delete skips ORM cascades, so rollups of the seasons have to go first
+    db.query(m.SeasonRollup).delete()
     db.query(m.Season).delete()
+    cache.bump_all_data_versions(db)
     db.commit()
 
 
 @router.delete("/seasons/{s_id}", status_code=status.HTTP_200_OK)
 def delete_season_admin(s_id: int,
                         db: Session = Depends(get_db),
-                        user: m.User = Depends(check_if_user_admin)):
+                        user: UserIdentity = Depends(check_if_user_admin)):
     season_m = db.query(m.Season).filter(m.Season.id == s_id).first()
     db.delete(season_m)
     db.commit()
 
 
 @router.get("/seasons/", status_code=status.HTTP_200_OK)
-def get_all_seasons_admin(user: m.User = Depends(check_if_user_admin),
+def get_all_seasons_admin(user: UserIdentity = Depends(check_if_user_admin),
+                          db: Session = Depends(get_db)):
+    return db.query(m.Season).options(*SEASON_LOAD_PROFILES['full']).all()
+
+
+@router.post("/rollups/rebuild", status_code=status.HTTP_200_OK)
+def rebuild_rollups_admin(season_id: Optional[List[int]] = Query(None),
+                          user: UserIdentity = Depends(check_if_user_admin),
                           db: Session = Depends(get_db)):
-    return db.query(m.Season)\
-        .options(joinedload(m.Season.employees), joinedload(m.Season.harvests), joinedload(m.Season.expenses)).all()
+    written = rollups_rebuild(db, season_id)
+    cache.bump_all_data_versions(db)
+    db.commit()
+    return {"rollups_written": written}
+
+
+@router.get("/profiles/", status_code=status.HTTP_200_OK)
+def get_profiles_admin(user: UserIdentity = Depends(check_if_user_admin)):
+    return {"profiles": profiler.profile_ids()[::-1]}
+
+
+@router.get("/profiles/{profile_id}", status_code=status.HTTP_200_OK)
+def get_profile_admin(profile_id: str,
+                      user: UserIdentity = Depends(check_if_user_admin)):
+    return FileResponse(_profile_file(profile_id, ".json"), media_type="application/json")
+
+
+@router.get("/profiles/{profile_id}/collapsed", status_code=status.HTTP_200_OK)
+def get_profile_stacks_admin(profile_id: str,
+                             user: UserIdentity = Depends(check_if_user_admin)):
+    return FileResponse(_profile_file(profile_id, ".collapsed"), media_type="text/plain",
+                        filename=f"{profile_id}.collapsed")
+
+
+def _profile_file(profile_id: str, extension: str) -> str:
+    path = profiler.profile_file(profile_id, extension)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Couldn't find profile with specified id")
+    return path
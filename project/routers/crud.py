@@ -1,17 +1,52 @@
 import datetime
 import decimal
-from typing import Optional, List, Union
+from collections import Counter
+from itertools import chain
+from typing import Optional, List, Union, Iterator
 
 from fastapi import HTTPException, status
-from sqlalchemy import extract
+from sqlalchemy import extract, func
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import Session, joinedload, Query
+from sqlalchemy.orm import Session, selectinload, Query
 from project.data import models as m, schemas as sc
+from .pagination import paginate
+from .rollups import RollupDeltas
 from .validations import validate_date_qp, validate_date_in_bounds,\
     validate_date_in_season_bounds, validate_fruit_qp, validate_order_by
 
 
+def query_stream(query: Query, name: str, batch_size: int = 500) -> Iterator:
+    """
+    Iterate over results of a query fetched from the database cursor in batches,
+    raising the same 404 as getters do if there are no results
+
+    :param query: query built by one of *_query functions
+    :param name: name of queried model used in the error message
+    :param batch_size: number of rows fetched at once
+    :return: iterator over query results
+    """
+    results = iter(query.yield_per(batch_size))
+    first = next(results, None)
+    if first is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Couldn't find {name} with specified parameters")
+    return chain([first], results)
+
+
 # SEASONS ===============================================================================================
+# Relationships loaded together with seasons, chosen per call depending on what caller needs
+SEASON_LOAD_PROFILES = {
+    'bare': (),
+    'summary': (selectinload(m.Season.employees),
+                selectinload(m.Season.harvests),
+                selectinload(m.Season.expenses)),
+    'full': (selectinload(m.Season.employees).selectinload(m.Employee.workdays),
+             selectinload(m.Season.harvests).selectinload(m.Harvest.workdays),
+             selectinload(m.Season.expenses)),
+}
+SEASON_ORDERS = {'year': m.Season.year}
+
+
 def season_create(db: Session, user: m.User,
                   start_date: datetime.date,
                   end_date: Optional[datetime.date] = None) -> m.Season:
@@ -45,12 +80,13 @@ def season_get(db: Session, user: m.User,
                limit: Optional[int] = None,
                offset: Optional[int] = None,
                order_by: Optional[str] = None,
-               order: Optional[str] = 'desc') -> List[m.Season]:
+               order: Optional[str] = 'desc',
+               cursor: Optional[str] = None,
+               load: str = 'bare') -> List[m.Season]:
+    if load not in SEASON_LOAD_PROFILES:
+        raise ValueError(f"Load profile must be one of {list(SEASON_LOAD_PROFILES)}, not {load}")
     seasons: Query = db.query(m.Season)\
-        .options(
-        joinedload(m.Season.employees),
-        joinedload(m.Season.harvests),
-        joinedload(m.Season.expenses))\
+        .options(*SEASON_LOAD_PROFILES[load])\
         .filter(m.Season.owner_id == user.id)
     if year:
         seasons = seasons.filter(m.Season.year == year)
@@ -61,13 +97,8 @@ def season_get(db: Session, user: m.User,
         before = validate_date_qp(before)
         seasons = seasons.filter(m.Season.start_date > before)
     if order_by:
-        orders = {'year': m.Season.year}
-        validate_order_by(order_by=order_by, order=order, orders=orders)
-        seasons = seasons.order_by(orders[order_by].desc() if order == 'desc' else orders[order_by].asc())
-    if offset:
-        seasons = seasons.offset(offset)
-    if limit:
-        seasons = seasons.limit(limit)
+        validate_order_by(order_by=order_by, order=order, orders=SEASON_ORDERS)
+    seasons = paginate(seasons, SEASON_ORDERS, m.Season.id, order_by, order, limit, offset, cursor)
 
     seasons: List[m.Season] = seasons.all()
     if not seasons:
@@ -79,7 +110,7 @@ def season_get(db: Session, user: m.User,
 
 def season_update(db: Session, user: m.User, year: int,
                   data: sc.SeasonUpdate) -> m.Season:
-    season = season_get(db=db, user=user, year=year)[0]
+    season = season_get(db=db, user=user, year=year, load='summary')[0]
     if data.start_date:
         season.start_date = data.start_date
         season.year = data.start_date.year
@@ -130,29 +161,38 @@ def harvest_create(db: Session, user: m.User, year: int,
                                     detail=f"Incompatible dates: harvest date {data.date}"
                                            f" and employee start: {e.start_date} or/and end {e.end_date}")
     db.add(harvest_new)
+    deltas = RollupDeltas()
+    deltas.harvest(harvest_new, with_workdays=False)
+    deltas.apply(db)
     db.commit()
     db.refresh(harvest_new)
     return harvest_new
 
 
-def harvests_get(db: Session, user: m.User,
-                 id: Optional[Union[int, List[int]]] = None,
-                 employee_id: Optional[int] = None,
-                 year: Optional[int] = None,
-                 season_id: Optional[int] = None,
-                 after: Optional[str] = None,
-                 before: Optional[str] = None,
-                 fruit: Optional[str] = None,
-                 limit: Optional[int] = None,
-                 offset: Optional[int] = None,
-                 p_more: Optional[decimal.Decimal] = None,
-                 p_less: Optional[decimal.Decimal] = None,
-                 h_more: Optional[decimal.Decimal] = None,
-                 h_less: Optional[decimal.Decimal] = None,
-                 order_by: Optional[str] = None,
-                 order: Optional[str] = 'desc'
-                 ) -> List[m.Harvest]:
+HARVEST_ORDERS = {'fruit': m.Harvest.fruit,
+                  'harvested': m.Harvest.harvested,
+                  'date': m.Harvest.date,
+                  'price': m.Harvest.price}
+
 
+def harvests_query(db: Session, user: m.User,
+                   id: Optional[Union[int, List[int]]] = None,
+                   employee_id: Optional[int] = None,
+                   year: Optional[int] = None,
+                   season_id: Optional[int] = None,
+                   after: Optional[str] = None,
+                   before: Optional[str] = None,
+                   fruit: Optional[str] = None,
+                   limit: Optional[int] = None,
+                   offset: Optional[int] = None,
+                   p_more: Optional[decimal.Decimal] = None,
+                   p_less: Optional[decimal.Decimal] = None,
+                   h_more: Optional[decimal.Decimal] = None,
+                   h_less: Optional[decimal.Decimal] = None,
+                   order_by: Optional[str] = None,
+                   order: Optional[str] = 'desc',
+                   cursor: Optional[str] = None
+                   ) -> Query:
     harvests = db.query(m.Harvest).filter(m.Harvest.owner_id == user.id)
     if id and type(id) == int:
         harvests = harvests.filter(m.Harvest.id == id)
@@ -188,17 +228,12 @@ def harvests_get(db: Session, user: m.User,
         harvest_ids = [h.id for h in employee_m.harvests]
         harvests = harvests.filter(m.Harvest.id.in_(harvest_ids))
     if order_by:
-        orders = {'fruit': m.Harvest.fruit,
-                  'harvested': m.Harvest.harvested,
-                  'date': m.Harvest.date,
-                  'price': m.Harvest.price}
-        validate_order_by(order_by=order_by, order=order, orders=orders)
-        harvests = harvests.order_by(orders[order_by].desc() if order == 'desc' else orders[order_by].asc())
-    if offset:
-        harvests = harvests.offset(offset)
-    if limit:
-        harvests = harvests.limit(limit)
-    harvests = harvests.all()
+        validate_order_by(order_by=order_by, order=order, orders=HARVEST_ORDERS)
+    return paginate(harvests, HARVEST_ORDERS, m.Harvest.id, order_by, order, limit, offset, cursor)
+
+
+def harvests_get(db: Session, user: m.User, **filters) -> List[m.Harvest]:
+    harvests = harvests_query(db, user, **filters).all()
     if not harvests:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail="Couldn't find Harvest with specified parameters")
@@ -207,7 +242,9 @@ def harvests_get(db: Session, user: m.User,
 
 def harvest_update(db: Session, user: m.User, id: int,
                    data: sc.HarvestUpdate) -> m.Harvest:
-    harvest: m.Harvest = harvests_get(db, user, id)[0]
+    harvest: m.Harvest = harvests_get(db, user, id=id)[0]
+    deltas = RollupDeltas()
+    deltas.harvest(harvest, -1)
     if data.date:
         for e in harvest.employees:
             e: m.Employee
@@ -220,7 +257,6 @@ def harvest_update(db: Session, user: m.User, id: int,
             w: m.Workday
             w.fruit = data.fruit
             db.add(w)
-            db.commit()
     if data.harvested:
         harvested_in_workdays = 0
         for w in harvest.workdays:
@@ -239,6 +275,8 @@ def harvest_update(db: Session, user: m.User, id: int,
                                     detail=f"Employee with id {e.id} can't be added to Harvest because of date discrepency")
             harvest.employees.append(e)
     db.add(harvest)
+    deltas.harvest(harvest)
+    deltas.apply(db)
     db.commit()
     db.refresh(harvest)
     return harvest
@@ -275,20 +313,26 @@ def employee_create(db: Session, user: m.User, year: int,
     return employee_new
 
 
-def employees_get(db: Session, user: m.User,
-                  id: Optional[int] = None,
-                  ids: Optional[List[int]] = None,
-                  harvest_id: Optional[int] = None,
-                  year: Optional[int] = None,
-                  season_id: Optional[str] = None,
-                  name: Optional[str] = None,
-                  after: Optional[str] = None,
-                  before: Optional[str] = None,
-                  limit: Optional[int] = None,
-                  offset: Optional[int] = None,
-                  order_by: Optional[str] = None,
-                  order: Optional[str] = 'desc'
-                  ) -> List[m.Employee]:
+EMPLOYEE_ORDERS = {'name': m.Employee.name,
+                   'start-date': m.Employee.start_date,
+                   'end-date': m.Employee.end_date}
+
+
+def employees_query(db: Session, user: m.User,
+                    id: Optional[int] = None,
+                    ids: Optional[List[int]] = None,
+                    harvest_id: Optional[int] = None,
+                    year: Optional[int] = None,
+                    season_id: Optional[str] = None,
+                    name: Optional[str] = None,
+                    after: Optional[str] = None,
+                    before: Optional[str] = None,
+                    limit: Optional[int] = None,
+                    offset: Optional[int] = None,
+                    order_by: Optional[str] = None,
+                    order: Optional[str] = 'desc',
+                    cursor: Optional[str] = None
+                    ) -> Query:
     employees = db.query(m.Employee).filter(m.Employee.employer_id == user.id)
     if id and not ids:
         employees = employees.filter(m.Employee.id == id)
@@ -315,16 +359,12 @@ def employees_get(db: Session, user: m.User,
         before = validate_date_qp(before)
         employees = employees.filter(m.Employee.start_date < before)
     if order_by:
-        orders = {'name': m.Employee.name,
-                  'start-date': m.Employee.start_date,
-                  'end-date': m.Employee.end_date}
-        validate_order_by(order_by=order_by, order=order, orders=orders)
-        employees = employees.order_by(orders[order_by].desc() if order == 'desc' else orders[order_by].asc())
-    if offset:
-        employees = employees.offset(offset)
-    if limit:
-        employees = employees.limit(limit)
-    employees = employees.all()
+        validate_order_by(order_by=order_by, order=order, orders=EMPLOYEE_ORDERS)
+    return paginate(employees, EMPLOYEE_ORDERS, m.Employee.id, order_by, order, limit, offset, cursor)
+
+
+def employees_get(db: Session, user: m.User, **filters) -> List[m.Employee]:
+    employees = employees_query(db, user, **filters).all()
     if not employees:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail="Couldn't find Employee with specified parameters")
@@ -333,7 +373,7 @@ def employees_get(db: Session, user: m.User,
 
 def employee_update(db: Session, user: m.User, id: int,
                     data: sc.EmployeeUpdate) -> m.Employee:
-    employee: m.Employee = employees_get(db, user, id)[0]
+    employee: m.Employee = employees_get(db, user, id=id)[0]
     if data.harvests_ids:
         harvests: List[m.Harvest] = harvests_get(db=db, user=user, id=data.harvests_ids)
         for h in harvests:
@@ -379,26 +419,35 @@ def expense_create(db: Session, year: int, user: m.User,
     )
 
     db.add(expense_new)
+    deltas = RollupDeltas()
+    deltas.expense(expense_new)
+    deltas.apply(db)
     db.commit()
     db.refresh(expense_new)
 
     return expense_new
 
 
-def expenses_get(db: Session, user: m.User,
-                 year: Optional[int] = None,
-                 id: Optional[int] = None,
-                 season_id: Optional[str] = None,
-                 type: Optional[str] = None,
-                 after: Optional[str] = None,
-                 before: Optional[str] = None,
-                 more: Optional[decimal.Decimal] = None,
-                 less: Optional[decimal.Decimal] = None,
-                 limit: Optional[int] = None,
-                 offset: Optional[int] = None,
-                 order_by: Optional[str] = None,
-                 order: Optional[str] = 'desc'
-                 ) -> List[m.Expense]:
+EXPENSE_ORDERS = {'type': m.Expense.type,
+                  'date': m.Expense.date,
+                  'amount': m.Expense.amount}
+
+
+def expenses_query(db: Session, user: m.User,
+                   year: Optional[int] = None,
+                   id: Optional[int] = None,
+                   season_id: Optional[str] = None,
+                   type: Optional[str] = None,
+                   after: Optional[str] = None,
+                   before: Optional[str] = None,
+                   more: Optional[decimal.Decimal] = None,
+                   less: Optional[decimal.Decimal] = None,
+                   limit: Optional[int] = None,
+                   offset: Optional[int] = None,
+                   order_by: Optional[str] = None,
+                   order: Optional[str] = 'desc',
+                   cursor: Optional[str] = None
+                   ) -> Query:
     expenses: Query = db.query(m.Expense).filter(m.Expense.owner_id == user.id)
     if id:
         expenses = expenses.filter(m.Expense.id == id)
@@ -425,16 +474,12 @@ def expenses_get(db: Session, user: m.User,
         less = decimal.Decimal(less)
         expenses = expenses.filter(m.Expense.amount < less)
     if order_by:
-        orders = {'type': m.Expense.type,
-                  'date': m.Expense.date,
-                  'amount': m.Expense.amount}
-        validate_order_by(order_by=order_by, order=order, orders=orders)
-        expenses = expenses.order_by(orders[order_by].desc() if order == 'desc' else orders[order_by].asc())
-    if offset:
-        expenses = expenses.offset(offset)
-    if limit:
-        expenses = expenses.limit(limit)
-    expenses: List[m.Expense] = expenses.all()
+        validate_order_by(order_by=order_by, order=order, orders=EXPENSE_ORDERS)
+    return paginate(expenses, EXPENSE_ORDERS, m.Expense.id, order_by, order, limit, offset, cursor)
+
+
+def expenses_get(db: Session, user: m.User, **filters) -> List[m.Expense]:
+    expenses: List[m.Expense] = expenses_query(db, user, **filters).all()
     if not expenses:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail="Couldn't find Expense with specified parameters")
@@ -444,6 +489,8 @@ def expenses_get(db: Session, user: m.User,
 def expense_update(db: Session, id: int, user: m.User,
                    data: sc.ExpenseUpdate) -> m.Expense:
     expense: m.Expense = expenses_get(db=db, user=user, id=id)[0]
+    deltas = RollupDeltas()
+    deltas.expense(expense, -1)
     if data.amount:
         expense.amount = data.amount
     if data.date:
@@ -454,6 +501,8 @@ def expense_update(db: Session, id: int, user: m.User,
     if data.type:
         expense.type = data.type
     db.add(expense)
+    deltas.expense(expense)
+    deltas.apply(db)
     db.commit()
     db.refresh(expense)
     return expense
@@ -470,12 +519,12 @@ def workday_create(db: Session,
     workday_new.employee_id = e_id or data.employee_id
     workday_new.employer_id = user.id
 
-    if not workday_new.harvest_id and workday_new.employee_id:
+    if not (workday_new.harvest_id and workday_new.employee_id):
         raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
                             detail="Both Employee and Harvest id are needed to create a Workday")
 
-    harvest_m: m.Harvest = harvests_get(db=db, user=user, id=h_id)[0]
-    employee_m: m.Employee = employees_get(db=db, user=user, id=e_id)[0]
+    harvest_m: m.Harvest = harvests_get(db=db, user=user, id=workday_new.harvest_id)[0]
+    employee_m: m.Employee = employees_get(db=db, user=user, id=workday_new.employee_id)[0]
 
     if harvest_m.season_id != employee_m.season_id:
         raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
@@ -489,26 +538,114 @@ def workday_create(db: Session,
     workday_new.pay_per_kg = data.pay_per_kg
 
     db.add(workday_new)
+    deltas = RollupDeltas()
+    deltas.workday(workday_new, harvest_m.season_id)
+    deltas.apply(db)
     db.commit()
     db.refresh(workday_new)
     return workday_new
 
 
-def workdays_get(db: Session,
-                 user: m.User,
-                 id: Optional[int] = None,
-                 h_id: Optional[int] = None,
-                 e_id: Optional[int] = None,
-                 fruit: Optional[str] = None,
-                 h_more: Optional[decimal.Decimal] = None,
-                 h_less: Optional[decimal.Decimal] = None,
-                 p_more: Optional[decimal.Decimal] = None,
-                 p_less: Optional[decimal.Decimal] = None,
-                 limit: Optional[int] = None,
-                 offset: Optional[int] = None,
-                 order_by: Optional[str] = None,
-                 order: Optional[str] = 'desc'
-                 ) -> List[m.Workday]:
+WORKDAYS_BULK_MAX = 500
+
+
+def workdays_create_bulk(db: Session,
+                         user: m.User,
+                         h_id: int,
+                         data: List[sc.WorkdayBulkItem]) -> List[dict]:
+    """
+    Create workdays of many employees on one harvest in a single transaction.
+    Employees are validated with one query, missing association rows are inserted together,
+    and the request is rejected as a whole if any entry is invalid
+    or harvested amounts would exceed amount of the harvest
+
+    :param db: database session
+    :param user: owner of the harvest and employees
+    :param h_id: id of the harvest
+    :param data: workdays, one per employee
+    :return: created workdays as dicts matching WorkdayResponse
+    """
+    if not data:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="At least one Workday is needed")
+    if len(data) > WORKDAYS_BULK_MAX:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"At most {WORKDAYS_BULK_MAX} Workdays can be created at once")
+    employee_ids = [w.employee_id for w in data]
+    duplicated = sorted(e_id for e_id, count in Counter(employee_ids).items() if count > 1)
+    if duplicated:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"Employees {duplicated} are listed more than once")
+
+    harvest_m: m.Harvest = harvests_get(db=db, user=user, id=h_id)[0]
+    asoc = m.harvests_employees_asoc_tab
+    employees = db.query(m.Employee.id, m.Employee.start_date, m.Employee.end_date,
+                         asoc.c.harvest_id.isnot(None).label('assigned')) \
+        .outerjoin(asoc, (asoc.c.employee_id == m.Employee.id) & (asoc.c.harvest_id == h_id)) \
+        .filter(m.Employee.employer_id == user.id,
+                m.Employee.season_id == harvest_m.season_id,
+                m.Employee.id.in_(set(employee_ids))).all()
+    found = {e.id: e for e in employees}
+    missing = sorted(set(employee_ids) - found.keys())
+    if missing:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail=f"Couldn't find Employees {missing} in season of the Harvest")
+    out_of_bounds = sorted(e.id for e in employees
+                           if not validate_date_in_bounds(bounds_start=e.start_date, bounds_end=e.end_date,
+                                                          start_date=harvest_m.date))
+    if out_of_bounds:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"Harvest date {harvest_m.date} conflicts with Employees {out_of_bounds}")
+
+    # lock the harvest row so concurrent bulk inserts can't both pass the total check
+    db.query(m.Harvest.id).filter(m.Harvest.id == h_id).with_for_update().one()
+    harvested_in_workdays = db.query(func.coalesce(func.sum(m.Workday.harvested), 0)) \
+        .filter(m.Workday.harvest_id == h_id).scalar()
+    harvested_total = decimal.Decimal(harvested_in_workdays) + sum(w.harvested for w in data)
+    if harvested_total > harvest_m.harvested:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"Harvested in workdays ({harvested_total}) "
+                                   f"would exceed harvested amount of the Harvest ({harvest_m.harvested})")
+
+    unassigned = [{'harvest_id': h_id, 'employee_id': e.id} for e in employees if not e.assigned]
+    if unassigned:
+        db.execute(asoc.insert(), unassigned)
+    workdays = [m.Workday(harvest_id=h_id, employee_id=w.employee_id, employer_id=user.id,
+                          fruit=harvest_m.fruit, harvested=w.harvested, pay_per_kg=w.pay_per_kg)
+                for w in data]
+    db.add_all(workdays)
+    deltas = RollupDeltas()
+    for workday_new in workdays:
+        deltas.workday(workday_new, harvest_m.season_id)
+    deltas.apply(db)
+    db.flush()
+    created = [{'id': w.id, 'employee_id': w.employee_id, 'harvest_id': w.harvest_id, 'employer_id': w.employer_id,
+                'fruit': w.fruit, 'harvested': w.harvested, 'pay_per_kg': w.pay_per_kg} for w in workdays]
+    db.commit()
+    return created
+
+
+WORKDAY_ORDERS = {'harvested': m.Workday.harvested,
+                  'fruit': m.Workday.fruit,
+                  'pay-per-kg': m.Workday.pay_per_kg}
+
+
+def workdays_query(db: Session,
+                   user: m.User,
+                   id: Optional[int] = None,
+                   h_id: Optional[int] = None,
+                   e_id: Optional[int] = None,
+                   fruit: Optional[str] = None,
+                   h_more: Optional[decimal.Decimal] = None,
+                   h_less: Optional[decimal.Decimal] = None,
+                   p_more: Optional[decimal.Decimal] = None,
+                   p_less: Optional[decimal.Decimal] = None,
+                   limit: Optional[int] = None,
+                   offset: Optional[int] = None,
+                   order_by: Optional[str] = None,
+                   order: Optional[str] = 'desc',
+                   cursor: Optional[str] = None
+                   ) -> Query:
     workdays = db.query(m.Workday).filter(m.Workday.employer_id == user.id)
     if h_id:
         workdays = db.query(m.Workday).filter(m.Workday.harvest_id == h_id)
@@ -529,19 +666,14 @@ def workdays_get(db: Session,
     if fruit:
         workdays = workdays.filter(m.Workday.fruit == fruit)
     if id:
-        workdays = workdays.filter(m.Workday.id == id),
+        workdays = workdays.filter(m.Workday.id == id)
     if order_by:
-        orders = {'harvested': m.Workday.harvested,
-                  'fruit': m.Workday.fruit,
-                  'pay-per-kg': m.Workday.pay_per_kg}
-        validate_order_by(order_by=order_by, order=order, orders=orders)
-        workdays = workdays.order_by(orders[order_by].desc() if order == 'desc' else orders[order_by].asc())
-    if offset:
-        workdays = workdays.offset(offset)
-    if limit:
-        workdays = workdays.limit(limit)
-
-    workdays = workdays.all()
+        validate_order_by(order_by=order_by, order=order, orders=WORKDAY_ORDERS)
+    return paginate(workdays, WORKDAY_ORDERS, m.Workday.id, order_by, order, limit, offset, cursor)
+
+
+def workdays_get(db: Session, user: m.User, **filters) -> List[m.Workday]:
+    workdays = workdays_query(db, user, **filters).all()
     if not workdays:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail="Couldn't find Workday with specified parameters")
@@ -553,6 +685,9 @@ def workday_update(db: Session,
                    id: int,
                    data: sc.WorkdayUpdate) -> m.Workday:
     workday: m.Workday = workdays_get(db=db, user=user, id=id)[0]
+    season_id = workday.harvest.season_id
+    deltas = RollupDeltas()
+    deltas.workday(workday, season_id, -1)
     if data.harvested:
         workday.harvested = data.harvested
     if data.pay_per_kg:
@@ -578,6 +713,7 @@ def workday_update(db: Session,
                                 detail="Harvest and Employee dates not compatible")
         workday.harvest_id = data.harvest_id
         workday.fruit = harvest_m.fruit
+        season_id = harvest_m.season_id
 
     if data.harvest_id and data.employee_id:
         employee_m: m.Employee = employees_get(db=db, user=user, id=data.employee_id)[0]
@@ -590,8 +726,11 @@ def workday_update(db: Session,
         workday.harvest_id = data.harvest_id
         workday.employee_id = data.employee_id
         workday.fruit = harvest_m.fruit
+        season_id = harvest_m.season_id
 
     db.add(workday)
+    deltas.workday(workday, season_id)
+    deltas.apply(db)
     db.commit()
     db.refresh(workday)
     return workday
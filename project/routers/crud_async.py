@@ -0,0 +1,96 @@
+"""
+Async versions of crud functions for routes using AsyncSession (see dependencies.get_async_db).
+Each one runs the sync crud function through AsyncSession.run_sync, which executes it on the session's
+asyncio connection in a greenlet, so queries don't block the event loop or take threadpool threads,
+and sync and async routes share the same filtering, validation and rollup code.
+Results are loaded before being returned, but relationships not loaded by crud functions
+can't be lazy loaded outside of run_sync - use response models with plain columns or load them there
+"""
+from typing import AsyncIterator, List, Optional
+
+from fastapi import HTTPException, status
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from project.data import models as m, schemas as sc
+from . import crud
+
+
+# SEASONS ===============================================================================================
+async def season_get(db: AsyncSession, user: m.User, **filters) -> List[m.Season]:
+    return await db.run_sync(crud.season_get, user, **filters)
+
+
+# HARVESTS ======================================================================================
+async def harvest_create(db: AsyncSession, user: m.User, year: int, data: sc.HarvestCreate) -> m.Harvest:
+    return await db.run_sync(crud.harvest_create, user, year, data)
+
+
+async def harvests_get(db: AsyncSession, user: m.User, **filters) -> List[m.Harvest]:
+    return await db.run_sync(crud.harvests_get, user, **filters)
+
+
+async def harvest_update(db: AsyncSession, user: m.User, id: int, data: sc.HarvestUpdate) -> m.Harvest:
+    return await db.run_sync(crud.harvest_update, user, id, data)
+
+
+# EMPLOYEES ======================================================================================
+async def employee_create(db: AsyncSession, user: m.User, year: int, data: sc.EmployeeCreate) -> m.Employee:
+    return await db.run_sync(crud.employee_create, user, year, data)
+
+
+async def employees_get(db: AsyncSession, user: m.User, **filters) -> List[m.Employee]:
+    return await db.run_sync(crud.employees_get, user, **filters)
+
+
+async def employee_update(db: AsyncSession, user: m.User, id: int, data: sc.EmployeeUpdate) -> m.Employee:
+    return await db.run_sync(crud.employee_update, user, id, data)
+
+
+# EXPENSES ======================================================================================
+async def expense_create(db: AsyncSession, year: int, user: m.User, data: sc.ExpenseCreate) -> m.Expense:
+    return await db.run_sync(crud.expense_create, year, user, data)
+
+
+async def expenses_get(db: AsyncSession, user: m.User, **filters) -> List[m.Expense]:
+    return await db.run_sync(crud.expenses_get, user, **filters)
+
+
+async def expense_update(db: AsyncSession, id: int, user: m.User, data: sc.ExpenseUpdate) -> m.Expense:
+    return await db.run_sync(crud.expense_update, id, user, data)
+
+
+# WORKDAYS ======================================================================================
+async def workday_create(db: AsyncSession, user: m.User, data: sc.WorkdayCreate,
+                         h_id: Optional[int] = None, e_id: Optional[int] = None) -> m.Workday:
+    return await db.run_sync(crud.workday_create, user, data, h_id, e_id)
+
+
+async def workdays_get(db: AsyncSession, user: m.User, **filters) -> List[m.Workday]:
+    return await db.run_sync(crud.workdays_get, user, **filters)
+
+
+async def workdays_stream(db: AsyncSession, user: m.User, batch_size: int = 500,
+                          **filters) -> AsyncIterator[List[m.Workday]]:
+    """
+    Async counterpart of crud.query_stream for workdays: the query built by crud.workdays_query
+    is read from a server-side cursor in batches, 404 is raised before the first batch is returned
+    """
+    query = await db.run_sync(lambda session: crud.workdays_query(session, user, **filters))
+    result = await db.stream(query.statement.execution_options(yield_per=batch_size))
+    batches = result.scalars().partitions()
+    try:
+        first = await batches.__anext__()
+    except StopAsyncIteration:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail="Couldn't find Workday with specified parameters")
+
+    async def all_batches():
+        yield first
+        async for batch in batches:
+            yield batch
+    return all_batches()
+
+
+async def workday_update(db: AsyncSession, user: m.User, id: int, data: sc.WorkdayUpdate) -> m.Workday:
+    return await db.run_sync(crud.workday_update, user, id, data)
@@ -1,18 +1,18 @@
 import csv
-import os
 import tempfile
 import zipfile
 from typing import List, Optional
 
-from fastapi import APIRouter, Depends, HTTPException, status, Query, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Request, Response
 from sqlalchemy.orm import Session
-from starlette.responses import FileResponse
 
-from project.auth import get_current_active_user
-from project.data import models as m, schemas as sc
+from project import cache
+from project.auth import get_current_user_identity, UserIdentity
+from project.data import schemas as sc
 from project.dependencies import get_db, after_before, price_harvested_more_less, limit_offset, order_by_query
-from . import crud
-from ..additional import delete_temp_files, create_temp_csv
+from . import crud, pagination, reports
+from .rollups import RollupDeltas
+from ..additional import csv_zip_response, ndjson_response, stream_ndjson, wants_ndjson
 
 router = APIRouter(
     prefix="/harvests",
@@ -22,7 +22,8 @@ router = APIRouter(
 
 @router.get("/", status_code=status.HTTP_200_OK,
             response_model=List[sc.HarvestResponseALL])
-def harvests_get_all(user: m.User = Depends(get_current_active_user),
+def harvests_get_all(request: Request, response: Response,
+                     user: UserIdentity = Depends(get_current_user_identity),
                      db: Session = Depends(get_db),
                      year: Optional[str] = Query(None, min_length=4, max_length=4, regex=r"^ *\d[\d ]*$"),
                      season_id: Optional[str] = Query(None, regex=r"^ *\d[\d ]*$"),
@@ -30,16 +31,32 @@ def harvests_get_all(user: m.User = Depends(get_current_active_user),
                      after_before_qp=Depends(after_before),
                      price_harvested_qp=Depends(price_harvested_more_less),
                      limit_offset_qp=Depends(limit_offset),
-                     order_by_qp=Depends(order_by_query)):
-    return crud.harvests_get(db, user, fruit=fruit, year=year, season_id=season_id,
-                             **after_before_qp, **price_harvested_qp, **limit_offset_qp,
-                             **order_by_qp)
+                     order_by_qp=Depends(order_by_query),
+                     data_format: Optional[str] = Query('json', min_length=3, max_length=6)):
+    if data_format not in ('json', 'ndjson'):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Data format must be 'json' or 'ndjson', not '{data_format}'")
+    ndjson = wants_ndjson(request, data_format)
+    page_qp = pagination.stream_limit_offset(request, limit_offset_qp) if ndjson else limit_offset_qp
+    etag = cache.check_etag(request, response, user.id, cache.data_version(db, user.id),
+                            representation=(ndjson, page_qp['limit']), vary='Accept')
+    if ndjson:
+        harvests = crud.query_stream(crud.harvests_query(db, user, fruit=fruit, year=year, season_id=season_id,
+                                                         **after_before_qp, **price_harvested_qp, **order_by_qp,
+                                                         **page_qp),
+                                     'Harvest')
+        return ndjson_response(stream_ndjson(harvests), headers={'ETag': etag, 'Vary': 'Accept'})
+    harvests = crud.harvests_get(db, user, fruit=fruit, year=year, season_id=season_id,
+                                 **after_before_qp, **price_harvested_qp, **limit_offset_qp,
+                                 **order_by_qp)
+    pagination.set_next_link(request, response, harvests, crud.HARVEST_ORDERS, order_by_qp, limit_offset_qp)
+    return harvests
 
 
 @router.get("/{h_id}", status_code=status.HTTP_200_OK,
             response_model=sc.HarvestResponseALL)
 def harvests_get_id(h_id: int,
-                    user: m.User = Depends(get_current_active_user),
+                    user: UserIdentity = Depends(get_current_user_identity),
                     db: Session = Depends(get_db)):
     try:
         return crud.harvests_get(db, user, id=h_id)[0]
@@ -50,9 +67,12 @@ def harvests_get_id(h_id: int,
 @router.delete("/{h_id}", status_code=status.HTTP_200_OK,
                response_model=None)
 def harvests_delete(h_id: int,
-                    user: m.User = Depends(get_current_active_user),
+                    user: UserIdentity = Depends(get_current_user_identity),
                     db: Session = Depends(get_db)):
     harvest_m = crud.harvests_get(db, user, id=h_id)[0]
+    deltas = RollupDeltas()
+    deltas.harvest(harvest_m, -1)
+    deltas.apply(db)
     db.delete(harvest_m)
     db.commit()
 
@@ -61,7 +81,7 @@ def harvests_delete(h_id: int,
               response_model=sc.HarvestResponse)
 def harvests_update(h_id: int,
                     harvest_data: sc.HarvestUpdate,
-                    user: m.User = Depends(get_current_active_user),
+                    user: UserIdentity = Depends(get_current_user_identity),
                     db: Session = Depends(get_db)):
     harvest_m_updated = crud.harvest_update(db=db, user=user, id=h_id, data=harvest_data)
     return harvest_m_updated
@@ -69,83 +89,85 @@ def harvests_update(h_id: int,
 
 @router.get("/{h_id}/employees", status_code=status.HTTP_200_OK)
 def harvests_get_employees(h_id: int,
-                           user: m.User = Depends(get_current_active_user),
+                           request: Request, response: Response,
+                           user: UserIdentity = Depends(get_current_user_identity),
                            db: Session = Depends(get_db),
                            after_before_qp=Depends(after_before),
                            limit_offset_qp=Depends(limit_offset),
                            order_by_qp=Depends(order_by_query),
                            name: Optional[str] = Query(None, min_length=2, max_length=10, regex=r"[a-zA-Z]+"),):
-    return crud.employees_get(db=db, user=user, harvest_id=h_id, name=name,
-                              **after_before_qp, **limit_offset_qp, **order_by_qp)
+    employees = crud.employees_get(db=db, user=user, harvest_id=h_id, name=name,
+                                   **after_before_qp, **limit_offset_qp, **order_by_qp)
+    pagination.set_next_link(request, response, employees, crud.EMPLOYEE_ORDERS, order_by_qp, limit_offset_qp)
+    return employees
 
 
 @router.get("/{h_id}/workdays", status_code=status.HTTP_200_OK,
             response_model=List[sc.WorkdayResponse])
 def harvests_get_workdays(h_id: int,
-                          user: m.User = Depends(get_current_active_user),
+                          request: Request, response: Response,
+                          user: UserIdentity = Depends(get_current_user_identity),
                           db: Session = Depends(get_db),
                           fruit: Optional[str] = Query(None, min_length=5, max_length=20),
                           price_harvested_qp=Depends(price_harvested_more_less),
                           limit_offset_qp=Depends(limit_offset),
                           order_by_qp=Depends(order_by_query)):
-    return crud.workdays_get(db=db, user=user, h_id=h_id,
-                             fruit=fruit, **price_harvested_qp, **limit_offset_qp, **order_by_qp)
+    workdays = crud.workdays_get(db=db, user=user, h_id=h_id,
+                                 fruit=fruit, **price_harvested_qp, **limit_offset_qp, **order_by_qp)
+    pagination.set_next_link(request, response, workdays, crud.WORKDAY_ORDERS, order_by_qp, limit_offset_qp)
+    return workdays
 
 
 @router.post("/{h_id}/workdays", status_code=status.HTTP_201_CREATED,
              response_model=sc.WorkdayResponse)
 def harvests_post_workday(h_id: int,
                           workday_data: sc.WorkdayCreate,
-                          user: m.User = Depends(get_current_active_user),
+                          user: UserIdentity = Depends(get_current_user_identity),
                           db: Session = Depends(get_db)):
     return crud.workday_create(db=db, user=user, data=workday_data, h_id=h_id)
 
 
+@router.post("/{h_id}/workdays/bulk", status_code=status.HTTP_201_CREATED,
+             response_model=List[sc.WorkdayResponse])
+def harvests_post_workdays_bulk(h_id: int,
+                                workdays_data: List[sc.WorkdayBulkItem],
+                                user: UserIdentity = Depends(get_current_user_identity),
+                                db: Session = Depends(get_db)):
+    return crud.workdays_create_bulk(db=db, user=user, h_id=h_id, data=workdays_data)
+
+
 @router.get("/{h_id}/summary", status_code=status.HTTP_200_OK)
 def harvests_get_summary(h_id: int,
-                         user: m.User = Depends(get_current_active_user),
+                         request: Request, response: Response,
+                         user: UserIdentity = Depends(get_current_user_identity),
                          db: Session = Depends(get_db)):
+    cache.check_etag(request, response, user.id, cache.data_version(db, user.id))
     harvest = crud.harvests_get(db, user=user, id=h_id)[0]
-    summary = {
-        "id": harvest.id,
-        "date": harvest.date,
-        "fruit": harvest.fruit,
-        "harvested_all": harvest.harvested,
-        "harvested_by_employees": harvest.harvested_by_employees,
-        "self_harvested": harvest.self_harvested,
-        "price_per_kg": harvest.price,
-        "avg_pay_per_kg": harvest.avg_pay_per_kg,
-        "total_profits": harvest.total_profits,
-        "harvested_by_emp_profits": harvest.harvested_by_employees * harvest.price,
-        "self_harvested_profits": harvest.self_harvested_profits,
-        "total_paid": harvest.harvested_by_employees * harvest.avg_pay_per_kg,
-        "net_profit": harvest.net_profit,
-        "best_employee": harvest.best_employee,
-        "harvested_per_emp": harvest.harvested_per_employee
-    }
+    key = ('harvest-summary', user.id, harvest.id, cache.data_version(db, user.id, harvest.season_id))
+    summary = cache.summary_cache.get(key)
+    if summary is None:
+        summary = reports.harvest_summary(db, harvest)
+        cache.summary_cache.set(key, summary)
     return summary
 
 
 @router.get("/{h_id}/employees-summary", status_code=status.HTTP_200_OK)
-def harvests_get_harvest_employees_summary(background_tasks: BackgroundTasks,
-                                           h_id: int,
-                                           user: m.User = Depends(get_current_active_user),
+def harvests_get_harvest_employees_summary(h_id: int,
+                                           request: Request, response: Response,
+                                           user: UserIdentity = Depends(get_current_user_identity),
                                            db: Session = Depends(get_db),
                                            data_format: str = Query('json', min_length=3, max_length=4)):
     if data_format not in ('json', 'csv'):
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail=f"Data format must be 'json' or 'csv', not '{data_format}'")
+    etag = cache.check_etag(request, response, user.id, cache.data_version(db, user.id))
     harvest = crud.harvests_get(db=db, user=user, id=h_id)[0]
     if not harvest.harvested_per_employee:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"Harvest with id {h_id} has no registered employees")
     if data_format == 'csv':
         filename = f"{harvest.fruit}_harvest_{harvest.id}_{harvest.date}_employees"
-        compressed_file, tmp_dir = create_temp_csv(data=harvest.harvested_per_employee,
-                                                   filename=filename,
-                                                   column_names=harvest.harvested_per_employee[0].keys())
-        background_tasks.add_task(delete_temp_files, tmp_dir)
-        return FileResponse(path=os.path.join(tmp_dir, compressed_file), filename=compressed_file,
-                            media_type='application/zip')
+        return csv_zip_response(harvest.harvested_per_employee, filename=filename,
+                                column_names=harvest.harvested_per_employee[0].keys(), headers={'ETag': etag})
     else:
         return harvest.harvested_per_employee
@@ -0,0 +1,312 @@
+"""
+Import of harvests, employees, expenses and workdays of a season from CSV or NDJSON files.
+Rows are validated with the same schemas and date rules as single-row endpoints, valid ones
+are written in chunks with executemany inserts, and invalid ones are reported by line
+instead of failing the whole file:
+
+    python -m project.routers.imports --username farmer --year 2015 --kind harvests harvests_2015.csv
+"""
+import argparse
+import csv
+import json
+import os
+import re
+from collections import defaultdict
+from itertools import chain
+from typing import Iterable, Iterator, Tuple, Union
+
+from fastapi import HTTPException
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from project import cache
+from project.data import models as m, schemas as sc
+from .crud import season_get
+from .rollups import RollupDeltas
+from .validations import validate_date_in_bounds, validate_date_in_season_bounds
+
+IMPORT_KINDS = ('harvests', 'employees', 'expenses', 'workdays')
+IMPORT_FORMATS = ('csv', 'ndjson')
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", 1000))
+IMPORT_MAX_ERRORS = 1000
+# error handler for decoding files, keeps undecodable bytes as lone surrogates so their lines can be reported
+IMPORT_DECODE_ERRORS = "surrogateescape"
+_UNDECODABLE = re.compile("[\udc80-\udcff]")
+
+
+class ImportRowError(ValueError):
+    """Raised for a row that can't be imported, message is shown in the error report"""
+
+
+def read_rows(lines: Iterable[str], data_format: str) -> Iterator[Tuple[int, Union[dict, ImportRowError]]]:
+    """
+    Parse lines of CSV file with header or NDJSON file lazily.
+    Empty CSV values are read as missing. Rows that can't be parsed or contain bytes
+    that aren't valid UTF-8 are yielded as errors
+
+    :param lines: lines of file decoded with IMPORT_DECODE_ERRORS error handler
+    :param data_format: 'csv' or 'ndjson'
+    :return: iterator over (line number, row or error) pairs
+    """
+    if data_format not in IMPORT_FORMATS:
+        raise ValueError(f"Data format must be one of {IMPORT_FORMATS}, not {data_format}")
+    if data_format == 'ndjson':
+        for line_n, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            if _UNDECODABLE.search(line):
+                yield line_n, ImportRowError("Line is not valid UTF-8")
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_n, ImportRowError(f"Invalid JSON: {e}")
+                continue
+            yield line_n, row if isinstance(row, dict) else ImportRowError("Row must be a JSON object")
+        return
+    reader = csv.DictReader(lines)
+    for row in reader:
+        if None in row:
+            yield reader.line_num, ImportRowError("Row has more values than the header")
+            continue
+        if any(_UNDECODABLE.search(value) for value in chain(row.keys(), row.values()) if value):
+            yield reader.line_num, ImportRowError("Row is not valid UTF-8")
+            continue
+        yield reader.line_num, {k.strip(): v if v != "" else None for k, v in row.items()}
+
+
+def _validated(schema, row: dict) -> BaseModel:
+    try:
+        return schema(**row)
+    except ValidationError as e:
+        raise ImportRowError("; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}"
+                                       for error in e.errors())) from e
+
+
+def _in_season(season: m.Season, name: str, start, end=None) -> None:
+    try:
+        validate_date_in_season_bounds(o_start=start, o_end=end, o_name=name,
+                                       s_start=season.start_date, s_end=season.end_date)
+    except HTTPException as e:
+        raise ImportRowError(e.detail) from e
+
+
+class SeasonImport:
+    """
+    Import of one kind of rows into a season of a user. Rows are validated as they are added
+    and written once a chunk is collected, each chunk in its own transaction together with
+    its season rollup changes and data version bump. Rows of a chunk the database rejects
+    are reported as failed
+    """
+
+    def __init__(self, db: Session, user: m.User, season: m.Season, kind: str,
+                 chunk_size: int = IMPORT_CHUNK_SIZE):
+        if kind not in IMPORT_KINDS:
+            raise ValueError(f"Kind must be one of {IMPORT_KINDS}, not {kind}")
+        self.db = db
+        self.user = user
+        self.season = season
+        self.kind = kind
+        self.chunk_size = chunk_size
+        self.chunk = []
+        self.chunk_lines = []
+        self.report = {"kind": kind, "season_id": season.id, "rows": 0, "imported": 0, "failed": 0, "errors": []}
+        if kind == 'harvests':
+            # harvests are unique by date and fruit across all users
+            taken = db.query(m.Harvest.date, m.Harvest.fruit).filter(m.Harvest.date >= season.start_date)
+            if season.end_date:
+                taken = taken.filter(m.Harvest.date <= season.end_date)
+            self.taken = set(taken.all())
+        if kind == 'workdays':
+            self._load_season_harvests_employees()
+
+    def _load_season_harvests_employees(self) -> None:
+        db, season = self.db, self.season
+        self.harvests = {h.id: h for h in db.query(m.Harvest.id, m.Harvest.date, m.Harvest.fruit, m.Harvest.harvested)
+                         .filter(m.Harvest.season_id == season.id, m.Harvest.owner_id == self.user.id)}
+        self.harvest_ids = {(h.date.isoformat(), h.fruit): h.id for h in self.harvests.values()}
+        self.employees = {e.id: e for e in db.query(m.Employee.id, m.Employee.name,
+                                                    m.Employee.start_date, m.Employee.end_date)
+                          .filter(m.Employee.season_id == season.id, m.Employee.employer_id == self.user.id)}
+        self.employee_ids = defaultdict(list)
+        for e in self.employees.values():
+            self.employee_ids[e.name].append(e.id)
+        self.harvested = defaultdict(int, db.query(m.Workday.harvest_id, func.sum(m.Workday.harvested))
+                                     .join(m.Harvest, m.Harvest.id == m.Workday.harvest_id)
+                                     .filter(m.Harvest.season_id == season.id)
+                                     .group_by(m.Workday.harvest_id).all())
+        asoc = m.harvests_employees_asoc_tab
+        self.assigned = set(db.query(asoc.c.harvest_id, asoc.c.employee_id)
+                            .join(m.Harvest, m.Harvest.id == asoc.c.harvest_id)
+                            .filter(m.Harvest.season_id == season.id).all())
+
+    def add(self, line: int, row: Union[dict, ImportRowError]) -> None:
+        """
+        Validate a row and queue it for writing, or record its error
+
+        :param line: line number of the row in the file
+        :param row: parsed row or parsing error
+        :return: None
+        """
+        self.report["rows"] += 1
+        try:
+            if isinstance(row, ImportRowError):
+                raise row
+            self.chunk.append(getattr(self, f"_{self.kind}_row")(row))
+        except ImportRowError as e:
+            self._fail(line, str(e))
+            return
+        self.chunk_lines.append(line)
+        if len(self.chunk) >= self.chunk_size:
+            self.flush()
+
+    def _fail(self, line: int, error: str) -> None:
+        self.report["failed"] += 1
+        if len(self.report["errors"]) < IMPORT_MAX_ERRORS:
+            self.report["errors"].append({"line": line, "error": error})
+
+    def _harvests_row(self, row: dict) -> dict:
+        data: sc.HarvestBase = _validated(sc.HarvestBase, row)
+        _in_season(self.season, "Harvest", data.date, data.date)
+        if (data.date, data.fruit.value) in self.taken:
+            raise ImportRowError(f"Harvest of {data.fruit.value} on {data.date} already exists")
+        self.taken.add((data.date, data.fruit.value))
+        return {"date": data.date, "fruit": data.fruit.value, "harvested": data.harvested, "price": data.price,
+                "season_id": self.season.id, "owner_id": self.user.id}
+
+    def _employees_row(self, row: dict) -> dict:
+        data: sc.EmployeeCreate = _validated(sc.EmployeeCreate, row)
+        _in_season(self.season, "Employee", data.start_date, data.end_date)
+        return {"name": data.name, "start_date": data.start_date, "end_date": data.end_date,
+                "season_id": self.season.id, "employer_id": self.user.id}
+
+    def _expenses_row(self, row: dict) -> dict:
+        data: sc.ExpenseCreate = _validated(sc.ExpenseCreate, row)
+        _in_season(self.season, "Expense", data.date)
+        return {"type": data.type, "date": data.date, "amount": data.amount,
+                "season_id": self.season.id, "owner_id": self.user.id}
+
+    def _workdays_row(self, row: dict) -> dict:
+        """Harvest is given by harvest_id or harvest_date and fruit, employee by employee_id or employee_name"""
+        data: sc.WorkdayCreate = _validated(sc.WorkdayCreate, row)
+        harvest_id = data.harvest_id or self.harvest_ids.get((row.get("harvest_date"), row.get("fruit")))
+        if harvest_id not in self.harvests:
+            raise ImportRowError("Couldn't find Harvest of the row in the season")
+        employee_id = data.employee_id
+        if employee_id is None and len(self.employee_ids.get(row.get("employee_name"), ())) > 1:
+            raise ImportRowError(f"More than one Employee named {row.get('employee_name')}, use employee_id")
+        if employee_id is None and row.get("employee_name") in self.employee_ids:
+            employee_id = self.employee_ids[row["employee_name"]][0]
+        if employee_id not in self.employees:
+            raise ImportRowError("Couldn't find Employee of the row in the season")
+        harvest, employee = self.harvests[harvest_id], self.employees[employee_id]
+        if not validate_date_in_bounds(bounds_start=employee.start_date, bounds_end=employee.end_date,
+                                       start_date=harvest.date):
+            raise ImportRowError(f"Incompatible dates: harvest date {harvest.date}"
+                                 f" and employee start: {employee.start_date} or/and end {employee.end_date}")
+        if self.harvested[harvest_id] + data.harvested > harvest.harvested:
+            raise ImportRowError(f"Harvested in workdays would exceed harvested amount"
+                                 f" of the Harvest ({harvest.harvested})")
+        self.harvested[harvest_id] += data.harvested
+        return {"harvest_id": harvest_id, "employee_id": employee_id, "employer_id": self.user.id,
+                "fruit": harvest.fruit, "harvested": data.harvested, "pay_per_kg": data.pay_per_kg}
+
+    def flush(self) -> None:
+        """
+        Write queued rows with their rollup changes and commit.
+        If the database rejects the chunk it's rolled back and its rows are reported as failed
+
+        :return: None
+        """
+        if not self.chunk:
+            return
+        try:
+            self._write_chunk()
+        except IntegrityError as e:
+            self.db.rollback()
+            self._forget_chunk()
+            for line in self.chunk_lines:
+                self._fail(line, f"Row couldn't be written: {e.orig}")
+        else:
+            self.report["imported"] += len(self.chunk)
+        self.chunk = []
+        self.chunk_lines = []
+
+    def _write_chunk(self) -> None:
+        model = {'harvests': m.Harvest, 'employees': m.Employee,
+                 'expenses': m.Expense, 'workdays': m.Workday}[self.kind]
+        self.db.bulk_insert_mappings(model, self.chunk)
+        deltas = RollupDeltas()
+        if self.kind == 'harvests':
+            for mapping in self.chunk:
+                deltas.harvest(m.Harvest(**mapping), with_workdays=False)
+        elif self.kind == 'expenses':
+            for mapping in self.chunk:
+                deltas.expense(m.Expense(**mapping))
+        elif self.kind == 'workdays':
+            pairs = {(w["harvest_id"], w["employee_id"]) for w in self.chunk} - self.assigned
+            if pairs:
+                self.db.execute(m.harvests_employees_asoc_tab.insert(),
+                                [{"harvest_id": h_id, "employee_id": e_id} for h_id, e_id in pairs])
+            for mapping in self.chunk:
+                deltas.workday(m.Workday(**mapping), self.season.id)
+        deltas.apply(self.db)
+        cache.bump_data_versions(self.db, [(self.user.id, self.season.id)])
+        self.db.commit()
+        if self.kind == 'workdays':
+            self.assigned |= pairs
+
+    def _forget_chunk(self) -> None:
+        """Undo what validation of rows of a rolled back chunk recorded, so later rows are checked against the db"""
+        if self.kind == 'harvests':
+            self.taken -= {(mapping["date"], mapping["fruit"]) for mapping in self.chunk}
+        elif self.kind == 'workdays':
+            for mapping in self.chunk:
+                self.harvested[mapping["harvest_id"]] -= mapping["harvested"]
+
+
+def import_rows(db: Session, user: m.User, year: int, kind: str,
+                rows: Iterable[Tuple[int, Union[dict, ImportRowError]]],
+                chunk_size: int = IMPORT_CHUNK_SIZE) -> dict:
+    """
+    Import rows into a season of the user, skipping invalid ones
+
+    :param db: database session, committed once per chunk
+    :param user: owner of the season
+    :param year: year of the season
+    :param kind: one of IMPORT_KINDS
+    :param rows: (line number, row) pairs, as returned by read_rows()
+    :param chunk_size: number of rows written with one executemany insert
+    :return: report with numbers of read, imported and failed rows and errors of failed rows
+    """
+    season_m: m.Season = season_get(db=db, user=user, year=year)[0]
+    season_import = SeasonImport(db, user, season_m, kind, chunk_size)
+    for line, row in rows:
+        season_import.add(line, row)
+    season_import.flush()
+    return season_import.report
+
+
+if __name__ == "__main__":
+    from project.data.database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Import harvests, employees, expenses or workdays of a season")
+    parser.add_argument("file", help="CSV file with header or NDJSON file")
+    parser.add_argument("--username", required=True, help="owner of the season")
+    parser.add_argument("--year", type=int, required=True, help="year of the season")
+    parser.add_argument("--kind", choices=IMPORT_KINDS, required=True)
+    parser.add_argument("--data-format", choices=IMPORT_FORMATS,
+                        help="format of the file, by default ndjson for .ndjson and .jsonl files, else csv")
+    parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE)
+    args = parser.parse_args()
+    data_format = args.data_format or ('ndjson' if args.file.endswith(('.ndjson', '.jsonl')) else 'csv')
+    db: Session = SessionLocal()
+    try:
+        user = db.query(m.User).filter(m.User.username == args.username).one()
+        with open(args.file, encoding="utf-8-sig", errors=IMPORT_DECODE_ERRORS, newline="") as file:
+            report = import_rows(db, user, args.year, args.kind, read_rows(file, data_format), args.chunk_size)
+        print(json.dumps(report, indent=2))
+    finally:
+        db.close()
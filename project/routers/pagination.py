@@ -0,0 +1,144 @@
+import base64
+import binascii
+import datetime
+import decimal
+import json
+from typing import Any, Optional, Tuple
+
+from fastapi import HTTPException, Request, Response, status
+from sqlalchemy import and_, or_, tuple_
+from sqlalchemy.orm import Query
+
+
+def _dump_value(value: Any) -> Any:
+    if isinstance(value, (datetime.date, decimal.Decimal)):
+        return str(value)
+    return value
+
+
+def _load_value(value: Any, column) -> Any:
+    if value is None:
+        return None
+    python_type = column.type.python_type
+    if python_type is datetime.date:
+        return datetime.date.fromisoformat(value)
+    return python_type(value)
+
+
+def encode_cursor(order_by: Optional[str], order: str, value: Any, id: int) -> str:
+    """
+    Create opaque cursor pointing right after given row of a list ordered by given column and id
+
+    :param order_by: ordering parameter of the list
+    :param order: desc(ending) or asc(ending) order of the list
+    :param value: value of ordering column in the last returned row
+    :param id: id of the last returned row
+    :return: url-safe cursor
+    """
+    payload = json.dumps([order_by or '', order, _dump_value(value), id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, order_by: Optional[str], order: str, column) -> Tuple[Any, int]:
+    """
+    Read cursor created by encode_cursor. Raise 400 if it's malformed or was created for different ordering
+
+    :param cursor: cursor from query parameters
+    :param order_by: ordering parameter of current request
+    :param order: order of current request
+    :param column: column list is ordered by, None if ordered only by id
+    :return: value of ordering column and id of the last row of previous page
+    """
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        cursor_order_by, cursor_order, value, id = payload
+        if (cursor_order_by, cursor_order) != (order_by or '', order) or not isinstance(id, int):
+            raise ValueError("Cursor doesn't match ordering")
+        return (_load_value(value, column) if column is not None else None), id
+    except (ValueError, TypeError, binascii.Error, decimal.InvalidOperation) as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Invalid cursor, cursors can be used only with ordering they were created for") from e
+
+
+def _after_cursor(column, id_column, value: Any, last_id: int, descending: bool):
+    id_after = id_column < last_id if descending else id_column > last_id
+    if column is None:
+        return id_after
+    if value is None:
+        return and_(column.is_(None), id_after)
+    # row value comparison can be answered with a range scan of (column, id) index
+    row = tuple_(column, id_column)
+    after = row < tuple_(value, last_id) if descending else row > tuple_(value, last_id)
+    # nulls are ordered last, so they come after any value
+    return or_(after, column.is_(None)) if column.nullable else after
+
+
+def paginate(query: Query, orders: dict, id_column, order_by: Optional[str], order: str,
+             limit: Optional[int] = None, offset: Optional[int] = None, cursor: Optional[str] = None) -> Query:
+    """
+    Order query by given ordering parameter with id as tiebreaker, nulls last, and apply requested page.
+    With cursor rows after the cursor are selected by keyset condition and offset is ignored,
+    so deep pages don't scan skipped rows
+
+    :param query: query to paginate
+    :param orders: dict of allowed parameters to order by ex: {'year': Season.year}, validated beforehand
+    :param id_column: primary key column of queried model
+    :param order_by: ordering parameter, if empty query is ordered by id ascending
+    :param order: desc(ending) or asc(ending) order
+    :param limit: max number of rows
+    :param offset: number of rows to skip, used only without cursor
+    :param cursor: cursor from previous page
+    :return: paginated query
+    """
+    column = orders[order_by] if order_by else None
+    descending = column is not None and order == 'desc'
+    if cursor:
+        value, last_id = decode_cursor(cursor, order_by, order, column)
+        query = query.filter(_after_cursor(column, id_column, value, last_id, descending))
+    if column is not None:
+        query = query.order_by(column.desc().nullslast() if descending else column.asc().nullslast())
+    query = query.order_by(id_column.desc() if descending else id_column.asc())
+    if offset and not cursor:
+        query = query.offset(offset)
+    if limit:
+        query = query.limit(limit)
+    return query
+
+
+def set_next_link(request: Request, response: Response, items: list, orders: dict,
+                  order_by_qp: dict, limit_offset_qp: dict) -> None:
+    """
+    Set Link header with url of the next page on the response if returned page is full
+
+    :param request: current request
+    :param response: response the header is set on
+    :param items: returned objects or dicts with their columns
+    :param orders: dict of allowed parameters to order by, the same as passed to paginate
+    :param order_by_qp: ordering query parameters
+    :param limit_offset_qp: paging query parameters
+    :return: None
+    """
+    limit = limit_offset_qp.get('limit')
+    if not items or not limit or len(items) < limit:
+        return
+    last = items[-1]
+    get = last.get if isinstance(last, dict) else lambda key: getattr(last, key)
+    order_by, order = order_by_qp.get('order_by'), order_by_qp.get('order')
+    value = get(orders[order_by].key) if order_by else None
+    cursor = encode_cursor(order_by, order, value, get('id'))
+    url = request.url.remove_query_params('offset').include_query_params(cursor=cursor)
+    response.headers['Link'] = f'<{url}>; rel="next"'
+
+
+def stream_limit_offset(request: Request, limit_offset_qp: dict) -> dict:
+    """
+    Paging query parameters of a streamed list, which includes all rows after offset or cursor
+    unless limit is given explicitly
+
+    :param request: current request
+    :param limit_offset_qp: paging query parameters
+    :return: paging query parameters without default limit
+    """
+    if 'limit' in request.query_params:
+        return limit_offset_qp
+    return {**limit_offset_qp, 'limit': None}
@@ -0,0 +1,309 @@
+from typing import Dict, List
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from project.data import models as m
+from .rollups import rollups_get
+
+
+def _to_float(value) -> float:
+    return float(value or 0)
+
+
+def seasons_stats(db: Session, season_ids: List[int]) -> Dict[int, dict]:
+    """
+    Compute figures used in season summaries from season rollups and grouped SQL queries
+    instead of walking every harvest, employee and workday through model properties
+
+    :param db: database session
+    :param season_ids: ids of seasons to compute figures for
+    :return: dict of figures keyed by season id
+    """
+    stats = {s_id: {'fruits': set(),
+                    'harvested_per_fruit': {},
+                    'value_per_fruit': {},
+                    'harvests_n': 0,
+                    'total_harvested_value': 0.0,
+                    'best_harvest': {'id': 0, 'date': '', 'fruit': '', 'harvested_value': 0},
+                    'employees_n': 0,
+                    'best_employee': {'id': 0, 'name': '', 'total_harvested': 0},
+                    'best_employees_per_fruit': {},
+                    'total_employee_payments': 0.0,
+                    'total_expenses_value': 0.0} for s_id in season_ids}
+    if not season_ids:
+        return stats
+
+    for rollup in rollups_get(db, season_ids):
+        s = stats[rollup.season_id]
+        s['total_employee_payments'] += _to_float(rollup.employee_payout)
+        s['total_expenses_value'] += _to_float(rollup.expenses)
+        if rollup.harvests_n:
+            s['fruits'].add(rollup.fruit)
+            s['harvested_per_fruit'][rollup.fruit] = _to_float(rollup.harvested)
+            s['value_per_fruit'][rollup.fruit] = _to_float(rollup.harvested_value)
+            s['harvests_n'] += rollup.harvests_n
+            s['total_harvested_value'] += _to_float(rollup.harvested_value)
+
+    harvest_value = m.Harvest.harvested * m.Harvest.price
+    max_value = db.query(m.Harvest.season_id.label('season_id'),
+                         func.max(harvest_value).label('value'))\
+        .filter(m.Harvest.season_id.in_(season_ids))\
+        .group_by(m.Harvest.season_id)\
+        .subquery()
+    best_harvests = db.query(m.Harvest.season_id, m.Harvest.id, m.Harvest.date,
+                             m.Harvest.fruit, harvest_value)\
+        .join(max_value, (max_value.c.season_id == m.Harvest.season_id) & (max_value.c.value == harvest_value))\
+        .order_by(m.Harvest.id.desc())
+    # Ordered descending so that the lowest id wins ties, as with max() over season.harvests
+    for season_id, h_id, h_date, fruit, value in best_harvests:
+        stats[season_id]['best_harvest'] = {'id': h_id, 'date': h_date, 'fruit': fruit,
+                                            'harvested_value': _to_float(value)}
+
+    first_employee = {}
+    per_employee = db.query(m.Employee.season_id, m.Employee.id, m.Employee.name,
+                            func.sum(m.Workday.harvested))\
+        .outerjoin(m.Workday, m.Workday.employee_id == m.Employee.id)\
+        .filter(m.Employee.season_id.in_(season_ids))\
+        .group_by(m.Employee.season_id, m.Employee.id, m.Employee.name)\
+        .order_by(m.Employee.id)
+    for season_id, e_id, name, harvested in per_employee:
+        s = stats[season_id]
+        harvested = _to_float(harvested)
+        if not s['employees_n'] or harvested > s['best_employee']['total_harvested']:
+            s['best_employee'] = {'id': e_id, 'name': name, 'total_harvested': harvested}
+        s['employees_n'] += 1
+        first_employee.setdefault(season_id, (e_id, name))
+
+    per_employee_fruit = db.query(m.Employee.season_id, m.Employee.id, m.Employee.name,
+                                  m.Workday.fruit, func.sum(m.Workday.harvested))\
+        .join(m.Workday, m.Workday.employee_id == m.Employee.id)\
+        .filter(m.Employee.season_id.in_(season_ids))\
+        .group_by(m.Employee.season_id, m.Employee.id, m.Employee.name, m.Workday.fruit)\
+        .order_by(m.Employee.id)
+    for season_id, e_id, name, fruit, harvested in per_employee_fruit:
+        best = stats[season_id]['best_employees_per_fruit']
+        harvested = _to_float(harvested)
+        if fruit not in best or harvested > best[fruit]['harvested']:
+            best[fruit] = {'id': e_id, 'name': name, 'harvested': harvested}
+
+    for season_id, s in stats.items():
+        best = s['best_employees_per_fruit']
+        for fruit in s['fruits']:
+            if fruit in best:
+                continue
+            if season_id in first_employee:
+                e_id, name = first_employee[season_id]
+                best[fruit] = {'id': e_id, 'name': name, 'harvested': 0.0}
+            else:
+                best[fruit] = {'id': 0, 'name': ''}
+        s['best_employees_per_fruit'] = {f: best[f] for f in s['fruits']}
+
+    return stats
+
+
+def season_summary(db: Session, season: m.Season) -> dict:
+    stats = seasons_stats(db, [season.id])[season.id]
+    return {
+        'id': season.id,
+        'year': season.year,
+        'start_date': season.start_date,
+        'end_date': season.end_date,
+        'fruits': stats['fruits'],
+        'employees_n': stats['employees_n'],
+        'best_employee': stats['best_employee'],
+        'best_employee_per_fruit': stats['best_employees_per_fruit'],
+        'harvests_n': stats['harvests_n'],
+        'best_harvest': stats['best_harvest'],
+        'total_harvested_value': stats['total_harvested_value'],
+        'total_employee_payments': stats['total_employee_payments'],
+        'harvested_per_fruit': stats['harvested_per_fruit'],
+        'value_per_fruit': stats['value_per_fruit'],
+        'total_expenses_value': stats['total_expenses_value'],
+        'net_profits': stats['total_harvested_value'] - stats['total_employee_payments']
+        - stats['total_expenses_value']
+    }
+
+
+def seasons_summaries(db: Session, seasons: List[m.Season]) -> List[dict]:
+    stats = seasons_stats(db, [s.id for s in seasons])
+    return [{
+        'id': s.id,
+        'year': s.year,
+        'start_date': s.start_date,
+        'end_date': s.end_date,
+        'fruits': stats[s.id]['fruits'],
+        'employees_n': stats[s.id]['employees_n'],
+        'best_employee': stats[s.id]['best_employee']['name'],
+        'harvests_n': stats[s.id]['harvests_n'],
+        'best_harvest': stats[s.id]['best_harvest']['date'],
+        'total_harvested_value': stats[s.id]['total_harvested_value'],
+        'total_employee_payments': stats[s.id]['total_employee_payments'],
+        'total_expenses_value': stats[s.id]['total_expenses_value'],
+        'net_profits': stats[s.id]['total_harvested_value'] - stats[s.id]['total_employee_payments']
+        - stats[s.id]['total_expenses_value']
+    } for s in seasons]
+
+
+def employee_stats(db: Session, employee_id: int) -> dict:
+    """
+    Compute figures used in employee summaries from a single query joining employee's workdays
+    with their harvests, instead of iterating and lazy loading them through model properties
+
+    :param db: database session
+    :param employee_id: id of employee to compute figures for
+    :return: dict of figures
+    """
+    workdays = db.query(m.Harvest.id, m.Harvest.date, m.Workday.fruit,
+                        m.Workday.harvested, m.Workday.pay_per_kg)\
+        .join(m.Harvest, m.Harvest.id == m.Workday.harvest_id)\
+        .filter(m.Workday.employee_id == employee_id)\
+        .order_by(m.Workday.id)
+
+    harvested_per_fruit = {}
+    earned_per_fruit = {}
+    harvests_history = []
+    best_harvest = {}
+    max_harvested = None
+    for h_id, h_date, fruit, harvested, pay_per_kg in workdays:
+        earned = harvested * pay_per_kg
+        harvested_per_fruit[fruit] = harvested_per_fruit.get(fruit, 0) + harvested
+        earned_per_fruit[fruit] = earned_per_fruit.get(fruit, 0) + earned
+        harvests_history.append({"id": h_id,
+                                 "date": h_date,
+                                 "fruit": fruit,
+                                 "harvested": float(harvested),
+                                 "pay_per_kg": float(pay_per_kg),
+                                 "earned": float(earned)})
+        if max_harvested is None or harvested > max_harvested:
+            max_harvested = harvested
+            best_harvest = harvests_history[-1]
+
+    return {'total_harvested': float(sum(harvested_per_fruit.values())),
+            'total_earnings': float(sum(earned_per_fruit.values())),
+            'harvested_per_fruit': {f: float(v) for f, v in harvested_per_fruit.items()},
+            'earned_per_fruit': {f: float(v) for f, v in earned_per_fruit.items()},
+            'best_harvest': best_harvest,
+            'harvests_history': harvests_history}
+
+
+def harvests_stats(db: Session, harvest_ids: List[int]) -> Dict[int, dict]:
+    """
+    Compute workday figures of multiple harvests with one grouped query, joined back to workdays
+    and employees to find the best employee of every harvest
+
+    :param db: database session
+    :param harvest_ids: ids of harvests to compute figures for
+    :return: dict of figures keyed by harvest id
+    """
+    stats = {h_id: {'harvested_by_employees': 0.0,
+                    'total_paid': 0.0,
+                    'avg_pay_per_kg': 0,
+                    'best_employee': {}} for h_id in harvest_ids}
+    if not harvest_ids:
+        return stats
+
+    totals = db.query(m.Workday.harvest_id.label('harvest_id'),
+                      func.sum(m.Workday.harvested).label('harvested'),
+                      func.sum(m.Workday.harvested * m.Workday.pay_per_kg).label('paid'),
+                      func.max(m.Workday.harvested).label('harvested_max'))\
+        .filter(m.Workday.harvest_id.in_(harvest_ids))\
+        .group_by(m.Workday.harvest_id)\
+        .subquery()
+    rows = db.query(totals.c.harvest_id, totals.c.harvested, totals.c.paid,
+                    m.Employee.id, m.Employee.name, m.Workday.harvested, m.Workday.pay_per_kg)\
+        .join(m.Workday, (m.Workday.harvest_id == totals.c.harvest_id)
+              & (m.Workday.harvested == totals.c.harvested_max))\
+        .join(m.Employee, m.Employee.id == m.Workday.employee_id)\
+        .order_by(m.Workday.id.desc())
+    # Ordered descending so that the first workday wins ties, as in Harvest.best_employee
+    for h_id, harvested, paid, e_id, name, e_harvested, pay_per_kg in rows:
+        harvested, paid = _to_float(harvested), _to_float(paid)
+        stats[h_id] = {'harvested_by_employees': harvested,
+                       'total_paid': paid,
+                       'avg_pay_per_kg': paid / harvested if harvested else 0,
+                       'best_employee': {"id": e_id,
+                                         "name": name,
+                                         "harvested": round(float(e_harvested), 2),
+                                         "pay_per_kg": round(float(pay_per_kg), 2),
+                                         "earned": round(float(e_harvested * pay_per_kg), 2)}}
+    return stats
+
+
+def harvest_extended(harvest: m.Harvest, stats: dict) -> dict:
+    """
+    Build extended harvest data from harvest columns and figures computed by harvests_stats()
+
+    :param harvest: harvest object
+    :param stats: figures of given harvest
+    :return: dict with extended harvest data
+    """
+    harvested, price = float(harvest.harvested), float(harvest.price)
+    self_harvested = harvested - stats['harvested_by_employees']
+    return {
+        "id": harvest.id,
+        'season_id': harvest.season_id,
+        'owner_id': harvest.owner_id,
+        "date": harvest.date,
+        "fruit": harvest.fruit,
+        "harvested": harvest.harvested,
+        "harvested_by_employees": stats['harvested_by_employees'],
+        "self_harvested": self_harvested,
+        "price": harvest.price,
+        "avg_pay_per_kg": stats['avg_pay_per_kg'],
+        "total_profits": harvested * price,
+        "harvested_by_emp_profits": stats['harvested_by_employees'] * price,
+        "self_harvested_profits": self_harvested * price,
+        "total_paid": stats['total_paid'],
+        "net_profit": harvested * price - stats['total_paid'],
+        "best_employee": stats['best_employee'],
+    }
+
+
+def harvest_summary(db: Session, harvest: m.Harvest) -> dict:
+    stats = harvests_stats(db, [harvest.id])[harvest.id]
+    extended = harvest_extended(harvest, stats)
+    per_employee = db.query(m.Employee.id, m.Employee.name, m.Workday.harvested, m.Workday.pay_per_kg)\
+        .join(m.Workday, m.Workday.employee_id == m.Employee.id)\
+        .filter(m.Workday.harvest_id == harvest.id)\
+        .order_by(m.Workday.id)
+    return {
+        "id": harvest.id,
+        "date": harvest.date,
+        "fruit": harvest.fruit,
+        "harvested_all": harvest.harvested,
+        "harvested_by_employees": extended['harvested_by_employees'],
+        "self_harvested": extended['self_harvested'],
+        "price_per_kg": harvest.price,
+        "avg_pay_per_kg": extended['avg_pay_per_kg'],
+        "total_profits": extended['total_profits'],
+        "harvested_by_emp_profits": extended['harvested_by_emp_profits'],
+        "self_harvested_profits": extended['self_harvested_profits'],
+        "total_paid": extended['total_paid'],
+        "net_profit": extended['net_profit'],
+        "best_employee": extended['best_employee'],
+        "harvested_per_emp": [{"id": e_id,
+                               "name": name,
+                               "harvested": round(float(harvested), 2),
+                               "pay_per_kg": round(float(pay_per_kg), 2),
+                               "earned": round(float(harvested * pay_per_kg), 2)}
+                              for e_id, name, harvested, pay_per_kg in per_employee]
+    }
+
+
+def employee_summary(db: Session, employee: m.Employee) -> dict:
+    stats = employee_stats(db, employee.id)
+    return {
+        "id": employee.id,
+        'season_id': employee.season_id,
+        'employer_id': employee.employer_id,
+        "name": employee.name,
+        "start_date": employee.start_date,
+        "end_date": employee.end_date,
+        'total_harvested': stats['total_harvested'],
+        "total_earnings": stats['total_earnings'],
+        "harvested_per_fruit": stats['harvested_per_fruit'],
+        "earnings_per_fruit": stats['earned_per_fruit'],
+        'best_harvest': stats['best_harvest'],
+        "harvest_history": stats['harvests_history']
+    }
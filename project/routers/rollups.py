@@ -0,0 +1,124 @@
+import argparse
+import decimal
+from collections import defaultdict
+from typing import Optional, List
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from project.data import models as m
+from project.data.database import upsert_increment
+
+NO_FRUIT = ""
+ROLLUP_COLUMNS = ('harvests_n', 'harvested', 'harvested_value', 'employee_payout', 'workdays_n', 'expenses')
+
+
+def _decimal(value) -> decimal.Decimal:
+    # floats from validated schemas are converted through str, so their binary expansion isn't stored
+    return value if isinstance(value, decimal.Decimal) else decimal.Decimal(str(value))
+
+
+class RollupDeltas:
+    """
+    Collects changes to season rollups caused by a single write, so that each affected
+    season_rollups row is updated with one statement in the transaction of that write.
+    Objects are registered with sign -1 before they are changed or deleted and with sign 1
+    once they are created or changed
+    """
+
+    def __init__(self):
+        self.deltas = defaultdict(lambda: dict.fromkeys(ROLLUP_COLUMNS, 0))
+
+    def harvest(self, harvest: m.Harvest, sign: int = 1, with_workdays: bool = True) -> None:
+        delta = self.deltas[(harvest.season_id, harvest.fruit)]
+        delta['harvests_n'] += sign
+        delta['harvested'] += sign * _decimal(harvest.harvested)
+        delta['harvested_value'] += sign * _decimal(harvest.harvested) * _decimal(harvest.price)
+        if with_workdays:
+            for w in harvest.workdays:
+                self.workday(w, harvest.season_id, sign)
+
+    def workday(self, workday: m.Workday, season_id: int, sign: int = 1) -> None:
+        delta = self.deltas[(season_id, workday.fruit)]
+        delta['workdays_n'] += sign
+        delta['employee_payout'] += sign * _decimal(workday.harvested) * _decimal(workday.pay_per_kg)
+
+    def expense(self, expense: m.Expense, sign: int = 1) -> None:
+        self.deltas[(expense.season_id, NO_FRUIT)]['expenses'] += sign * _decimal(expense.amount)
+
+    def apply(self, db: Session) -> None:
+        """
+        Add collected deltas to season_rollups rows, creating missing rows with an upsert. Doesn't commit
+
+        :param db: database session of the write that caused the changes
+        :return: None
+        """
+        for (season_id, fruit), delta in self.deltas.items():
+            if not any(delta.values()):
+                continue
+            upsert_increment(db, m.SeasonRollup.__table__, {'season_id': season_id, 'fruit': fruit}, delta)
+        self.deltas.clear()
+
+
+def rollups_get(db: Session, season_ids: List[int]) -> List[m.SeasonRollup]:
+    return db.query(m.SeasonRollup).filter(m.SeasonRollup.season_id.in_(season_ids)).all()
+
+
+def rollups_rebuild(db: Session, season_ids: Optional[List[int]] = None) -> int:
+    """
+    Recompute season_rollups rows from harvests, workdays and expenses.
+    Used for backfills and after writes that bypass crud functions. Doesn't commit
+
+    :param db: database session
+    :param season_ids: seasons to rebuild rollups for, all seasons if not given
+    :return: number of rollup rows written
+    """
+    rows = defaultdict(lambda: dict.fromkeys(ROLLUP_COLUMNS, 0))
+
+    harvests = db.query(m.Harvest.season_id, m.Harvest.fruit,
+                        func.count(m.Harvest.id),
+                        func.sum(m.Harvest.harvested),
+                        func.sum(m.Harvest.harvested * m.Harvest.price))\
+        .group_by(m.Harvest.season_id, m.Harvest.fruit)
+    workdays = db.query(m.Harvest.season_id, m.Workday.fruit,
+                        func.count(m.Workday.id),
+                        func.sum(m.Workday.harvested * m.Workday.pay_per_kg))\
+        .join(m.Harvest, m.Harvest.id == m.Workday.harvest_id)\
+        .group_by(m.Harvest.season_id, m.Workday.fruit)
+    expenses = db.query(m.Expense.season_id, func.sum(m.Expense.amount))\
+        .group_by(m.Expense.season_id)
+    deleted = db.query(m.SeasonRollup)
+    if season_ids is not None:
+        harvests = harvests.filter(m.Harvest.season_id.in_(season_ids))
+        workdays = workdays.filter(m.Harvest.season_id.in_(season_ids))
+        expenses = expenses.filter(m.Expense.season_id.in_(season_ids))
+        deleted = deleted.filter(m.SeasonRollup.season_id.in_(season_ids))
+
+    for season_id, fruit, harvests_n, harvested, value in harvests:
+        rows[(season_id, fruit)].update(harvests_n=harvests_n, harvested=harvested or 0,
+                                        harvested_value=value or 0)
+    for season_id, fruit, workdays_n, payout in workdays:
+        rows[(season_id, fruit)].update(workdays_n=workdays_n, employee_payout=payout or 0)
+    for season_id, amount in expenses:
+        rows[(season_id, NO_FRUIT)]['expenses'] = amount or 0
+
+    deleted.delete(synchronize_session=False)
+    db.bulk_insert_mappings(m.SeasonRollup, [dict(season_id=season_id, fruit=fruit, **values)
+                                             for (season_id, fruit), values in rows.items()])
+    return len(rows)
+
+
+if __name__ == "__main__":
+    from project.data.database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Rebuild season rollups from harvests, workdays and expenses")
+    parser.add_argument("--season-id", type=int, action="append", dest="season_ids",
+                        help="season to rebuild, can be given multiple times (default: all seasons)")
+    args = parser.parse_args()
+    db: Session = SessionLocal()
+    try:
+        written = rollups_rebuild(db, args.season_ids)
+        db.commit()
+        print(f"Rebuilt {written} season rollup rows")
+    finally:
+        db.close()
@@ -23,7 +23,7 @@ def validate_date_qp(qp: str) -> datetime.date:
                             detail=str(e)) from e
 
 
-def validate_fruit_qp(qp: str) -> m.Fruit.value:
+def validate_fruit_qp(qp: str) -> str:
     """
     Validate 'fruit' query parameter and return appropriate enum if valid, else raise HTTP Exception
 
@@ -1,12 +1,15 @@
 from typing import List, Optional
 
-from fastapi import APIRouter, Depends, status, Query
+from fastapi import APIRouter, Depends, status, Query, HTTPException, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
-from project.auth import get_current_active_user
+from project.auth import get_current_user_identity, get_current_user_identity_async, UserIdentity
 from project.data import models as m, schemas as sc
-from project.dependencies import get_db, price_harvested_more_less, limit_offset, order_by_query
-from . import crud
+from project.dependencies import get_db, get_async_db, price_harvested_more_less, limit_offset, order_by_query
+from . import crud, crud_async, pagination
+from .rollups import RollupDeltas
+from ..additional import astream_ndjson, ndjson_response, wants_ndjson
 
 router = APIRouter(
     prefix="/workdays",
@@ -16,37 +19,51 @@ router = APIRouter(
 
 @router.get("/", status_code=status.HTTP_200_OK,
             response_model=List[sc.WorkdayResponse])
-def workdays_get_all(user: m.User = Depends(get_current_active_user),
-                     db: Session = Depends(get_db),
-                     price_harvested_qp=Depends(price_harvested_more_less),
-                     fruit: Optional[str] = Query(None, min_length=5, max_length=20),
-                     limit_offset_qp=Depends(limit_offset),
-                     order_by_qp=Depends(order_by_query)):
-    return crud.workdays_get(db=db, user=user, **price_harvested_qp, **limit_offset_qp,
-                             fruit=fruit, **order_by_qp)
+async def workdays_get_all(request: Request, response: Response,
+                           user: UserIdentity = Depends(get_current_user_identity_async),
+                           db: AsyncSession = Depends(get_async_db),
+                           price_harvested_qp=Depends(price_harvested_more_less),
+                           fruit: Optional[str] = Query(None, min_length=5, max_length=20),
+                           limit_offset_qp=Depends(limit_offset),
+                           order_by_qp=Depends(order_by_query),
+                           data_format: Optional[str] = Query('json', min_length=3, max_length=6)):
+    if data_format not in ('json', 'ndjson'):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"Data format must be 'json' or 'ndjson', not '{data_format}'")
+    if wants_ndjson(request, data_format):
+        workdays = await crud_async.workdays_stream(db=db, user=user, **price_harvested_qp, fruit=fruit, **order_by_qp,
+                                                    **pagination.stream_limit_offset(request, limit_offset_qp))
+        return ndjson_response(astream_ndjson(workdays))
+    workdays = await crud_async.workdays_get(db=db, user=user, **price_harvested_qp, **limit_offset_qp,
+                                             fruit=fruit, **order_by_qp)
+    pagination.set_next_link(request, response, workdays, crud.WORKDAY_ORDERS, order_by_qp, limit_offset_qp)
+    return workdays
 
 
 @router.get("/{w_id}", status_code=status.HTTP_200_OK,
             response_model=sc.WorkdayResponse)
-def workday_get_id(w_id: int,
-                   user: m.User = Depends(get_current_active_user),
-                   db: Session = Depends(get_db)):
-    return crud.workdays_get(db=db, user=user, id=w_id)[0]
+async def workday_get_id(w_id: int,
+                         user: UserIdentity = Depends(get_current_user_identity_async),
+                         db: AsyncSession = Depends(get_async_db)):
+    return (await crud_async.workdays_get(db=db, user=user, id=w_id))[0]
 
 
 @router.patch("/{w_id}", status_code=status.HTTP_200_OK,
               response_model=sc.WorkdayResponse)
 def workday_update(w_id: int,
                    workday_data: sc.WorkdayUpdate,
-                   user: m.User = Depends(get_current_active_user),
+                   user: UserIdentity = Depends(get_current_user_identity),
                    db: Session = Depends(get_db)):
     return crud.workday_update(db=db, user=user, id=w_id, data=workday_data)
 
 
 @router.delete("/{w_id}", status_code=status.HTTP_200_OK)
 def workday_update(w_id: int,
-                   user: m.User = Depends(get_current_active_user),
+                   user: UserIdentity = Depends(get_current_user_identity),
                    db: Session = Depends(get_db)):
     workday_to_delete: m.Workday = crud.workdays_get(db=db, user=user, id=w_id)[0]
+    deltas = RollupDeltas()
+    deltas.workday(workday_to_delete, workday_to_delete.harvest.season_id, -1)
+    deltas.apply(db)
     db.delete(workday_to_delete)
     db.commit()
@@ -0,0 +1,49 @@
+from fastapi.testclient import TestClient
+
+import project.data.models as m
+from project.benchmarks.load import run_load
+from project.benchmarks.run import run_benchmarks
+from project.benchmarks.stats import percentile
+from project.main import app
+from project.populate_db import generate_bulk
+from .main_test import override_get_db
+
+
+def test_percentile():
+    values = [float(v) for v in range(1, 101)]
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([3.0], 95) == 3
+
+
+def test_run_benchmarks(tmp_path):
+    results = run_benchmarks(f"sqlite:///{tmp_path / 'benchmark.db'}", seed=3, employees=5, harvests=8,
+                             expenses=4, repeat=3, warmup=1, login_repeat=1)
+    assert set(results["routes"]) == {"login", "season_summary", "harvests_extended", "employee_summary",
+                                      "harvests_csv", "expenses_csv", "workdays_page"}
+    for name, route in results["routes"].items():
+        assert route["statuses"] == [200], name
+        assert route["p50_ms"] <= route["p95_ms"] <= route["p99_ms"]
+    assert results["routes"]["season_summary"]["db_queries_max"] > 0
+    assert results["meta"]["dataset"]["workdays"] > 0
+
+
+def test_run_load():
+    db = next(override_get_db())
+    generate_bulk(db, seed=55, users=2, seasons=1, employees=4, harvests=6, expenses=2,
+                  start_year=2555, password="load_test_pass")
+    usernames = ["populator_55_1", "populator_55_2"]
+    try:
+        report = run_load("http://testserver", usernames, "load_test_pass", concurrency=2, duration=1.5,
+                          session_factory=lambda: TestClient(app))
+        assert report["users"] == 2
+        assert report["requests"] > 0
+        assert report["throughput_rps"] > 0
+        assert report["errors"] == 0, report["errors_by_status"]
+        assert report["latency"]["p50_ms"] <= report["latency"]["p99_ms"]
+        assert report["calls"]["dashboard"]["n"] > 0
+    finally:
+        for user in db.query(m.User).filter(m.User.username.in_(usernames)):
+            db.query(m.DataVersion).filter(m.DataVersion.owner_id == user.id).delete()
+            db.delete(user)
+        db.commit()
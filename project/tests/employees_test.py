@@ -1,8 +1,57 @@
+import datetime
+
 from pytest import fixture
 from requests import Session
 from fastapi.testclient import TestClient
 
 from project.main import app
+from .seasons_test import create_harvest, create_employee, create_season_fix
+from .main_test import create_user_and_get_token
+
+
+client: Session = TestClient(app)
+
+
+def test_employee_summary(create_season_fix):
+    oauth_header, season = create_season_fix
+    employee = create_employee(oauth_header, season['year'], name="Stefan",
+                               start_date=datetime.date(season['year'], 6, 1),
+                               end_date=datetime.date(season['year'], 8, 1)).json()
+    harvest = create_harvest(oauth_header, season['year'], price=5, harvested=100,
+                             date=datetime.date(season['year'], 7, 1), fruit='raspberry',
+                             employee_ids=[employee['id']]).json()
+    client.post(url=f"/emlpoyees/{employee['id']}/workdays", headers=oauth_header,
+                json={'harvest_id': harvest['id'], 'harvested': 30, 'pay_per_kg': 2})
+
+    response = client.get(url=f"/emlpoyees/{employee['id']}/summary", headers=oauth_header)
+    assert response.status_code == 200
+    summary = response.json()
+    assert summary['total_harvested'] == 30
+    assert summary['total_earnings'] == 60
+    assert summary['harvested_per_fruit'] == {'raspberry': 30}
+    assert summary['earnings_per_fruit'] == {'raspberry': 60}
+    assert summary['best_harvest']['id'] == harvest['id']
+    assert summary['harvest_history'] == [{'id': harvest['id'], 'date': harvest['date'], 'fruit': 'raspberry',
+                                           'harvested': 30, 'pay_per_kg': 2, 'earned': 60}]
+
+    response = client.get(url=f"/emlpoyees/{employee['id']}/harvests-summary", headers=oauth_header)
+    assert response.status_code == 200
+    assert response.json() == summary['harvest_history']
+
 
+def test_employees_cursor_pages_nullable_order(create_season_fix):
+    oauth_header, season = create_season_fix
+    ids = [create_employee(oauth_header, season['year'], name=name, start_date=datetime.date(season['year'], 6, 1),
+                           end_date=end_date).json()['id']
+           for name, end_date in (("Stefan", None), ("Marta", datetime.date(season['year'], 8, 1)),
+                                  ("Zofia", datetime.date(season['year'], 7, 1)), ("Jan", None))]
 
-client: Session = TestClient(app)
\ No newline at end of file
+    seen = []
+    url = "/emlpoyees/?order_by=end-date&order=asc&limit=1"
+    while url:
+        response = client.get(url, headers=oauth_header)
+        if response.status_code == 404:
+            break
+        seen.extend(e['id'] for e in response.json())
+        url = response.links.get('next', {}).get('url')
+    assert seen == [ids[2], ids[1], ids[0], ids[3]]
@@ -1,4 +1,5 @@
 import datetime
+import json
 
 import pytest
 from pytest import fixture
@@ -6,7 +7,7 @@ from requests import Session
 from fastapi.testclient import TestClient
 
 from project.main import app
-from .seasons_test import create_season, create_harvest, create_employee, create_season_fix
+from .seasons_test import create_season, create_harvest, create_employee, create_expense, create_season_fix
 
 from .main_test import client, create_user_and_get_token
 
@@ -53,7 +54,7 @@ def test_harvests_fail_unauthorized_gets(endpoint, status):
     assert response.status_code == status
 
 
-@pytest.mark.parametrize('endpoint,status', [('/harvests/1/workdays', 401)])
+@pytest.mark.parametrize('endpoint,status', [('/harvests/1/workdays', 401), ('/harvests/1/workdays/bulk', 401)])
 def test_harvests_fail_unauthorized_post(endpoint, status):
     response = client.post(url=endpoint, headers={}, allow_redirects=True)
     assert response.status_code == status
@@ -102,3 +103,165 @@ def test_harvests_get_all_query_params(create_user_and_get_token):
     create_harvest(oauth_header, season_a['year'],
                    date=datetime.date(season_b['year'], 7, 20),
                    fruit="raspberry", harvested=500, price=5)
+
+
+def test_season_harvests_extended(create_season_fix):
+    oauth_header, season = create_season_fix
+    employee = create_employee(oauth_header, season['year'], name="Stefan",
+                               start_date=datetime.date(season['year'], 6, 1),
+                               end_date=datetime.date(season['year'], 8, 1)).json()
+    harvest = create_harvest(oauth_header, season['year'], price=5, harvested=100,
+                             date=datetime.date(season['year'], 7, 1), fruit='raspberry',
+                             employee_ids=[employee['id']]).json()
+    create_harvest(oauth_header, season['year'], price=10, harvested=50,
+                   date=datetime.date(season['year'], 7, 2), fruit='strawberry')
+    client.post(url=f"/harvests/{harvest['id']}/workdays", headers=oauth_header,
+                json={'employee_id': employee['id'], 'harvested': 40, 'pay_per_kg': 2})
+
+    response = client.get(url=f"/seasons/{season['year']}/harvests",
+                          params={'extended': True, 'order_by': 'date', 'order': 'asc'},
+                          headers=oauth_header)
+    assert response.status_code == 200
+    harvest_ext, harvest_no_workdays = response.json()
+    assert float(harvest_ext['harvested_by_employees']) == 40
+    assert float(harvest_ext['self_harvested']) == 60
+    assert float(harvest_ext['avg_pay_per_kg']) == 2
+    assert float(harvest_ext['total_paid']) == 80
+    assert float(harvest_ext['net_profit']) == 420
+    assert harvest_ext['best_employee']['id'] == employee['id']
+    assert float(harvest_no_workdays['harvested_by_employees']) == 0
+    assert harvest_no_workdays['best_employee'] == {}
+
+
+def test_harvest_summary(create_season_fix):
+    oauth_header, season = create_season_fix
+    employee = create_employee(oauth_header, season['year'], name="Stefan",
+                               start_date=datetime.date(season['year'], 6, 1),
+                               end_date=datetime.date(season['year'], 8, 1)).json()
+    harvest = create_harvest(oauth_header, season['year'], price=5, harvested=100,
+                             date=datetime.date(season['year'], 7, 1), fruit='raspberry',
+                             employee_ids=[employee['id']]).json()
+    response = client.get(url=f"/harvests/{harvest['id']}/summary", headers=oauth_header)
+    assert response.status_code == 200
+    assert response.json()['harvested_per_emp'] == []
+
+    client.post(url=f"/harvests/{harvest['id']}/workdays", headers=oauth_header,
+                json={'employee_id': employee['id'], 'harvested': 40, 'pay_per_kg': 2})
+    response = client.get(url=f"/harvests/{harvest['id']}/summary", headers=oauth_header)
+    assert response.status_code == 200
+    assert response.json()['total_paid'] == 80
+    assert response.json()['self_harvested'] == 60
+    assert response.json()['harvested_per_emp'] == [{'id': employee['id'], 'name': 'Stefan', 'harvested': 40,
+                                                     'pay_per_kg': 2, 'earned': 80}]
+
+
+def test_harvests_post_workdays_bulk(create_season_fix):
+    oauth_header, season = create_season_fix
+    employees = [create_employee(oauth_header, season['year'], name=name,
+                                 start_date=datetime.date(season['year'], 6, 1)).json()
+                 for name in ("Stefan", "Marta", "Zofia")]
+    late = create_employee(oauth_header, season['year'], name="Jan",
+                           start_date=datetime.date(season['year'], 8, 1)).json()
+    harvest = create_harvest(oauth_header, season['year'], price=5, harvested=200,
+                             date=datetime.date(season['year'], 7, 2), fruit='raspberry',
+                             employee_ids=[employees[0]['id']]).json()
+    url = f"/harvests/{harvest['id']}/workdays/bulk"
+    body = [{'employee_id': e['id'], 'harvested': 50, 'pay_per_kg': 2} for e in employees]
+
+    response = client.post(url=url, headers=oauth_header, json=body)
+    assert response.status_code == 201
+    assert [w['employee_id'] for w in response.json()] == [e['id'] for e in employees]
+    assert all(w['harvest_id'] == harvest['id'] and w['fruit'] == 'raspberry' for w in response.json())
+    workdays = client.get(url=f"/harvests/{harvest['id']}/workdays", headers=oauth_header).json()
+    assert sorted(w['id'] for w in workdays) == sorted(w['id'] for w in response.json())
+    harvest_employees = client.get(url=f"/harvests/{harvest['id']}/employees", headers=oauth_header).json()
+    assert sorted(e['id'] for e in harvest_employees) == sorted(e['id'] for e in employees)
+    summary = client.get(url=f"/harvests/{harvest['id']}/summary", headers=oauth_header).json()
+    assert summary['total_paid'] == 300
+    assert summary['self_harvested'] == 50
+
+    # 150 kg already in workdays, 60 more would exceed 200 kg of the harvest
+    response = client.post(url=url, headers=oauth_header,
+                           json=[{'employee_id': employees[0]['id'], 'harvested': 30, 'pay_per_kg': 2},
+                                 {'employee_id': employees[1]['id'], 'harvested': 30, 'pay_per_kg': 2}])
+    assert response.status_code == 422
+    response = client.post(url=url, headers=oauth_header,
+                           json=[{'employee_id': employees[0]['id'], 'harvested': 5, 'pay_per_kg': 2}] * 2)
+    assert response.status_code == 422
+    response = client.post(url=url, headers=oauth_header,
+                           json=[{'employee_id': late['id'], 'harvested': 5, 'pay_per_kg': 2}])
+    assert response.status_code == 422
+    response = client.post(url=url, headers=oauth_header,
+                           json=[{'employee_id': employees[0]['id'], 'harvested': 5, 'pay_per_kg': 2},
+                                 {'employee_id': 999999, 'harvested': 5, 'pay_per_kg': 2}])
+    assert response.status_code == 404
+    assert len(client.get(url=f"/harvests/{harvest['id']}/workdays", headers=oauth_header).json()) == 3
+
+
+def test_harvests_employees_expenses_ndjson(create_season_fix):
+    oauth_header, season = create_season_fix
+    employee = create_employee(oauth_header, season['year'], name="Stefan",
+                               start_date=datetime.date(season['year'], 6, 1)).json()
+    for day in range(1, 13):
+        create_harvest(oauth_header, season['year'], price=5, harvested=100 + day,
+                       date=datetime.date(season['year'], 6, day), fruit='cherry')
+    create_expense(oauth_header, season['year'], "fuel", datetime.date(season['year'], 6, 2), 55.5)
+    ndjson_header = {**oauth_header, 'Accept': "application/x-ndjson"}
+
+    response = client.get("/harvests/?order_by=date&order=asc", headers=ndjson_header)
+    assert response.status_code == 200
+    assert 'ETag' in response.headers
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert len(rows) == 12
+    assert rows[0]['date'] == f"{season['year']}-06-01" and rows[0]['harvested'] == 101
+    assert set(rows[0]) == {'id', 'fruit', 'harvested', 'date', 'price', 'season_id', 'owner_id'}
+    assert len(client.get("/harvests/", headers=oauth_header).json()) == 10
+
+    response = client.get("/emlpoyees/?data_format=ndjson", headers=oauth_header)
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [(row['id'], row['name']) for row in rows] == [(employee['id'], "Stefan")]
+    response = client.get("/expenses/?data_format=ndjson", headers=oauth_header)
+    assert [json.loads(line)['amount'] for line in response.text.splitlines()] == [55.5]
+
+
+def test_harvests_post_workday_employee(create_season_fix):
+    oauth_header, season = create_season_fix
+    employees = [create_employee(oauth_header, season['year'], name=name,
+                                 start_date=datetime.date(season['year'], 6, 1)).json()
+                 for name in ("Stefan", "Marta")]
+    harvest = create_harvest(oauth_header, season['year'], price=5, harvested=100,
+                             date=datetime.date(season['year'], 7, 4), fruit='raspberry').json()
+    url = f"/harvests/{harvest['id']}/workdays"
+
+    response = client.post(url=url, headers=oauth_header, json={'harvested': 10, 'pay_per_kg': 2})
+    assert response.status_code == 422
+    response = client.post(url=url, headers=oauth_header,
+                           json={'employee_id': employees[1]['id'], 'harvested': 10, 'pay_per_kg': 2})
+    assert response.status_code == 201
+    assert response.json()['employee_id'] == employees[1]['id']
+    harvest_employees = client.get(url=f"/harvests/{harvest['id']}/employees", headers=oauth_header).json()
+    assert [e['id'] for e in harvest_employees] == [employees[1]['id']]
+
+
+def test_harvests_etag_per_representation(create_season_fix):
+    oauth_header, season = create_season_fix
+    create_harvest(oauth_header, season['year'], price=5, harvested=100,
+                   date=datetime.date(season['year'], 6, 1), fruit='cherry')
+    ndjson_header = {**oauth_header, 'Accept': "application/x-ndjson"}
+
+    json_response = client.get("/harvests/", headers=oauth_header)
+    ndjson_response = client.get("/harvests/", headers=ndjson_header)
+    assert all('Accept' in r.headers['Vary'].split(', ') for r in (json_response, ndjson_response))
+    assert json_response.headers['ETag'] != ndjson_response.headers['ETag']
+    response = client.get("/harvests/", headers={**ndjson_header, 'If-None-Match': json_response.headers['ETag']})
+    assert response.status_code == 200
+    assert json.loads(response.text.splitlines()[0])['fruit'] == 'cherry'
+    response = client.get("/harvests/", headers={**ndjson_header, 'If-None-Match': ndjson_response.headers['ETag']})
+    assert response.status_code == 304
+    assert 'Accept' in response.headers['Vary'].split(', ')
+
+    create_employee(oauth_header, season['year'], name="Stefan", start_date=datetime.date(season['year'], 6, 1))
+    json_response = client.get("/emlpoyees/", headers=oauth_header)
+    ndjson_response = client.get("/emlpoyees/", headers=ndjson_header)
+    assert all('Accept' in r.headers['Vary'].split(', ') for r in (json_response, ndjson_response))
+    assert json_response.headers['ETag'] != ndjson_response.headers['ETag']
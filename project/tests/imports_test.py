@@ -0,0 +1,129 @@
+import datetime
+import json
+
+from project.data import models as m
+from project.routers.imports import SeasonImport
+from .main_test import client, create_user_and_get_token, TestingSessionLocal
+from .seasons_test import create_employee, create_harvest, create_season_fix
+
+
+def import_file(oauth_header: dict, year: int, kind: str, filename: str, content: str, **params):
+    return client.post(url=f"/seasons/{year}/import/{kind}", headers=oauth_header, params=params,
+                       files={"file": (filename, content.encode())})
+
+
+def test_import_harvests_csv(create_season_fix):
+    oauth_header, season = create_season_fix
+    content = ("date,fruit,harvested,price\n"
+               "2777-08-01,apricot,100,5\n"
+               "2777-08-02,apricot,200.5,4\n"
+               "2777-08-02,apricot,50,4\n"
+               "2777-10-01,apricot,50,4\n"
+               "2777-08-03,banana,50,4\n"
+               "2777-08-04,apricot,,4\n"
+               "2777-08-05,apricot,50,4,7\n")
+    response = import_file(oauth_header, season['year'], "harvests", "harvests.csv", content)
+    assert response.status_code == 200
+    report = response.json()
+    assert (report['rows'], report['imported'], report['failed']) == (7, 2, 5)
+    assert [e['line'] for e in report['errors']] == [4, 5, 6, 7, 8]
+    assert "already exists" in report['errors'][0]['error']
+    assert "between season start and end" in report['errors'][1]['error']
+    assert report['errors'][2]['error'].startswith("fruit")
+
+    harvests = client.get(url=f"/seasons/{season['year']}/harvests", headers=oauth_header).json()
+    assert sorted(float(h['harvested']) for h in harvests) == [100, 200.5]
+    summary = client.get(url=f"/seasons/{season['year']}/summary", headers=oauth_header).json()
+    assert float(summary['harvested_per_fruit']['apricot']) == 300.5
+
+    response = import_file(oauth_header, season['year'], "harvests", "harvests.xlsx", content, data_format="xlsx")
+    assert response.status_code == 400
+    response = import_file(oauth_header, season['year'], "seasons", "harvests.csv", content)
+    assert response.status_code == 400
+
+
+def test_import_employees_and_workdays_ndjson(create_season_fix):
+    oauth_header, season = create_season_fix
+    employees = "\n".join(json.dumps(row) for row in [
+        {"name": "Stefan", "start_date": "2777-06-01"},
+        {"name": "Marta", "start_date": "2777-06-01", "end_date": "2777-08-15"},
+        {"name": "Zofia", "start_date": "2777-05-01"},
+    ])
+    report = import_file(oauth_header, season['year'], "employees", "employees.ndjson", employees).json()
+    assert (report['imported'], report['failed']) == (2, 1)
+    import_file(oauth_header, season['year'], "harvests", "harvests.csv",
+                "date,fruit,harvested,price\n2777-08-20,redcurrant,100,5\n")
+    late = create_employee(oauth_header, season['year'], name="Jan",
+                           start_date=datetime.date(2777, 8, 25)).json()
+
+    workdays = "\n".join([
+        json.dumps({"harvest_date": "2777-08-20", "fruit": "redcurrant", "employee_name": "Stefan",
+                    "harvested": 60, "pay_per_kg": 2}),
+        "{not json",
+        json.dumps({"harvest_date": "2777-08-20", "fruit": "redcurrant", "employee_name": "Marta",
+                    "harvested": 30, "pay_per_kg": 2}),
+        json.dumps({"harvest_date": "2777-08-20", "fruit": "redcurrant", "employee_id": late['id'],
+                    "harvested": 5, "pay_per_kg": 2}),
+        json.dumps({"harvest_date": "2777-08-21", "fruit": "redcurrant", "employee_name": "Stefan",
+                    "harvested": 5, "pay_per_kg": 2}),
+        json.dumps({"harvest_date": "2777-08-20", "fruit": "redcurrant", "employee_name": "Stefan",
+                    "harvested": 50, "pay_per_kg": 2}),
+    ])
+    response = import_file(oauth_header, season['year'], "workdays", "workdays.jsonl", workdays)
+    assert response.status_code == 200
+    report = response.json()
+    assert (report['imported'], report['failed']) == (1, 5)
+    assert [e['line'] for e in report['errors']] == [2, 3, 4, 5, 6]
+    assert report['errors'][0]['error'].startswith("Invalid JSON")
+    assert "Incompatible dates" in report['errors'][1]['error']
+    assert "exceed" in report['errors'][4]['error']
+
+    harvest = client.get(url=f"/seasons/{season['year']}/harvests", headers=oauth_header).json()[0]
+    harvest_employees = client.get(url=f"/harvests/{harvest['id']}/employees", headers=oauth_header).json()
+    assert [e['name'] for e in harvest_employees] == ["Stefan"]
+    summary = client.get(url=f"/harvests/{harvest['id']}/summary", headers=oauth_header).json()
+    assert summary['total_paid'] == 120
+
+
+def test_import_reports_lines_not_valid_utf8(create_season_fix):
+    oauth_header, season = create_season_fix
+    content = ("date,fruit,harvested,price\n"
+               "2777-08-06,apricot,100,5\n"
+               "2777-08-07,apricot,100,5\n").encode() + "2777-08-08,żółć,100,5\n".encode("iso8859-2")
+    response = client.post(url=f"/seasons/{season['year']}/import/harvests", headers=oauth_header,
+                           files={"file": ("harvests.csv", content)})
+    report = response.json()
+    assert (report['imported'], report['failed']) == (2, 1)
+    assert report['errors'] == [{"line": 4, "error": "Row is not valid UTF-8"}]
+
+    content = json.dumps({"name": "Stefan", "start_date": "2777-06-01"}).encode() + b"\n" \
+        + json.dumps({"name": "Łucja", "start_date": "2777-06-01"}, ensure_ascii=False).encode("iso8859-2")
+    response = client.post(url=f"/seasons/{season['year']}/import/employees", headers=oauth_header,
+                           files={"file": ("employees.ndjson", content)})
+    report = response.json()
+    assert (report['imported'], report['failed']) == (1, 1)
+    assert report['errors'] == [{"line": 2, "error": "Line is not valid UTF-8"}]
+
+
+def test_import_reports_rows_of_rejected_chunk(create_season_fix):
+    oauth_header, season = create_season_fix
+    db = TestingSessionLocal()
+    try:
+        user = db.query(m.User).filter(m.User.id == season['owner_id']).one()
+        season_m = db.query(m.Season).filter(m.Season.id == season['id']).one()
+        season_import = SeasonImport(db, user, season_m, 'harvests', chunk_size=2)
+        season_import.add(2, {"date": "2777-08-10", "fruit": "apricot", "harvested": 10, "price": 5})
+        # harvest created after the import read existing ones, the chunk violates the unique constraint
+        create_harvest(oauth_header, season['year'], price=5, harvested=10,
+                       date=datetime.date(2777, 8, 11), fruit="apricot")
+        season_import.add(3, {"date": "2777-08-11", "fruit": "apricot", "harvested": 10, "price": 5})
+        season_import.add(4, {"date": "2777-08-10", "fruit": "apricot", "harvested": 20, "price": 5})
+        season_import.flush()
+        report = season_import.report
+    finally:
+        db.close()
+    assert (report['rows'], report['imported'], report['failed']) == (3, 1, 2)
+    assert [e['line'] for e in report['errors']] == [2, 3]
+    assert report['errors'][0]['error'].startswith("Row couldn't be written")
+    harvests = client.get(url=f"/seasons/{season['year']}/harvests", headers=oauth_header).json()
+    assert sorted((h['date'], float(h['harvested'])) for h in harvests) == [("2777-08-10", 20), ("2777-08-11", 10)]
@@ -0,0 +1,18 @@
+from sqlalchemy import create_engine, inspect
+
+from project.data.database import Base
+from project.data.indexes import ensure_indexes, missing_indexes
+
+
+def test_ensure_indexes_creates_missing(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'upgraded.db'}")
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        conn.exec_driver_sql("DROP INDEX ix_workdays_harvest_id")
+        conn.exec_driver_sql("DROP INDEX ix_association_employee_id")
+    assert [index.name for index in missing_indexes(engine)] == ['ix_association_employee_id',
+                                                                 'ix_workdays_harvest_id']
+
+    assert sorted(ensure_indexes(engine)) == ['ix_association_employee_id', 'ix_workdays_harvest_id']
+    assert 'ix_workdays_harvest_id' in {index['name'] for index in inspect(engine).get_indexes('workdays')}
+    assert ensure_indexes(engine) == []
@@ -1,14 +1,21 @@
+import datetime
+import glob
+import gzip
+import json
 import os
 
 import requests
 import sqlalchemy.orm
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from fastapi.testclient import TestClient
-from pytest import fixture
+from pytest import fixture, raises
 
 from project.main import app
-from project.dependencies import get_db
+from project.additional import ApiLogger, _LogWriter
+from project.dependencies import get_db, get_async_db
+from project.data import database
 import project.data.models as m
 
 # TESTING DB
@@ -28,6 +35,19 @@ def override_get_db():
 
 
 app.dependency_overrides[get_db] = override_get_db
+
+# TESTING DB, async driver
+engine_test_async = create_async_engine("sqlite+aiosqlite:///./test.db")
+TestingAsyncSessionLocal = sessionmaker(engine_test_async, class_=AsyncSession,
+                                        autoflush=False, expire_on_commit=False)
+
+
+async def override_get_async_db():
+    async with TestingAsyncSessionLocal() as db:
+        yield db
+
+
+app.dependency_overrides[get_async_db] = override_get_async_db
 client: requests.Session = TestClient(app)
 
 
@@ -37,6 +57,19 @@ def test_hello():
     assert response.json() == {"message": "Hello World"}
 
 
+def test_openapi_cached_with_etag():
+    docs_auth = (os.environ.get("API_DOCS_USERNAME"), os.environ.get("API_DOCS_PASSWORD"))
+    response = client.get("/openapi.json", auth=docs_auth)
+    assert response.status_code == 200
+    assert "/seasons/" in response.json()['paths']
+    etag = response.headers['ETag']
+
+    response = client.get("/openapi.json", auth=docs_auth, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    response = client.get("/openapi.json", headers={'If-None-Match': etag})
+    assert response.status_code == 401
+
+
 def test_create_user_and_get_token():
     user_data = {
         "username": "kasztan_test_login",
@@ -83,3 +116,139 @@ def create_user_and_get_token():
     user_m: m.User = db.query(m.User).filter(m.User.username == user_data['username']).first()
     db.delete(user_m)
     db.commit()
+
+
+def test_deactivated_user_loses_access(create_user_and_get_token):
+    oauth_header = create_user_and_get_token
+    response = client.get(url="/harvests", headers=oauth_header, allow_redirects=True)
+    assert response.status_code == 404
+
+    db: sqlalchemy.orm.Session = next(override_get_db())
+    user_m: m.User = db.query(m.User).filter(m.User.username == "kasztan_test_login").first()
+    user_m.is_active = False
+    db.commit()
+
+    response = client.get(url="/harvests", headers=oauth_header, allow_redirects=True)
+    assert response.status_code == 401
+
+
+def test_http_exceptions_logged(create_user_and_get_token):
+    oauth_header = create_user_and_get_token
+    response = client.get(url="/harvests/999999", headers=oauth_header)
+    assert response.status_code == 404
+    ApiLogger.flush()
+    log_path = f"{ApiLogger.logs_path}/{datetime.date.today().isoformat()}/harvests.exc.log"
+    with open(log_path, encoding="utf-8") as logfile:
+        assert "/harvests/999999: Couldn't find Harvest with specified parameters" in logfile.read()
+
+
+def test_json_request_logs(create_user_and_get_token, monkeypatch):
+    oauth_header = create_user_and_get_token
+    monkeypatch.setattr(ApiLogger, "log_format", "json")
+    response = client.get(url="/harvests/999999", headers=oauth_header)
+    assert response.status_code == 404
+    ApiLogger.flush()
+
+    with open(f"{ApiLogger.logs_path}/harvests.exc.jsonl", encoding="utf-8") as logfile:
+        exc_event = json.loads(logfile.readlines()[-1])
+    assert exc_event["route"] == "/harvests/{h_id}"
+    assert exc_event["status"] == 404
+    assert exc_event["user_id"] is not None
+    assert exc_event["headers"]["authorization"] == "<redacted>"
+    assert oauth_header["Authorization"] not in json.dumps(exc_event)
+
+    with open(f"{ApiLogger.logs_path}/access.jsonl", encoding="utf-8") as logfile:
+        access_event = json.loads(logfile.readlines()[-1])
+    assert access_event["route"] == "/harvests/{h_id}"
+    assert access_event["path"] == "/harvests/999999"
+    assert access_event["status"] == 404
+    assert access_event["user_id"] == exc_event["user_id"]
+    assert access_event["latency_ms"] >= 0
+
+
+def test_log_rotation_and_retention(tmp_path):
+    writer = _LogWriter(max_queue_size=100, max_bytes=100, backup_count=2)
+    path = f"{tmp_path}/access.jsonl"
+    sibling_path = f"{tmp_path}/access.exc.jsonl"
+    for i in range(5):
+        writer.put(path, json.dumps({"entry": i, "padding": "x" * 100}) + "\n")
+        writer.put(sibling_path, json.dumps({"entry": i, "padding": "y" * 100}) + "\n")
+        writer.flush()
+    writer.close()
+
+    sibling_segments = glob.glob(f"{tmp_path}/access.exc.*.jsonl.gz")
+    assert len(sibling_segments) == 2
+    segments = sorted(set(glob.glob(f"{tmp_path}/access.*.jsonl.gz")) - set(sibling_segments))
+    assert len(segments) == 2
+    assert not glob.glob(f"{tmp_path}/access.*.jsonl")
+    with gzip.open(segments[-1], "rt", encoding="utf-8") as segment:
+        assert json.loads(segment.read())["entry"] == 4
+
+
+def set_test_user_auth_level(auth_level: int):
+    db: sqlalchemy.orm.Session = next(override_get_db())
+    user_m: m.User = db.query(m.User).filter(m.User.username == "kasztan_test_login").first()
+    user_m.auth_level = auth_level
+    db.commit()
+
+
+def test_metrics(create_user_and_get_token):
+    oauth_header = create_user_and_get_token
+    response = client.get(url="/metrics", headers=oauth_header)
+    assert response.status_code == 401
+
+    set_test_user_auth_level(2)
+
+    client.get(url="/harvests/999999", headers=oauth_header)
+    response = client.get(url="/metrics", headers=oauth_header)
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith("text/plain")
+    metrics = response.text
+    assert 'http_requests_total{method="GET",route="/harvests/{h_id}",status="404"}' in metrics
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/harvests/{h_id}",le="+Inf"}' in metrics
+    assert 'http_response_size_bytes_count{method="GET",route="/harvests/{h_id}"}' in metrics
+    assert "http_requests_in_progress 1" in metrics
+    assert 'http_request_db_queries_count{method="GET",route="/harvests/{h_id}"}' in metrics
+
+
+def test_db_query_stats_and_budget(create_user_and_get_token, monkeypatch):
+    oauth_header = create_user_and_get_token
+    response = client.get(url="/harvests/", headers=oauth_header)
+    assert int(response.headers['X-DB-Queries']) >= 2
+    assert float(response.headers['X-DB-Time']) >= 0
+
+    monkeypatch.setattr(database, "QUERY_BUDGET", 1)
+    response = client.get(url="/harvests/", headers=oauth_header)
+    assert response.status_code == 404
+    ApiLogger.flush()
+    with open(f"{ApiLogger.logs_path}/{datetime.date.today().isoformat()}/db.budget.log",
+              encoding="utf-8") as logfile:
+        assert "GET /harvests/ executed" in logfile.read()
+
+    monkeypatch.setattr(database, "QUERY_BUDGET_STRICT", True)
+    with raises(database.QueryBudgetExceeded):
+        client.get(url="/harvests/", headers=oauth_header)
+
+
+def test_request_profiler(create_user_and_get_token):
+    oauth_header = create_user_and_get_token
+    response = client.get(url="/harvests/?profile=1", headers=oauth_header)
+    assert "X-Profile-Id" not in response.headers
+
+    set_test_user_auth_level(2)
+    response = client.get(url="/harvests/", headers={**oauth_header, "X-Profile": "1"})
+    assert response.status_code == 404
+    profile_id = response.headers["X-Profile-Id"]
+
+    response = client.get(url="/admin/profiles/", headers=oauth_header)
+    assert profile_id in response.json()["profiles"]
+    response = client.get(url=f"/admin/profiles/{profile_id}", headers=oauth_header)
+    assert response.status_code == 200
+    profile = response.json()
+    assert profile["route"] == "/harvests/"
+    assert profile["status"] == 404
+    assert profile["db_queries"] == sum(statement["count"] for statement in profile["statements"]) > 0
+    response = client.get(url=f"/admin/profiles/{profile_id}/collapsed", headers=oauth_header)
+    assert response.status_code == 200
+    response = client.get(url="/admin/profiles/missing/collapsed", headers=oauth_header)
+    assert response.status_code == 404
@@ -0,0 +1,25 @@
+from sqlalchemy import create_engine, func
+from sqlalchemy.orm import sessionmaker
+
+import project.data.models as m
+from project.data.database import Base
+from project.populate_db import generate_bulk
+
+
+def test_generate_bulk_reproducible(tmp_path):
+    rows = []
+    for name in ("first", "second"):
+        engine = create_engine(f"sqlite:///{tmp_path / f'{name}.db'}")
+        Base.metadata.create_all(bind=engine)
+        db = sessionmaker(bind=engine)()
+        totals = generate_bulk(db, seed=7, users=2, seasons=2, employees=6, harvests=10, expenses=3)
+        assert totals["seasons"] == 4
+        assert totals["harvests"] == 40
+        assert db.query(m.Workday).count() == totals["workdays"] > 0
+        assert db.query(func.count()).select_from(m.harvests_employees_asoc_tab).scalar() == totals["workdays"]
+        assert db.query(func.sum(m.SeasonRollup.harvests_n)).scalar() == totals["harvests"]
+        assert db.query(m.DataVersion).filter(m.DataVersion.season_id != 0).count() == 4
+        rows.append(db.query(m.Workday.employee_id, m.Workday.harvest_id, m.Workday.harvested)
+                    .order_by(m.Workday.id).all())
+        db.close()
+    assert rows[0] == rows[1]
@@ -1,9 +1,15 @@
+import csv
 import datetime
+import decimal
+import io
+import zipfile
 from typing import Tuple, Optional, List
 
 from pytest import fixture
 
-from .main_test import client, create_user_and_get_token
+from project.data import models as m
+from project.routers.rollups import NO_FRUIT, RollupDeltas
+from .main_test import client, create_user_and_get_token, override_get_db, set_test_user_auth_level
 
 
 def create_harvest(oauth_header: dict, s_year: int, price: int,
@@ -384,3 +390,176 @@ def test_season_get_expense_fail_unauthorized(create_season_fix):
     response = client.get(headers={}, url=f"/seasons/{season['year']}/expenses")
     print(response.json())
     assert response.status_code == 401
+
+
+def test_season_summary(create_season_fix):
+    oauth_header, season = create_season_fix
+    employee = create_employee(oauth_header, season['year'], name="Stefan",
+                               start_date=datetime.date(season['year'], 6, 1),
+                               end_date=datetime.date(season['year'], 8, 1)).json()
+    harvest_a = create_harvest(oauth_header, season['year'], price=5, harvested=100,
+                               date=datetime.date(season['year'], 7, 1), fruit='raspberry',
+                               employee_ids=[employee['id']]).json()
+    create_harvest(oauth_header, season['year'], price=10, harvested=50,
+                   date=datetime.date(season['year'], 7, 2), fruit='strawberry')
+    client.post(url=f"/harvests/{harvest_a['id']}/workdays", headers=oauth_header,
+                json={'employee_id': employee['id'], 'harvested': 30, 'pay_per_kg': 2})
+    create_expense(oauth_header, season['year'], e_type='fuel',
+                   e_date=datetime.date(season['year'], 7, 3), amount=200)
+
+    response = client.get(url=f"/seasons/{season['year']}/summary", headers=oauth_header)
+    assert response.status_code == 200
+    summary = response.json()
+    assert sorted(summary['fruits']) == ['raspberry', 'strawberry']
+    assert summary['harvests_n'] == 2
+    assert summary['employees_n'] == 1
+    assert summary['harvested_per_fruit'] == {'raspberry': 100, 'strawberry': 50}
+    assert summary['value_per_fruit'] == {'raspberry': 500, 'strawberry': 500}
+    assert summary['best_harvest']['id'] == harvest_a['id']
+    assert summary['best_employee'] == {'id': employee['id'], 'name': 'Stefan', 'total_harvested': 30}
+    assert summary['best_employee_per_fruit']['raspberry']['harvested'] == 30
+    assert summary['best_employee_per_fruit']['strawberry']['harvested'] == 0
+    assert summary['total_employee_payments'] == 60
+    assert summary['total_expenses_value'] == 200
+    assert summary['net_profits'] == 740
+
+    response = client.get(url="/seasons/summary", headers=oauth_header)
+    assert response.status_code == 200
+    assert response.json()[0]['net_profits'] == 740
+
+
+def test_season_summary_rollups_follow_writes(create_season_fix):
+    oauth_header, season = create_season_fix
+    employee = create_employee(oauth_header, season['year'], name="Stefan",
+                               start_date=datetime.date(season['year'], 6, 1),
+                               end_date=datetime.date(season['year'], 8, 1)).json()
+    harvest = create_harvest(oauth_header, season['year'], price=5, harvested=100,
+                             date=datetime.date(season['year'], 7, 1), fruit='raspberry',
+                             employee_ids=[employee['id']]).json()
+    workday = client.post(url=f"/harvests/{harvest['id']}/workdays", headers=oauth_header,
+                          json={'employee_id': employee['id'], 'harvested': 30, 'pay_per_kg': 2}).json()
+
+    response = client.patch(url=f"/harvests/{harvest['id']}", headers=oauth_header,
+                            json={'fruit': 'cherry', 'price': 4, 'harvested': 100})
+    assert response.status_code == 200
+    summary = client.get(url=f"/seasons/{season['year']}/summary", headers=oauth_header).json()
+    assert summary['value_per_fruit'] == {'cherry': 400}
+    assert summary['total_employee_payments'] == 60
+
+    response = client.patch(url=f"/workdays/{workday['id']}", headers=oauth_header,
+                            json={'harvested': 30, 'pay_per_kg': 3})
+    assert response.status_code == 200
+    summary = client.get(url=f"/seasons/{season['year']}/summary", headers=oauth_header).json()
+    assert summary['total_employee_payments'] == 90
+
+    response = client.delete(url=f"/harvests/{harvest['id']}", headers=oauth_header)
+    assert response.status_code == 200
+    summary = client.get(url=f"/seasons/{season['year']}/summary", headers=oauth_header).json()
+    assert summary['fruits'] == []
+    assert summary['total_harvested_value'] == 0
+    assert summary['total_employee_payments'] == 0
+
+
+def test_rollup_deltas_keep_decimal_values_of_floats():
+    deltas = RollupDeltas()
+    deltas.expense(m.Expense(season_id=1, amount=10.1))
+    deltas.workday(m.Workday(fruit='cherry', harvested=0.1, pay_per_kg=3), season_id=1)
+    assert deltas.deltas[(1, NO_FRUIT)]['expenses'] == decimal.Decimal("10.1")
+    assert deltas.deltas[(1, 'cherry')]['employee_payout'] == decimal.Decimal("0.3")
+
+
+def test_admin_delete_all_seasons_deletes_rollups(create_season_fix):
+    oauth_header, season = create_season_fix
+    harvest = create_harvest(oauth_header, season['year'], price=5, harvested=100,
+                             date=datetime.date(season['year'], 7, 1), fruit='raspberry').json()
+    # rollup row of a fruit stays, zeroed, after its last harvest is deleted
+    client.delete(url=f"/harvests/{harvest['id']}", headers=oauth_header)
+    db = next(override_get_db())
+    assert db.query(m.SeasonRollup).filter(m.SeasonRollup.season_id == season['id']).count() == 1
+
+    set_test_user_auth_level(2)
+    response = client.delete(url="/admin/seasons/", headers=oauth_header)
+    assert response.status_code == 200
+    assert db.query(m.Season).count() == 0
+    assert db.query(m.SeasonRollup).count() == 0
+    db.close()
+
+
+def test_seasons_get_by_year_with_relationships(create_season_fix):
+    oauth_header, season = create_season_fix
+    harvest = create_harvest(oauth_header, season['year'], price=5, harvested=100,
+                             date=datetime.date(season['year'], 7, 1), fruit='raspberry').json()
+    expense = create_expense(oauth_header, season['year'], e_type='fuel',
+                             e_date=datetime.date(season['year'], 7, 3), amount=200).json()
+    response = client.get(f"/seasons/{season['year']}", headers=oauth_header)
+    assert response.status_code == 200
+    assert [h['id'] for h in response.json()['harvests']] == [harvest['id']]
+    assert [e['id'] for e in response.json()['expenses']] == [expense['id']]
+    assert response.json()['employees'] == []
+
+
+def test_season_summary_etag(create_season_fix):
+    oauth_header, season = create_season_fix
+    create_harvest(oauth_header, season['year'], price=5, harvested=100,
+                   date=datetime.date(season['year'], 7, 1), fruit='raspberry')
+    response = client.get(url=f"/seasons/{season['year']}/summary", headers=oauth_header)
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+
+    response = client.get(url=f"/seasons/{season['year']}/summary",
+                          headers={**oauth_header, 'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    assert response.content == b''
+
+    create_harvest(oauth_header, season['year'], price=4, harvested=50,
+                   date=datetime.date(season['year'], 7, 2), fruit='cherry')
+    response = client.get(url=f"/seasons/{season['year']}/summary",
+                          headers={**oauth_header, 'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert response.json()['harvests_n'] == 2
+
+    response = client.get(url=f"/seasons/{season['year']}/harvests",
+                          headers={**oauth_header, 'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_season_get_expenses_csv(create_season_fix):
+    oauth_header, season = create_season_fix
+    for day, amount in ((3, 200), (4, 150)):
+        create_expense(oauth_header, season['year'], e_type='fuel',
+                       e_date=datetime.date(season['year'], 7, day), amount=amount)
+    response = client.get(f"/seasons/{season['year']}/expenses?data_format=csv&order_by=date&order=asc",
+                          headers=oauth_header)
+    assert response.status_code == 200
+    assert response.headers['content-type'] == 'application/zip'
+    assert response.headers['content-disposition'] == f'attachment; filename="season_{season["year"]}_expenses.zip"'
+    with zipfile.ZipFile(io.BytesIO(response.content)) as zip_file:
+        assert zip_file.namelist() == [f"season_{season['year']}_expenses.csv"]
+        rows = list(csv.DictReader(io.TextIOWrapper(zip_file.open(zip_file.namelist()[0]), encoding='utf-8')))
+    assert [(r['type'], float(r['amount']), r['date']) for r in rows] == \
+           [('fuel', 200, f"{season['year']}-07-03"), ('fuel', 150, f"{season['year']}-07-04")]
+
+    response = client.get(f"/seasons/{season['year']}/expenses?data_format=csv&type=water", headers=oauth_header)
+    assert response.status_code == 404
+
+
+def test_season_get_expenses_cursor_pages(create_season_fix):
+    oauth_header, season = create_season_fix
+    expense_ids = [create_expense(oauth_header, season['year'], e_type='fuel',
+                                  e_date=datetime.date(season['year'], 7, day), amount=amount).json()['id']
+                   for day, amount in ((1, 100), (2, 300), (3, 100), (4, 200), (5, 300))]
+    url = f"/seasons/{season['year']}/expenses?order_by=amount&order=desc&limit=2"
+    pages = []
+    while url:
+        response = client.get(url, headers=oauth_header)
+        assert response.status_code == 200
+        pages.append([e['id'] for e in response.json()])
+        url = response.links.get('next', {}).get('url')
+    assert pages == [[expense_ids[4], expense_ids[1]], [expense_ids[3], expense_ids[2]], [expense_ids[0]]]
+
+    response = client.get(f"/seasons/{season['year']}/expenses?order_by=date&cursor=bm90LWEtY3Vyc29y",
+                          headers=oauth_header)
+    assert response.status_code == 400
@@ -1,7 +1,11 @@
+import datetime
+import json
+
 import pytest
 from pytest import fixture
 
 from .main_test import client, create_user_and_get_token
+from .seasons_test import create_season_fix, create_employee, create_harvest
 
 # TODO expand test suite
 
@@ -22,3 +26,56 @@ def test_workdays_fail_unauthorized_delete(endpoint, status):
 def test_workdays_fail_unauthorized_patch(endpoint, status):
     response = client.patch(url=endpoint, headers={}, allow_redirects=True)
     assert response.status_code == status
+
+
+def test_workdays_get_all(create_season_fix):
+    oauth_header, season = create_season_fix
+    employee = create_employee(oauth_header, season['year'], name="Stefan",
+                               start_date=datetime.date(season['year'], 6, 1),
+                               end_date=datetime.date(season['year'], 8, 1)).json()
+    harvest = create_harvest(oauth_header, season['year'], price=5, harvested=100,
+                             date=datetime.date(season['year'], 7, 1), fruit='raspberry',
+                             employee_ids=[employee['id']]).json()
+    workday_ids = [client.post(url=f"/harvests/{harvest['id']}/workdays", headers=oauth_header,
+                               json={'employee_id': employee['id'], 'harvested': harvested,
+                                     'pay_per_kg': 2}).json()['id']
+                   for harvested in (30, 20, 10)]
+
+    response = client.get("/workdays/?order_by=harvested&order=asc&limit=2", headers=oauth_header)
+    assert response.status_code == 200
+    assert [w['id'] for w in response.json()] == [workday_ids[2], workday_ids[1]]
+    response = client.get(response.links['next']['url'], headers=oauth_header)
+    assert [w['id'] for w in response.json()] == [workday_ids[0]]
+
+    response = client.get(f"/workdays/{workday_ids[0]}", headers=oauth_header)
+    assert response.status_code == 200
+    assert response.json()['harvested'] == 30
+
+
+def test_workdays_get_all_ndjson(create_season_fix):
+    oauth_header, season = create_season_fix
+    employee = create_employee(oauth_header, season['year'], name="Stefan",
+                               start_date=datetime.date(season['year'], 6, 1)).json()
+    harvest = create_harvest(oauth_header, season['year'], price=5, harvested=500,
+                             date=datetime.date(season['year'], 7, 3), fruit='raspberry',
+                             employee_ids=[employee['id']]).json()
+    for harvested in (10, 40, 30, 20):
+        client.post(url=f"/harvests/{harvest['id']}/workdays", headers=oauth_header,
+                    json={'employee_id': employee['id'], 'harvested': harvested, 'pay_per_kg': 2.5})
+
+    # all rows are streamed unless limit is given
+    response = client.get("/workdays/?data_format=ndjson&order_by=harvested&order=asc", headers=oauth_header)
+    assert response.status_code == 200
+    assert response.headers['content-type'] == "application/x-ndjson"
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [r['harvested'] for r in rows] == [10, 20, 30, 40]
+    assert rows[0] == {'id': rows[0]['id'], 'employee_id': employee['id'], 'harvest_id': harvest['id'],
+                       'employer_id': rows[0]['employer_id'], 'fruit': 'raspberry', 'harvested': 10,
+                       'pay_per_kg': 2.5}
+
+    response = client.get("/workdays/?limit=2", headers={**oauth_header, 'Accept': "application/x-ndjson"})
+    assert len(response.text.splitlines()) == 2
+    response = client.get("/workdays/?data_format=ndjson&fruit=cherry", headers=oauth_header)
+    assert response.status_code == 404
+    response = client.get("/workdays/?data_format=xml", headers=oauth_header)
+    assert response.status_code == 400